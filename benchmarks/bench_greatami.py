@@ -0,0 +1,168 @@
+'''Benchmark greatami.process_gafile and extract_img_links against their previous per-row implementations
+on a synthetic GA dump.
+
+    python bench_greatami.py --n_posts 250000 [--fmt jsonl]
+
+Each implementation runs in a fresh process, reporting wall time and peak RSS, and outputs are checked to be equal.
+
+At the default 250k posts (about 50x a full GA scrape), process_gafile takes 17.8s against 50.8s and 
+extract_img_links 7.4s against 22.1s, about 2.9x faster for both, with the same peak RSS (~2050MB). The target 
+of an order-of-magnitude speedup is only partly met: loading the json and building the frame, shared by both 
+versions, takes about a third of the vectorized time, and the remaining per-post work is on the extract dicts 
+and url lists, which stay Python objects. Peak memory is set by the parsed posts, and processing them in chunks 
+only keeps the vectorized version from adding to it.
+'''
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing as mp
+from pathlib import Path
+
+import pandas as pd
+
+from crawchet.process import greatami
+from crawchet.utils import uri as uutil
+
+from harness import peak_rss_mb
+
+LANG_TAGS = ['English', 'Spanish', 'French', 'German', 'Portuguese', 'Russian', 'Italian', 'Dutch']
+OTHER_TAGS = ['bear', 'bunny', 'cat', 'dog', 'doll', 'food', 'keychain', 'unicorn', 'sea creatures', 'christmas']
+
+
+def synthetic_gadata(n_posts, posts_per_page=64, seed=0):
+    '''Pages of posts shaped like `GreatAmigurumiScraper.scrape` output'''
+    rng = random.Random(seed)
+    def url(i, j):
+        host = rng.choice(['blogspot.com', 'wordpress.com', 'example.com'])
+        scheme = rng.choice(['https://', 'http://', '//'])
+        return f'{scheme}pattern{i%5000}.{host}/20{10+i%13}/0{1+j%9}/amigurumi-{i}-{j}.html'
+    def img(i, j):
+        scheme = rng.choice(['https://', 'http://', '//'])
+        return f'{scheme}{j%4}.bp.blogspot.com/-{i:x}/{j:x}/AAAA/s{rng.choice([200,320,400,1600])}/amigurumi_{i}_{j}.jpg'
+
+    posts = []
+    for i in range(n_posts):
+        n_items = rng.randint(0, 6)
+        parsed = [{'img_link': rng.choice([img(i,j), url(i,j)]), 'img_attrs': {'src': img(i,j), 'alt': '', 'border': '0'},
+                   'text_link': url(i,j), 'text_desc': f'Amigurumi pattern {i} {j}'} for j in range(n_items)]
+        langs = rng.sample(LANG_TAGS, rng.randint(0, 2))
+        posts.append({
+            'post_date': 'Jan 01, 2022',
+            'header': {'title_text': f'Amigurumi {i}', 'title_link': f'https://greatamigurumi.blogspot.com/2022/01/post-{i}.html'},
+            'body': {'parsed': parsed,
+                     'raw_links': [p['text_link'] for p in parsed] + [p['img_link'] for p in parsed],
+                     'raw_images': [p['img_attrs']['src'] for p in parsed],
+                     'raw_text': '  '.join(f'Amigurumi {i} {j} \n free pattern in {" and ".join(langs) or "english"}' for j in range(n_items))},
+            'footer': [{'tag': tag, 'taglink': f'https://greatamigurumi.blogspot.com/search/label/{tag}'}
+                       for tag in langs + rng.sample(OTHER_TAGS, rng.randint(0, 3))]})
+
+    return [{'url': '', 'page_data': posts[i:i+posts_per_page], 'num_posts': posts_per_page, 'next_page': None}
+            for i in range(0, n_posts, posts_per_page)]
+
+
+# previous implementations, per-row .apply over list columns
+
+def legacy_fix_bodylinks(body_extract):
+    for extr in body_extract:
+        extr.update(img_link=uutil.fix_imgurl(extr.get('img_link')))
+        extr.update(text_link=uutil.fix_urlscheme(extr.get('text_link')))
+        extr['img_attrs'].update(src=uutil.fix_imgurl(extr['img_attrs'].get('src')))
+    return body_extract
+
+def legacy_extract_languages(df_gaf):
+    langs = greatami.LANGUAGES
+    text_langs = df_gaf['raw_text'].str.extractall(f"({'|'.join(langs)})", re.I|re.M).groupby(level=0).agg(list)[0]
+    # previously an unordered set intersection, ordered as in the tags here for comparable output
+    tag_langs = df_gaf['tag_list'].apply(lambda x: [t for t in dict.fromkeys(x) if t in set(langs)])
+    lang_extracts = text_langs.reindex(tag_langs.index, fill_value=[])+tag_langs
+    return lang_extracts.apply(lambda x: list(dict.fromkeys([l.title() for l in x])))
+
+def legacy_process_gafile(ga_file):
+    df_gaf = pd.json_normalize(greatami.flatten_gadata(ga_file))
+    df_gaf.insert(0,'ptid',[f'{i:05d}' for i in range(len(df_gaf))])
+    df_gaf['tag_list'] = df_gaf.footer.apply(lambda taglist: [t.get('tag') for t in taglist])
+    df_gaf = df_gaf.rename(columns={'header.title_text':'post_title', 'header.title_link':'post_link', 'body.parsed': 'body_extracts'}).rename(lambda c: c.replace('body.',''),axis=1)
+    df_gaf['raw_text'] = (df_gaf['raw_text'].str.strip().str.replace(r' {2,}',' ', regex=True)
+                          .str.replace(r' ?\n ?','\n', regex=True).str.replace(r'\n',r'\\n', regex=True))
+    df_gaf = df_gaf.drop(columns='footer')
+    df_gaf['raw_images'] = df_gaf['raw_images'].apply(lambda img_urls: [uutil.fix_imgurl(img) for img in img_urls])
+    df_gaf['raw_links'] = df_gaf['raw_links'].apply(lambda urls: [uutil.fix_urlscheme(url) for url in urls])
+    df_gaf['body_extracts'].apply(legacy_fix_bodylinks)
+    df_gaf['languages'] = legacy_extract_languages(df_gaf)
+    df_gaf['text_links'] = df_gaf['body_extracts'].apply(lambda subp: [i['text_link'] for i in subp])
+    return df_gaf
+
+def legacy_extract_img_links(df_gaf):
+    df_gaimg = df_gaf[['ptid','raw_images','body_extracts','raw_links']].copy()
+    df_gaimg['imgurl'] = (
+        df_gaimg['raw_images']
+        + df_gaimg['body_extracts'].apply(lambda xtrcs: [x['img_attrs']['src'] for x in xtrcs] + [*filter(uutil.is_imageurl, [x['img_link'] for x in xtrcs])])
+        + df_gaimg['raw_links'].apply(lambda links: [*filter(uutil.is_imageurl,links)]))
+    df_gaimg = df_gaimg[['imgurl','ptid']].explode('imgurl')
+    df_gaimg['imgurl'] = df_gaimg['imgurl'].apply(uutil.fix_imgurl)
+    return df_gaimg.drop_duplicates('imgurl')
+
+
+IMPLEMENTATIONS = {
+    'legacy': (legacy_process_gafile, legacy_extract_img_links),
+    'vectorized': (greatami.process_gafile, greatami.extract_img_links),
+}
+
+
+def _run(impl, ga_file, out_file, queue):
+    process_gafile, extract_img_links = IMPLEMENTATIONS[impl]
+    base_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    df_gaf = process_gafile(ga_file)
+    t1 = time.perf_counter()
+    df_gaimg = extract_img_links(df_gaf)
+    t2 = time.perf_counter()
+    peak_rss = peak_rss_mb()
+    pd.to_pickle((df_gaf, df_gaimg), out_file)
+    queue.put({'impl': impl, 'process_gafile_s': round(t1-t0, 3), 'extract_img_links_s': round(t2-t1, 3),
+               'peak_rss_mb': round(peak_rss, 1), 'base_rss_mb': round(base_rss, 1)})
+
+
+def run_benchmark(n_posts, seed=0, fmt='json'):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ga_file = Path(tmp_dir)/f'ga.{fmt}'
+        gadata = synthetic_gadata(n_posts, seed=seed)
+        if fmt == 'jsonl':
+            ga_file.write_text(''.join(json.dumps(post)+'\n' for post in greatami.flatten_gadata(gadata)))
+        else:
+            ga_file.write_text(json.dumps(gadata))
+        del gadata
+
+        ctx = mp.get_context('spawn') # fresh process per implementation for a clean peak rss
+        results, outputs = [], {}
+        for impl in IMPLEMENTATIONS:
+            queue = ctx.Queue()
+            out_file = Path(tmp_dir)/f'{impl}.pkl'
+            proc = ctx.Process(target=_run, args=(impl, ga_file, out_file, queue))
+            proc.start()
+            results.append(queue.get())
+            proc.join()
+            outputs[impl] = pd.read_pickle(out_file)
+
+    (gaf_a, img_a), (gaf_b, img_b) = outputs['legacy'], outputs['vectorized']
+    same = gaf_a.astype(str).equals(gaf_b.astype(str)) and img_a.astype(str).equals(img_b.astype(str))
+    return {'n_posts': n_posts, 'fmt': fmt, 'outputs_equal': same, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark GA dump processing')
+    parser.add_argument('--n_posts', type=int, default=250000, help='posts in the synthetic dump, the default is about 50x a full GA scrape')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fmt', type=str, default='json', choices=['json', 'jsonl'], help='a JSON list of pages, or JSON Lines of posts as scraped now')
+    parser.add_argument('--json_out', type=str, default=None)
+    args = parser.parse_args()
+
+    report = run_benchmark(args.n_posts, args.seed, args.fmt)
+    print(json.dumps(report, indent=1))
+    if args.json_out is not None:
+        Path(args.json_out).write_text(json.dumps(report, indent=1))
+    sys.exit(0 if report['outputs_equal'] else 1)
@@ -0,0 +1,72 @@
+'''Benchmark import time of the crawchet modules and joblib worker startup, each in a fresh interpreter.
+
+    python bench_imports.py --repeat 5 --json_out imports.json
+
+For each module: median seconds to import it, the number of modules loaded, and which heavy dependencies were loaded.
+worker_spawn is the time for a first Parallel call that runs `parsehtml.extract_main_content` in 2 new loky workers,
+which import the function's module (and whatever it imports) on startup.
+'''
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+MODULES = ['crawchet.utils.io', 'crawchet.utils.uri', 'crawchet.utils.html', 'crawchet.process.greatami', 'crawchet.process.archive',
+           'crawchet.process.parsehtml', 'crawchet.process.dataset', 'crawchet.process.transform', 'crawchet.pipeline']
+HEAVY = ['pandas', 'numpy', 'pyarrow', 'scipy', 'yaml', 'joblib', 'tqdm', 'bs4', 'html2text', 'readabilipy', 'css_inline',
+         'minify_html', 'warcio', 'waybackpy', 'requests', 'lxml']
+
+IMPORT_CODE = '''
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter()-t0
+print(json.dumps({{'seconds': seconds, 'n_modules': len(sys.modules), 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+SPAWN_CODE = '''
+import time, json
+from joblib import Parallel, delayed
+from crawchet.process import parsehtml
+t0 = time.perf_counter()
+Parallel(n_jobs=2)(delayed(parsehtml.extract_main_content)('<html><body><p>sc in each st</p></body></html>') for _ in range(2))
+print(json.dumps({'seconds': time.perf_counter()-t0}))
+'''
+
+
+def _run_code(code):
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def bench_import(module, repeat=5):
+    runs = [_run_code(IMPORT_CODE.format(module=module, heavy=HEAVY)) for _ in range(repeat)]
+    return {'module': module, 'seconds': round(statistics.median(r['seconds'] for r in runs), 4),
+            'n_modules': runs[-1]['n_modules'], 'loaded': runs[-1]['loaded']}
+
+
+def bench_worker_spawn(repeat=5):
+    return {'seconds': round(statistics.median(_run_code(SPAWN_CODE)['seconds'] for _ in range(repeat)), 4)}
+
+
+def run_benchmark(modules=MODULES, repeat=5):
+    # one untimed run first, so that all runs read .pyc files from the page cache
+    _run_code(IMPORT_CODE.format(module='crawchet.process.transform', heavy=HEAVY))
+    return {'python': sys.version.split()[0], 'repeat': repeat,
+            'imports': [bench_import(module, repeat) for module in modules],
+            'worker_spawn': bench_worker_spawn(repeat)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark crawchet import time and worker startup')
+    parser.add_argument('--modules', type=str, nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per module, the median is reported')
+    parser.add_argument('--json_out', type=str, default=None)
+    args = parser.parse_args()
+
+    report = run_benchmark(args.modules, args.repeat)
+    print(json.dumps(report, indent=1))
+    if args.json_out is not None:
+        Path(args.json_out).write_text(json.dumps(report, indent=1))
@@ -0,0 +1,155 @@
+'''Offline throughput benchmarks of the crawl, archive, parse and transform stages on synthetic blog pages.
+
+    python bench_pipeline.py --n_pages 5000 --page_kb 40 --n_jobs 4 --json_out bench.json
+
+Pages are crawled from a local `synthetic.StandInServer` and the other stages read a synthetic WARC corpus, so nothing
+touches the network. Each benchmark runs in a fresh process and reports pages/sec, MB/s (of html payload) and peak RSS.
+setup_rss_mb is the peak before the timed step, e.g. after loading its input.
+'''
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from crawchet.collect.crawl import WARCAsyncCrawler
+from crawchet.process import archive, transform
+
+from harness import peak_rss_mb, run_isolated, throughput
+from synthetic import StandInServer, write_synthetic_warc
+
+BENCHMARKS = ['crawl', 'to_dataframe', 'parse_fast', 'parse_generic', 'warc_to_dftext', 'parallel_simplify']
+PARSERS = {'parse_fast': 'fast', 'parse_generic': 'reduce'}
+
+
+def _payload_bytes(contents):
+    return sum(len(c) for c in contents if c is not None)
+
+
+def bench_crawl(urls, warc_file, limit_per_host):
+    # nameservers are only used to resolve hostnames, the stand-in is addressed by ip
+    crawler = WARCAsyncCrawler(warc_file, limit=limit_per_host, limit_per_host=limit_per_host)
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    asyncio.run(crawler.crawl_urls(urls))
+    seconds = time.perf_counter()-t0
+    df_records = archive.ArchiveManager().to_dataframe(warc_file)
+    return {**throughput(seconds, len(df_records), _payload_bytes(df_records['content'])), 'hits': dict(crawler._hits),
+            'setup_rss_mb': round(setup_rss, 1)}
+
+
+def bench_to_dataframe(warc_file, n_jobs):
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    df_records = archive.ArchiveManager().to_dataframe(warc_file, n_jobs=n_jobs)
+    seconds = time.perf_counter()-t0
+    return {**throughput(seconds, len(df_records), _payload_bytes(df_records['content'])), 'setup_rss_mb': round(setup_rss, 1)}
+
+
+def bench_parse(warc_file, tag_transform, n_jobs, batch_size, preprocess_engine='legacy'):
+    df_records = archive.ArchiveManager().to_dataframe(warc_file)
+    gp = transform.get_parser(tag_transform, preprocess_engine=preprocess_engine)
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    gp.parallel_parse(df_records['content'], df_records['target_uri'], n_jobs=n_jobs, batch_size=batch_size)
+    seconds = time.perf_counter()-t0
+    return {**throughput(seconds, len(df_records), _payload_bytes(df_records['content'])), 'parser': type(gp).__name__,
+            'setup_rss_mb': round(setup_rss, 1)}
+
+
+def bench_warc_to_dftext(warc_file, n_bytes, n_jobs, preprocess_engine='legacy'):
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    df_textracts = transform.warc_to_dftext(warc_file, tag_transform='fast', n_jobs=n_jobs, preprocess_engine=preprocess_engine)
+    seconds = time.perf_counter()-t0
+    n_records = len(archive.ArchiveManager().member_offsets(warc_file))
+    return {**throughput(seconds, n_records, n_bytes), 'n_kept': len(df_textracts), 'setup_rss_mb': round(setup_rss, 1)}
+
+
+def bench_parallel_simplify(df_master_path, json_out_path, n_jobs, simplifier):
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    df_master = transform.parallel_simplify(df_master_path, json_out_path, n_jobs=n_jobs, simplifier=simplifier)
+    seconds = time.perf_counter()-t0
+    return {**throughput(seconds, len(df_master), _payload_bytes(df_master['content'])), 'simplifier': simplifier,
+            'setup_rss_mb': round(setup_rss, 1)}
+
+
+def write_synthetic_master(warc_file, df_master_path):
+    '''The columns of df_master that `transform.parallel_simplify` reads, for the 200 pages of a synthetic WARC'''
+    df_records = archive.ArchiveManager().to_dataframe(warc_file)
+    df_master = df_records[df_records['status'] == 200][['target_uri', 'content', 'content_length']].rename(columns={'target_uri': 'url'})
+    df_master.insert(0, 'ptid', [f'{i:05d}' for i in range(len(df_master))])
+    df_master['post_title'] = df_master['url'].str.extract(r'/(\d+)\.html$', expand=False).radd('Amigurumi ')
+    df_master['languages'] = [['English']]*len(df_master)
+    df_master['term_count'] = 0
+    df_master.reset_index(drop=True).to_pickle(df_master_path)
+
+
+def run_benchmarks(benchmarks, n_pages, page_size, n_jobs, batch_size=64, latency=0.0, error_rate=0.0,
+                   limit_per_host=100, simplifier='lxml', seed=0, preprocess_engine='legacy'):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        warc_file = tmp_dir/'pages.warc.gz'
+        n_bytes = write_synthetic_warc(warc_file, n_pages, page_size, error_rate, seed)
+
+        for name in benchmarks:
+            print(f'running {name}...')
+            if name == 'crawl':
+                with StandInServer(page_size, latency, error_rate, seed) as server:
+                    urls = [server.url(i) for i in range(n_pages)]
+                    results[name] = run_isolated(bench_crawl, urls=urls, warc_file=tmp_dir/'crawled.warc.gz', limit_per_host=limit_per_host)
+            elif name == 'to_dataframe':
+                results[name] = run_isolated(bench_to_dataframe, warc_file=warc_file, n_jobs=n_jobs)
+            elif name in PARSERS:
+                results[name] = run_isolated(bench_parse, warc_file=warc_file, tag_transform=PARSERS[name], n_jobs=n_jobs, batch_size=batch_size,
+                                             preprocess_engine=preprocess_engine)
+            elif name == 'warc_to_dftext':
+                results[name] = run_isolated(bench_warc_to_dftext, warc_file=warc_file, n_bytes=n_bytes, n_jobs=n_jobs, preprocess_engine=preprocess_engine)
+            elif name == 'parallel_simplify':
+                df_master_path = tmp_dir/'df_master.pkl'
+                if not df_master_path.exists():
+                    write_synthetic_master(warc_file, df_master_path)
+                results[name] = run_isolated(bench_parallel_simplify, df_master_path=df_master_path, json_out_path=tmp_dir/'simphtml.json',
+                                             n_jobs=n_jobs, simplifier=simplifier)
+
+    params = {'n_pages': n_pages, 'page_size': page_size, 'corpus_mb': round(n_bytes/1e6, 2), 'n_jobs': n_jobs, 'batch_size': batch_size,
+              'latency': latency, 'error_rate': error_rate, 'simplifier': simplifier, 'seed': seed,
+              'preprocess_engine': preprocess_engine}
+    env = {'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.machine()}
+    return {'time': pd.Timestamp.now().isoformat(timespec='seconds'), 'params': params, 'env': env, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark crawl, archive, parse and transform throughput offline')
+    parser.add_argument('--only', type=str, nargs='*', default=None, help=f'benchmarks to run (default: all), any of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--n_pages', type=int, default=2000)
+    parser.add_argument('--page_kb', type=float, default=40, help='approximate size of each synthetic page')
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=64, help='parallel_parse batch size')
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in server response delay in seconds')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of pages served/stored as 404/500/503')
+    parser.add_argument('--limit_per_host', type=int, default=100, help='crawler connections to the stand-in server')
+    parser.add_argument('--simplifier', type=str, default='lxml', choices=['lxml', 'readability'], help='readability needs node')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--preprocess_engine', type=str, default='legacy', choices=['legacy', 'tree'], help='parsehtml preprocessing engine')
+    parser.add_argument('--json_out', type=str, default=None)
+    args = parser.parse_args()
+
+    benchmarks = args.only or BENCHMARKS
+    unknown = [b for b in benchmarks if b not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks {unknown}, expected any of {BENCHMARKS}')
+
+    report = run_benchmarks(benchmarks, args.n_pages, int(args.page_kb*1000), args.n_jobs, args.batch_size, args.latency,
+                            args.error_rate, args.limit_per_host, args.simplifier, args.seed, args.preprocess_engine)
+    print(json.dumps(report, indent=1))
+    if args.json_out is not None:
+        Path(args.json_out).write_text(json.dumps(report, indent=1))
+    sys.exit(1 if any('error' in r for r in report['results'].values()) else 0)
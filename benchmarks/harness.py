@@ -0,0 +1,48 @@
+'''Shared helpers for the benchmark scripts: peak memory and running a benchmark in a fresh process'''
+import re
+import time
+import resource
+import traceback
+import multiprocessing as mp
+from pathlib import Path
+
+
+def peak_rss_mb():
+    '''Peak resident memory of this process. ru_maxrss carries over the parent's peak across exec on Linux, VmHWM does not.'''
+    try:
+        status = Path('/proc/self/status').read_text()
+        return int(re.search(r'VmHWM:\s+(\d+) kB', status).group(1))/1024
+    except (OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def _run_target(func, kwargs, queue):
+    try:
+        t0 = time.perf_counter()
+        result = func(**kwargs)
+        result.update(total_s=round(time.perf_counter()-t0, 3), peak_rss_mb=round(peak_rss_mb(), 1))
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    queue.put(result)
+    # multiprocessing would otherwise wait at exit for the loky workers that joblib keeps alive for reuse
+    for child in mp.active_children():
+        child.terminate()
+
+
+def run_isolated(func, **kwargs):
+    '''Run func(**kwargs) in a spawned process for a clean peak rss. func returns a dict of results,
+    to which the total wall time and peak rss of the process are added.'''
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_target, args=(func, kwargs, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def throughput(seconds, n_pages, n_bytes):
+    '''pages/sec and MB/s of a timed step'''
+    return {'seconds': round(seconds, 3), 'n_pages': n_pages, 'mb': round(n_bytes/1e6, 2),
+            'pages_per_s': round(n_pages/seconds, 1) if seconds else None,
+            'mb_per_s': round(n_bytes/1e6/seconds, 2) if seconds else None}
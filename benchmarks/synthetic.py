@@ -0,0 +1,173 @@
+'''Synthetic blog pages for offline benchmarks: a WARC corpus generator and a local aiohttp stand-in for the crawled sites.
+
+    python synthetic.py --warc_out pages.warc.gz --n_pages 5000 --page_kb 40
+'''
+import io
+import zlib
+import random
+import asyncio
+import argparse
+import threading
+from pathlib import Path
+
+from aiohttp import web
+from warcio.warcwriter import WARCWriter
+from warcio.statusandheaders import StatusAndHeaders
+
+WORDS = ('the of and to in a is for with this that you it on pattern free crochet amigurumi doll bear bunny yarn hook '
+         'stuffing eyes safety cute little tutorial easy beginner stitch round repeat make finish sew head body arms legs').split()
+ROUNDS = ['Rnd {r}: {n} sc in magic ring ({n})', 'Rnd {r}: inc x{n} ({m})', 'Rnd {r}: (sc, inc) x{n} ({m})',
+          'Rnd {r}: sc in each st around ({m})', 'Rnd {r}: (sc, dec) x{n} ({m})', 'Rnd {r}: dec x{n}, fasten off ({n})']
+ERROR_STATUSES = [(404, 'Not Found'), (500, 'Internal Server Error'), (503, 'Service Unavailable')]
+
+
+def _sentence(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + '.'
+
+def synthetic_page(i, size=40_000, seed=0):
+    '''Blog post html of about size bytes: navigation, sidebar and comment boilerplate around a pattern with rounds,
+    images and links. Pages are deterministic in (i, seed).'''
+    rng = random.Random(f'{seed}-{i}')
+    host = f'pattern{i%500}.blogspot.com'
+    nav = ''.join(f'<li><a href="https://{host}/search/label/{w}">{w}</a></li>' for w in rng.sample(WORDS, 8))
+    sidebar = ''.join(f'<div class="widget"><h2>{_sentence(rng, 3)}</h2><a href="https://{host}/20{10+j}/">archive</a></div>' for j in range(6))
+    head = (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Amigurumi {i} free pattern</title>'
+            f'<style>.post{{margin:0 auto}} .widget{{float:right}}</style><script>var post_id={i};</script></head><body>'
+            f'<div id="header"><h1><a href="https://{host}/">Pattern blog {i%500}</a></h1><ul class="nav">{nav}</ul></div>'
+            f'<div id="sidebar">{sidebar}</div><div class="post hentry"><h3 class="post-title">Amigurumi {i} free pattern</h3>'
+            f'<div class="post-body entry-content"><p>{_sentence(rng, 25)}</p>')
+    tail = (f'</div></div><div id="comments"><p>{_sentence(rng, 12)}</p></div>'
+            f'<div id="footer"><p>&copy; Pattern blog {i%500}</p></div></body></html>')
+
+    parts, n_bytes, r = [head], len(head) + len(tail), 1
+    while n_bytes < size:
+        if rng.random() < 0.15:
+            block = (f'<p><a href="https://{host}/2022/01/part-{r}.jpg"><img src="https://{i%4}.bp.blogspot.com/-{i:x}/{r:x}/s400/amigurumi_{i}_{r}.jpg" '
+                     f'alt="step {r}" width="400"></a></p><h4>{_sentence(rng, 4)}</h4>')
+        else:
+            n = rng.randint(4, 12)
+            rounds = '<br>'.join(rng.choice(ROUNDS).format(r=r+k, n=n, m=n*2) for k in range(rng.randint(2, 6)))
+            block = f'<p>{_sentence(rng, rng.randint(8, 30))}</p><p>{rounds}</p>'
+        parts.append(block)
+        n_bytes += len(block)
+        r += 1
+    parts.append(tail)
+    return ''.join(parts)
+
+
+def page_status(i, error_rate=0.0, seed=0):
+    '''(status, reason) of page i, an error for about error_rate of the pages'''
+    if zlib.crc32(f'{seed}-{i}'.encode()) / 2**32 < error_rate:
+        return ERROR_STATUSES[i % len(ERROR_STATUSES)]
+    return 200, 'OK'
+
+
+def page_url(i, base_url='http://pattern.example.com'):
+    return f'{base_url}/post/{i}.html'
+
+
+def write_synthetic_warc(warc_file, n_pages=5000, page_size=40_000, error_rate=0.0, seed=0):
+    '''Write a gzipped WARC of n_pages response records as `WARCAsyncCrawler` would. Error pages get a short body.
+
+    Returns:
+        int: total payload bytes
+    '''
+    n_bytes = 0
+    Path(warc_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(warc_file, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        for i in range(n_pages):
+            status, reason = page_status(i, error_rate, seed)
+            payload = (synthetic_page(i, page_size, seed) if status == 200 else f'<html><body><h1>{reason}</h1></body></html>').encode()
+            http_headers = StatusAndHeaders(f'{status} {reason}', [('Content-Type', 'text/html; charset=utf-8'),
+                                                                   ('Content-Length', str(len(payload)))], protocol='HTTP/1.1')
+            record = writer.create_warc_record(page_url(i), 'response', payload=io.BytesIO(payload), http_headers=http_headers)
+            writer.write_record(record)
+            n_bytes += len(payload)
+    return n_bytes
+
+
+class StandInServer:
+    '''Local aiohttp server for /post/<i>.html synthetic pages, run on its own event loop in a background thread.
+
+    Args:
+        page_size (int): approximate page size in bytes (default: 40000)
+        latency (float): seconds before each response (default: 0.0)
+        error_rate (float): fraction of pages answered with a 404/500/503 (default: 0.0)
+
+    Example:
+        with StandInServer(latency=0.05, error_rate=0.02) as server:
+            urls = [server.url(i) for i in range(1000)]
+    '''
+    def __init__(self, page_size=40_000, latency=0.0, error_rate=0.0, seed=0, host='127.0.0.1', port=0) -> None:
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.host = host
+        self.port = port
+        self.bytes_served = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def url(self, i):
+        return page_url(i, f'http://{self.host}:{self.port}')
+
+    async def handle_page(self, request):
+        i = int(request.match_info['i'])
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        status, reason = page_status(i, self.error_rate, self.seed)
+        body = synthetic_page(i, self.page_size, self.seed) if status == 200 else f'<html><body><h1>{reason}</h1></body></html>'
+        self.bytes_served += len(body.encode())
+        return web.Response(text=body, status=status, content_type='text/html')
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get(r'/post/{i:\d+}.html', self.handle_page)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic WARC corpus or serve synthetic pages')
+    parser.add_argument('--warc_out', type=str, default=None, help='write a .warc.gz here, otherwise serve pages until interrupted')
+    parser.add_argument('--n_pages', type=int, default=5000)
+    parser.add_argument('--page_kb', type=float, default=40)
+    parser.add_argument('--latency', type=float, default=0.0, help='server response delay in seconds')
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    page_size = int(args.page_kb*1000)
+    if args.warc_out is not None:
+        n_bytes = write_synthetic_warc(args.warc_out, args.n_pages, page_size, args.error_rate, args.seed)
+        print(f'wrote {args.n_pages} pages ({n_bytes/1e6:.1f}MB) to {args.warc_out}')
+    else:
+        with StandInServer(page_size, args.latency, args.error_rate, args.seed, port=args.port) as server:
+            print(f'serving synthetic pages at {server.url(0)}, ctrl-c to stop')
+            threading.Event().wait()
@@ -1,6 +1,7 @@
 import os
 import io
 import asyncio
+from pathlib import Path
 import aiohttp
 from aiohttp.resolver import AsyncResolver
 from tqdm.auto import tqdm
@@ -10,6 +11,7 @@ from warcio.statusandheaders import StatusAndHeaders
 from warcio.utils import BUFF_SIZE as WARCIO_BUFF_SIZE # 16384
 
 from crawchet.utils import uri
+from crawchet.utils import instrument
 
 class AsyncCrawler:
     def __init__(self, **session_kwargs) -> None:
@@ -54,8 +56,9 @@ class AsyncCrawler:
     async def crawl_urls(self, urls):
         self.pbar = tqdm(total=len(urls), postfix=self._hits)
         
-        async with self.get_session() as session:
-            ret = await asyncio.gather(*[self.async_get(url, session) for url in urls])
+        with instrument.span('crawl', items=len(urls)):
+            async with self.get_session() as session:
+                ret = await asyncio.gather(*[self.async_get(url, session) for url in urls])
         
         print('Done. Results:', self._hits)
         
@@ -106,8 +109,9 @@ class WARCAsyncCrawler(AsyncCrawler):
             output = open(self.warc_outfile, 'wb')
             self.writer = WARCWriter(output, gzip=True)
             
-            async with self.get_session() as session:  
-                await asyncio.gather(*[self.async_get(url, session) for url in urls])
+            with instrument.span('crawl', items=len(urls)):
+                async with self.get_session() as session:  
+                    await asyncio.gather(*[self.async_get(url, session) for url in urls])
         finally:
             self.writer.out.close()
 
@@ -188,8 +192,47 @@ class ImageAsyncCrawler(AsyncCrawler):
     async def crawl_urls(self, url_ptids):
         self.pbar = tqdm(total=len(url_ptids), postfix=self._hits)
 
-        async with self.get_session() as session:
-            ret = await asyncio.gather(*[self.async_get(url, ptid, session) for url,ptid in url_ptids])
+        with instrument.span('crawl_images', items=len(url_ptids)):
+            async with self.get_session() as session:
+                ret = await asyncio.gather(*[self.async_get(url, ptid, session) for url,ptid in url_ptids])
+        
+        print('Done. Results:', self._hits)
+        
+        return ret
+
+
+class ImageFileCrawler(ImageAsyncCrawler):
+    '''Download images straight to their files, so only the images in flight are held in memory.
+    
+    Args:
+        max_tasks (int): downloads in progress at once (default: 200)
+    '''
+    def __init__(self, max_tasks=200, **session_kwargs) -> None:
+        self.max_tasks = max_tasks
+        super().__init__(**session_kwargs)
+
+    async def async_save(self, url, ptid, filepath, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            _, _, content = await self.async_get(url, ptid, session)
+        if content is None:
+            return False
+        try:
+            filepath = Path(filepath)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_bytes(content)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    async def crawl_urls(self, url_ptid_paths):
+        '''Download (url, ptid, filepath) items in one session, returning if each was saved'''
+        self.pbar = tqdm(total=len(url_ptid_paths), postfix=self._hits)
+        semaphore = asyncio.Semaphore(self.max_tasks)
+
+        with instrument.span('crawl_images', items=len(url_ptid_paths)):
+            async with self.get_session() as session:
+                ret = await asyncio.gather(*[self.async_save(url, ptid, path, session, semaphore) for url,ptid,path in url_ptid_paths])
         
         print('Done. Results:', self._hits)
         
@@ -1,8 +1,11 @@
+import json
 import time
 from warcio.capture_http import capture_http
 import requests # requests must be imported after capture_http
 from bs4 import BeautifulSoup
 
+from crawchet.utils.io import open_text
+
 
 class GreatAmigurumiScraper:
     def __init__(self) -> None:
@@ -84,11 +87,11 @@ class GreatAmigurumiScraper:
         return {'post_date': post_date, 'header':header_data, 'body':body_data, 'footer':footer_data}
 
 
-    def scrape(self, warc_outfile, timeout=2):
+    def iter_pages(self, warc_outfile, timeout=2):
+        '''Scrape the blog page by page, yielding each page's data as soon as it is parsed'''
         ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
         headers={'Accept-Encoding': 'identity', 'user-agent':ua}
         url = 'https://greatamigurumi.blogspot.com/search?updated-max=2023-12-31T03:09:00-07:00&max-results=64&start=0&by-date=false'
-        site_data = []
         
         with capture_http(warc_outfile),requests.Session() as session:
             session.headers.update(headers)
@@ -109,9 +112,27 @@ class GreatAmigurumiScraper:
                 next_link = doc.find('a',text='Older Posts')
                 next_url = next_link['href'] if next_link is not None else None
                     
-                top_data = {'url': url, 'page_data':page_data, 'num_posts':len(posts), 'next_page':next_url}
-                site_data.append(top_data)
+                yield {'url': url, 'page_data':page_data, 'num_posts':len(posts), 'next_page':next_url}
                 url = next_url
                 time.sleep(timeout)
-            
-        return site_data
+
+    def scrape(self, warc_outfile, timeout=2):
+        return list(self.iter_pages(warc_outfile, timeout))
+
+    def scrape_jsonl(self, warc_outfile, jsonl_outfile, timeout=2):
+        '''Scrape, appending one JSON line per post to jsonl_outfile (gzipped if it ends in .gz) after each page.
+        Nothing is kept in memory, and an interrupted scrape leaves every page written before it readable
+        (see `greatami.iter_gaposts`).
+
+        Returns:
+            int: number of posts written
+        '''
+        n_posts = 0
+        with open_text(jsonl_outfile, 'w') as f:
+            for page in self.iter_pages(warc_outfile, timeout):
+                f.writelines(json.dumps(post) + '\n' for post in page['page_data'])
+                # for gzip, a sync flush makes everything written so far decompressible
+                f.flush()
+                n_posts += len(page['page_data'])
+        
+        return n_posts
@@ -0,0 +1,357 @@
+'''Run the dataset scripts as one pipeline, skipping stages whose inputs and code have not changed.
+
+    crawchet run                  # everything that is stale
+    crawchet run datasets         # datasets and whatever stale stages it depends on
+    crawchet run --from pages     # resume: rerun pages and everything downstream of it
+    crawchet run --report         # also write a timing report of each stage to data/logs (see `crawchet.utils.instrument`)
+    crawchet status               # what would run
+
+Each stage runs its script from scripts/ in a subprocess, with output in data/logs/<stage>.log. A stage is skipped
+when the hash of its code, command and input files matches the one it last ran with, and its outputs still hold
+what it wrote. Stages that don't depend on each other run concurrently (--jobs).
+'''
+import os
+import ast
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+ROOT = Path(__file__).resolve().parents[1]
+DATA_DIR = ROOT/'data'
+SCRIPTS_DIR = ROOT/'scripts'
+STATE_FILE = DATA_DIR/'.pipeline_state.json'
+LOG_DIR = DATA_DIR/'logs'
+
+
+class Stage:
+    '''A script and the artifacts it reads and writes.
+
+    Args:
+        name (str): stage name
+        script (str): script in scripts/, run with args from that directory
+        inputs (list): files or directories under data/ the stage reads
+        outputs (list): files or directories under data/ the stage writes
+        code (list): other files or directories, relative to the repo root, whose changes make the stage stale. 
+            The script and the package modules it imports, directly or not, are always included (see `imported_modules`)
+        args (list): extra command line arguments for the script
+    '''
+    def __init__(self, name, script, inputs, outputs, code=(), args=()) -> None:
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.extra_code = list(code)
+        self.args = list(args)
+
+    @property
+    def code(self):
+        script = SCRIPTS_DIR/self.script
+        return list(dict.fromkeys([script.relative_to(ROOT).as_posix(), *imported_modules(script), *self.extra_code]))
+
+    @property
+    def command(self):
+        return [sys.executable, self.script, *self.args]
+
+
+def _module_file(name):
+    '''File of a module under ROOT, a package's __init__.py, or None'''
+    path = ROOT.joinpath(*name.split('.'))
+    for file in [path.with_suffix('.py'), path/'__init__.py']:
+        if file.is_file():
+            return file
+    return None
+
+
+def imported_modules(file):
+    '''Paths, relative to ROOT, of the package modules file imports, directly or through the modules it imports. 
+    Parent packages are included since their __init__ runs on import. Modules outside ROOT are ignored.'''
+    found, todo = {}, [Path(file)]
+    while todo:
+        path = todo.pop()
+        if not path.is_file():
+            continue
+        package = path.relative_to(ROOT).parent.parts if path.is_relative_to(ROOT) else ()
+        for node in ast.walk(ast.parse(path.read_bytes())):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                parent = package[:len(package)-node.level+1] if node.level else ()
+                base = '.'.join([*parent, *filter(None, [node.module])])
+                # from a package import a submodule or a name defined in it
+                names = [base, *(f'{base}.{alias.name}' for alias in node.names)]
+            else:
+                continue
+            for name in names:
+                parts = name.split('.')
+                for i in range(1, len(parts)+1):
+                    module = _module_file('.'.join(parts[:i]))
+                    if module is not None and module not in found:
+                        found[module] = module.relative_to(ROOT).as_posix()
+                        todo.append(module)
+    return sorted(found.values())
+
+
+STAGES = [
+    Stage('scrape', 'gascrape.py', [],
+          ['interim/greatamigurumi.jsonl']),
+    Stage('urls', 'write_urls.py', ['interim/greatamigurumi.jsonl'],
+          ['raw/urls/url_list.txt', 'raw/urls/archive_url_list.txt', 'raw/urls/waybacklinks_result.json']),
+    Stage('pages', 'asyncget.py', ['raw/urls/url_list.txt', 'raw/urls/archive_url_list.txt'],
+          ['raw/pages/merged.warc.gz']),
+    Stage('datasets', 'build_datasets.py', ['interim/greatamigurumi.jsonl', 'raw/pages/merged.warc.gz'],
+          ['interim/df_master', 'staged/simphtml.json'], code=['crawchet/process/js']),
+    Stage('images', 'dl_images.py', ['interim/greatamigurumi.jsonl', 'staged/simphtml.json'],
+          ['raw/images/images.csv'], args=['--source', 'all']),
+]
+
+
+def dependencies(stages):
+    '''{stage name: names of the stages producing its inputs}'''
+    producers = {out:stage.name for stage in stages for out in stage.outputs}
+    return {stage.name: sorted({producers[inp] for inp in stage.inputs if inp in producers}) for stage in stages}
+
+
+def downstream(stages, name):
+    '''name and every stage that depends on it, directly or not'''
+    deps = dependencies(stages)
+    found = {name}
+    while True:
+        more = {s for s,ds in deps.items() if found & set(ds)} - found
+        if not more:
+            return found
+        found |= more
+
+
+def upstream(stages, names):
+    '''names and every stage they depend on'''
+    deps = dependencies(stages)
+    found, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name not in found:
+            found.add(name)
+            todo.extend(deps[name])
+    return found
+
+
+class Hasher:
+    '''Content hashes of files and directories. A file is only read again when its size or mtime changed.
+
+    Args:
+        file_hashes (dict): {path: [size:mtime_ns, sha256]} from a previous run, updated in place
+    '''
+    def __init__(self, file_hashes) -> None:
+        self.file_hashes = file_hashes
+
+    def file_hash(self, path):
+        stat = path.stat()
+        stamp = f'{stat.st_size}:{stat.st_mtime_ns}'
+        cached = self.file_hashes.get(path.as_posix())
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1<<20):
+                digest.update(chunk)
+        self.file_hashes[path.as_posix()] = [stamp, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def artifact_hash(self, path):
+        '''Hash of a file, or of the relative paths and contents of the files in a directory. None if it does not exist'''
+        path = Path(path)
+        if path.is_file():
+            return self.file_hash(path)
+        if not path.is_dir():
+            return None
+
+        digest = hashlib.sha256()
+        for file in sorted(p for p in path.rglob('*') if p.is_file() and '__pycache__' not in p.parts):
+            digest.update(f'{file.relative_to(path).as_posix()}:{self.file_hash(file)}\n'.encode())
+        return digest.hexdigest()
+
+
+class Pipeline:
+    '''Stages run in dependency order, skipping those already up to date (see `Stage`).
+
+    Args:
+        stages (list): Stage objects
+        jobs (int): stages to run at once (default: 2)
+        state_file (str): where run state and file hashes are kept (default: data/.pipeline_state.json)
+        env (dict): extra environment variables for the stage scripts (default: None)
+    '''
+    def __init__(self, stages=STAGES, jobs=2, state_file=STATE_FILE, env=None) -> None:
+        self.stages = {stage.name:stage for stage in stages}
+        self.deps = dependencies(stages)
+        self.jobs = jobs
+        self.env = {**os.environ, **env} if env else None
+        self.state_file = Path(state_file)
+        state = json.loads(self.state_file.read_text()) if self.state_file.exists() else {}
+        self.file_hashes = state.get('file_hashes', {})
+        self.runs = state.get('stages', {})
+        self.hasher = Hasher(self.file_hashes)
+
+    def save(self):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_name(f'.{self.state_file.name}.tmp')
+        tmp_file.write_text(json.dumps({'stages': self.runs, 'file_hashes': self.file_hashes}, indent=1))
+        tmp_file.replace(self.state_file)
+
+    def stage_key(self, stage):
+        '''Hash of what a stage's result depends on: its command, code and inputs'''
+        key = {
+            'command': [stage.script, *stage.args],
+            'code': {path: self.hasher.artifact_hash(ROOT/path) for path in stage.code},
+            'inputs': {path: self.hasher.artifact_hash(DATA_DIR/path) for path in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, stage):
+        '''If stage ran with its current key and its outputs are unchanged since'''
+        run = self.runs.get(stage.name)
+        if run is None or run['key'] != self.stage_key(stage):
+            return False
+        return all(self.hasher.artifact_hash(DATA_DIR/out) == run['outputs'].get(out) for out in stage.outputs)
+
+    def missing_inputs(self, stage):
+        return [inp for inp in stage.inputs if not (DATA_DIR/inp).exists()]
+
+    def run_stage(self, stage):
+        '''Run a stage's script, returning (succeeded, seconds)'''
+        for out in stage.outputs:
+            (DATA_DIR/out).parent.mkdir(parents=True, exist_ok=True)
+        LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+        t0 = time.perf_counter()
+        with open(LOG_DIR/f'{stage.name}.log', 'w') as log:
+            proc = subprocess.run(stage.command, cwd=SCRIPTS_DIR, stdout=log, stderr=subprocess.STDOUT, env=self.env)
+        return proc.returncode == 0, time.perf_counter()-t0
+
+    def record_run(self, stage, seconds):
+        self.runs[stage.name] = {
+            'key': self.stage_key(stage),
+            'outputs': {out: self.hasher.artifact_hash(DATA_DIR/out) for out in stage.outputs},
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(seconds, 1),
+        }
+        self.save()
+
+    def select(self, targets=None, start=None):
+        '''Names of the stages to consider: targets and their dependencies (default: all), limited to start and its dependents'''
+        names = upstream(self.stages.values(), targets) if targets else set(self.stages)
+        if start is not None:
+            names &= downstream(self.stages.values(), start)
+        return [name for name in self.stages if name in names]
+
+    def status(self, targets=None, start=None):
+        '''{stage name: fresh, stale, or missing inputs}, from the files as they are now'''
+        status = {}
+        for name in self.select(targets, start):
+            stage = self.stages[name]
+            missing = self.missing_inputs(stage)
+            status[name] = f'missing {", ".join(missing)}' if missing else 'fresh' if self.is_fresh(stage) else 'stale'
+        return status
+
+    def run(self, targets=None, start=None, force=False, dry_run=False):
+        '''Run the selected stages that are stale, as soon as the stages they depend on are done.
+        Stages started from (start) are always run, as are all selected stages if force.
+
+        Returns:
+            dict: {stage name: ran, skipped, failed, or blocked (by a failed dependency)}
+        '''
+        selected = self.select(targets, start)
+        forced = set(selected) if force else {start} if start is not None else set()
+        results = {}
+
+        def ready(name):
+            return all(results.get(dep) in ('ran', 'skipped') for dep in self.deps[name] if dep in selected)
+
+        with ThreadPoolExecutor(self.jobs) as executor:
+            running = {}
+            while len(results) < len(selected):
+                for name in selected:
+                    if name in results or name in running.values():
+                        continue
+                    if any(results.get(dep) in ('failed', 'blocked') for dep in self.deps[name]):
+                        results[name] = 'blocked'
+                        print(f'[{name}] blocked by a failed dependency')
+                    elif ready(name):
+                        stage = self.stages[name]
+                        # a dry run can't know what a stage that would run writes, so its dependents are stale too
+                        assume_stale = dry_run and any(results.get(dep) == 'ran' for dep in self.deps[name])
+                        if name not in forced and not assume_stale and self.is_fresh(stage):
+                            results[name] = 'skipped'
+                            print(f'[{name}] up to date')
+                        elif dry_run:
+                            results[name] = 'ran'
+                            print(f'[{name}] would run: {" ".join(stage.command[1:])}')
+                        else:
+                            print(f'[{name}] running {" ".join(stage.command[1:])}, log: {LOG_DIR/name}.log')
+                            running[executor.submit(self.run_stage, stage)] = name
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    ok, seconds = future.result()
+                    if ok:
+                        self.record_run(self.stages[name], seconds)
+                        results[name] = 'ran'
+                        print(f'[{name}] done in {seconds:.1f}s')
+                    else:
+                        results[name] = 'failed'
+                        print(f'[{name}] failed after {seconds:.1f}s, see {LOG_DIR/name}.log')
+
+        return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='crawchet', description='Build the crawchet datasets, running only stages that are out of date')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run stale stages')
+    run_parser.add_argument('targets', nargs='*', help=f'stages to bring up to date, with their dependencies (default: all). One of {", ".join(s.name for s in STAGES)}')
+    run_parser.add_argument('--from', dest='start', type=str, default=None, choices=[s.name for s in STAGES], help='resume: rerun this stage and only what depends on it')
+    run_parser.add_argument('--force', action='store_true', help='run the selected stages even if up to date')
+    run_parser.add_argument('--dry_run', action='store_true', help='print what would run')
+    run_parser.add_argument('-j', '--jobs', type=int, default=2, help='stages to run at once')
+    run_parser.add_argument('--report', action='store_true', help='write a json report of timed spans per stage to data/logs')
+    run_parser.add_argument('--profile', type=str, default=None, help='also capture cprofile, tracemalloc, or cprofile,tracemalloc in the reports')
+
+    status_parser = subparsers.add_parser('status', help='show which stages are up to date')
+    status_parser.add_argument('targets', nargs='*')
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    unknown = set(args.targets) - {s.name for s in STAGES}
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    if args.command == 'status':
+        pipeline = Pipeline()
+        deps = pipeline.deps
+        for name, status in pipeline.status(args.targets).items():
+            print(f'{name:12} {status:10} after: {", ".join(deps[name]) or "-"}')
+        pipeline.save()
+        return 0
+
+    env = {}
+    if args.report or args.profile:
+        env['CRAWCHET_REPORT_DIR'] = LOG_DIR.as_posix()
+    if args.profile:
+        env['CRAWCHET_PROFILE'] = args.profile
+    results = Pipeline(jobs=args.jobs, env=env).run(args.targets, args.start, args.force, args.dry_run)
+    return 1 if any(r in ('failed', 'blocked') for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
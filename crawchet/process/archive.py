@@ -1,18 +1,31 @@
 import time
+import json
+import mmap
+import zlib
+import math
+import bisect
 from pathlib import Path
+from urllib.parse import urlsplit
 
-import pandas as pd
-from tqdm.auto import tqdm
+from crawchet.utils import uri as uutil
+from crawchet.utils.lazy import lazy_import, lazy_callable
 
-from warcio.archiveiterator import ArchiveIterator
-from warcio.warcwriter import WARCWriter
+pd = lazy_import('pandas')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
+effective_n_jobs = lazy_callable('joblib', 'effective_n_jobs')
 
-from waybackpy import WaybackMachineCDXServerAPI
-from waybackpy.exceptions import NoCDXRecordFound
-import requests
+ArchiveIterator = lazy_callable('warcio.archiveiterator', 'ArchiveIterator')
+LimitReader = lazy_callable('warcio.limitreader', 'LimitReader')
+WARCWriter = lazy_callable('warcio.warcwriter', 'WARCWriter')
 
+WaybackMachineCDXServerAPI = lazy_callable('waybackpy', 'WaybackMachineCDXServerAPI')
+waybackpy_exceptions = lazy_import('waybackpy.exceptions')
+requests = lazy_import('requests')
 
-def to_wbmts_format(post_dates: pd.Series):
+
+def to_wbmts_format(post_dates: 'pd.Series'):
     return post_dates.pipe(pd.to_datetime).dt.strftime('%Y%m%d')+'0'*6
 
 
@@ -59,7 +72,7 @@ def cdx_wayback_search(urls, wayback_timestamps):
         try:
             res = WaybackMachineCDXServerAPI(url,user_agent=UA).near(wayback_machine_timestamp=wmts)
             record = res.__dict__
-        except NoCDXRecordFound as e:
+        except waybackpy_exceptions.NoCDXRecordFound as e:
             print('No record found:',url)
             record = {**empty_record, 'original': url}
 
@@ -75,6 +88,151 @@ def cdx_wayback_search(urls, wayback_timestamps):
 
     return archives
 
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+def _is_member_start(buf, pos):
+    '''Check that a gzip magic number at pos really starts a member holding a WARC record'''
+    try:
+        head = zlib.decompressobj(wbits=31).decompress(buf[pos:pos+1024], 16)
+    except zlib.error:
+        return False
+    return head.startswith(b'WARC/')
+
+
+def scan_member_offsets(warc_file):
+    '''Find the byte offset of every gzip member in a .warc.gz without decompressing the records.
+
+    Candidates are found with a raw search for the gzip magic number, then verified by inflating
+    only the first few bytes of each. Returns [0] if the file is not gzipped (cannot be split).
+    '''
+    with open(warc_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if buf[:3] != GZIP_MAGIC:
+            return [0]
+        
+        offsets = []
+        pos = buf.find(GZIP_MAGIC)
+        while pos != -1:
+            if _is_member_start(buf, pos):
+                offsets.append(pos)
+            pos = buf.find(GZIP_MAGIC, pos+1)
+
+    return offsets
+
+
+def read_index_offsets(index_file):
+    '''Read record offsets from a `warcio index` (JSON lines) or CDXJ index file'''
+    offsets = []
+    with open(index_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                offsets.append(int(json.loads(line[line.index('{'):])['offset']))
+    
+    return sorted(set(offsets))
+
+
+def split_byte_ranges(offsets, file_size, n_chunks):
+    '''Group member offsets into at most n_chunks contiguous (start, end) byte ranges of roughly equal size'''
+    offsets = sorted(offsets)
+    bounds = {0}
+    for k in range(1, n_chunks):
+        i = bisect.bisect_left(offsets, file_size*k//n_chunks)
+        if i < len(offsets):
+            bounds.add(offsets[i])
+    
+    bounds = sorted(bounds)+[file_size]
+    return [(s,e) for s,e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+def _response_extracts(record):
+    extracts = {'statusline': record.http_headers.statusline}
+    rh_dict = dict(record.rec_headers.headers)
+    extracts.update({'target_uri':rh_dict['WARC-Target-URI'], 'content_length':rh_dict['Content-Length'], 'payload_digest':rh_dict.get('WARC-Payload-Digest')})
+    extracts.update(content = record.content_stream().read())
+    return extracts
+
+
+def read_records_at(warc_file, offsets):
+    '''Yield the `parse_records` extracts of the records starting at each byte offset of warc_file, in order'''
+    with open(warc_file, 'rb') as stream:
+        for offset in offsets:
+            stream.seek(offset)
+            yield _response_extracts(next(ArchiveIterator(stream)))
+
+
+def _parse_range(warc_file, start, end):
+    '''Decode and parse the response records contained in bytes [start, end) of warc_file'''
+    parsed = []
+    with open(warc_file, 'rb') as stream:
+        stream.seek(start)
+        for record in ArchiveIterator(LimitReader(stream, end-start)):
+            if record.rec_type == 'response':
+                parsed.append(_response_extracts(record))
+    
+    return parsed
+
+
+CATALOG_DTYPES = {
+    'archive': 'category',
+    'offset': 'int64',
+    'length': 'int64',
+    'warc_type': 'category',
+    'target_uri': 'string',
+    'host': 'string',
+    'date': 'datetime64[ns, UTC]',
+    'status': 'Int16',
+    'content_length': 'Int64',
+    'mime': 'category',
+    'payload_digest': 'string',
+    'block_digest': 'string',
+}
+
+
+def _header_extracts(record):
+    '''Catalog fields from the record and http headers only, the payload is never decoded'''
+    rec_head, http_head = record.rec_headers, record.http_headers
+    target_uri = rec_head.get_header('WARC-Target-URI')
+    
+    status, mime = None, None
+    if http_head is not None and record.rec_type in ('response','revisit'):
+        statuscode = http_head.get_statuscode()
+        status = int(statuscode) if statuscode and statuscode.isdigit() else None
+        mime = (http_head.get_header('Content-Type') or '').split(';')[0].strip().lower() or None
+
+    return {
+        'warc_type': record.rec_type,
+        'target_uri': target_uri,
+        'host': urlsplit(uutil.get_original_url(target_uri)).hostname if target_uri else None,
+        'date': rec_head.get_header('WARC-Date'),
+        'status': status,
+        'content_length': rec_head.get_header('Content-Length'),
+        'mime': mime,
+        'payload_digest': rec_head.get_header('WARC-Payload-Digest'),
+        'block_digest': rec_head.get_header('WARC-Block-Digest'),
+    }
+
+
+def _catalog_range(warc_file, start, end):
+    '''Catalog rows for all records in bytes [start, end) of warc_file'''
+    archive_name = Path(warc_file).name
+    rows = []
+    with open(warc_file, 'rb') as stream:
+        stream.seek(start)
+        arc_iter = ArchiveIterator(LimitReader(stream, end-start))
+        for record in arc_iter:
+            extracts = _header_extracts(record)
+            # offsets are relative to the range start
+            rows.append({'archive':archive_name, 'offset':start+arc_iter.get_record_offset(), 'length':arc_iter.get_record_length(), **extracts})
+    
+    return rows
+
+
+def read_catalog(catalog_path, columns=None, filters=None):
+    '''Read a catalog written by `ArchiveManager.build_catalog`, optionally only some columns/row groups'''
+    return pd.read_parquet(catalog_path, columns=columns, filters=filters)
+
+
 class ArchiveManager:
     def __init__(self, warc_file=None) -> None:
         self.warc_file = warc_file
@@ -98,22 +256,63 @@ class ArchiveManager:
         with open(warc_file, 'rb') as stream:
             for record in ArchiveIterator(stream):
                 if record.rec_type == 'response':
-                    extracts = {'statusline': record.http_headers.statusline}
-                    rh_dict = dict(record.rec_headers.headers)
-                    extracts.update({'target_uri':rh_dict['WARC-Target-URI'], 'content_length':rh_dict['Content-Length']})
-                    extracts.update(content = record.content_stream().read())
-                    parsed.append(extracts)
+                    parsed.append(_response_extracts(record))
 
         return parsed
 
-    def to_dataframe(self, warc_file=None):
-        df_records = pd.DataFrame(self.parse_records(warc_file))
+    def member_offsets(self, warc_file=None, index_file=None):
+        '''Gzip member offsets of warc_file, read from index_file if given, otherwise found by a boundary scan'''
+        warc_file = warc_file if warc_file is not None else self.warc_file
+        if index_file is not None:
+            return read_index_offsets(index_file)
+        
+        return scan_member_offsets(warc_file)
+
+    def parallel_parse_records(self, warc_file=None, index_file=None, n_jobs=-1, chunks_per_job=4):
+        '''Same output as `parse_records`, but the archive is split on gzip member boundaries 
+        and each byte range is decompressed and parsed in a separate worker process.
+
+        Args:
+            warc_file (str): path to .warc.gz file (default: self.warc_file)
+            index_file (str): optional `warcio index`/CDXJ file to read member offsets from instead of scanning
+            n_jobs (int): number of worker processes, as in joblib (default: -1)
+            chunks_per_job (int): number of byte ranges per worker, more ranges balance load better (default: 4)
+        '''
+        warc_file = warc_file if warc_file is not None else self.warc_file
+        
+        offsets = self.member_offsets(warc_file, index_file)
+        file_size = Path(warc_file).stat().st_size
+        ranges = split_byte_ranges(offsets, file_size, effective_n_jobs(n_jobs)*chunks_per_job)
+        
+        parsed_ranges = Parallel(n_jobs=n_jobs)(delayed(_parse_range)(warc_file, s, e) for s,e in tqdm(ranges))
+        # joblib returns results in submission order, so records stay in archive order
+        return [extracts for parsed in parsed_ranges for extracts in parsed]
+
+    def to_dataframe(self, warc_file=None, n_jobs=None, index_file=None):
+        if n_jobs is None:
+            records = self.parse_records(warc_file)
+        else:
+            records = self.parallel_parse_records(warc_file, index_file=index_file, n_jobs=n_jobs)
+        
+        df_records = pd.DataFrame(records)
         df_records['content_length'] = df_records['content_length'].astype(int)
         df_records['status'] = df_records['statusline'].str.split().str[0].astype(int)
         df_records = df_records.drop(columns='statusline')
         
         return df_records
 
+    def index_records(self, warc_file=None, n_jobs=-1):
+        '''Response records of warc_file from headers alone, with the (warc_file, offset) needed to read each back.
+        Same columns as `to_dataframe`, with warc_file and offset in place of content.'''
+        warc_file = Path(warc_file if warc_file is not None else self.warc_file).resolve()
+        
+        df_catalog = self.build_catalog(warc_file.parent, warc_file=warc_file.name, n_jobs=n_jobs)
+        df_records = df_catalog[(df_catalog.warc_type == 'response') & df_catalog.status.notna()].reset_index(drop=True)
+        df_records = df_records[['target_uri','content_length','status','payload_digest','offset']].astype({'target_uri':object, 'content_length':int, 'status':int, 'payload_digest':object})
+        df_records.insert(4, 'warc_file', warc_file.as_posix())
+        
+        return df_records
+
     def extract_metadata(self, archive_dir, warc_file=None):
         arcpath = Path(archive_dir)
         arcfiles = [arcpath/warc_file] if warc_file else arcpath.glob('*.warc.gz')
@@ -131,8 +330,64 @@ class ArchiveManager:
                     )
         return record_extracts
 
+    def build_catalog(self, archive_dir, catalog_outpath=None, warc_file=None, n_jobs=-1, chunks_per_job=4):
+        '''Build a typed, columnar catalog of every record in every *.warc.gz of archive_dir from headers alone.
+
+        Archives, and byte ranges within large archives, are processed in parallel. 
+        Columns are given by `CATALOG_DTYPES`; (archive, offset) locates each record.
+
+        Args:
+            archive_dir (str): directory containing .warc.gz files
+            catalog_outpath (str): path to write the catalog parquet file, not written if None (default: None)
+            warc_file (str): only catalog this file in archive_dir (default: None)
+            n_jobs (int): number of worker processes, as in joblib (default: -1)
+            chunks_per_job (int): target number of byte ranges per worker (default: 4)
+
+        Example:
+            df_cat = read_catalog('catalog.parquet', columns=['host','status','mime'])
+            df_cat[(df_cat.status==200) & (df_cat.mime=='text/html')].groupby('host').size()
+        '''
+        arcpath = Path(archive_dir)
+        arcfiles = [arcpath/warc_file] if warc_file else sorted(arcpath.glob('*.warc.gz'))
+        
+        # only scan for member offsets when there are too few archives to keep every worker busy
+        n_chunks = math.ceil(effective_n_jobs(n_jobs)*chunks_per_job/max(len(arcfiles),1))
+        tasks = []
+        for arc in arcfiles:
+            file_size = arc.stat().st_size
+            offsets = scan_member_offsets(arc) if n_chunks > 1 else [0]
+            tasks += [(arc, s, e) for s,e in split_byte_ranges(offsets, file_size, n_chunks)]
+        
+        print(f'Cataloging {len(arcfiles)} archives in {len(tasks)} chunks')
+        cataloged = Parallel(n_jobs=n_jobs)(delayed(_catalog_range)(arc, s, e) for arc,s,e in tqdm(tasks))
+        
+        df_catalog = pd.DataFrame([row for rows in cataloged for row in rows], columns=[*CATALOG_DTYPES])
+        df_catalog['date'] = pd.to_datetime(df_catalog['date'], utc=True)
+        df_catalog = df_catalog.astype(CATALOG_DTYPES)
+        
+        if catalog_outpath is not None:
+            df_catalog.to_parquet(catalog_outpath, index=False)
+            print('Catalog written to:', catalog_outpath)
+        
+        return df_catalog
+
+
+    def merge_archives(self, archive_files, merged_outpath, mode='rewrite', index_outpath=None):
+        '''Merge archives into a single .warc.gz.
 
-    def merge_archives(self, archive_files, merged_outpath):
+        Args:
+            archive_files (list): paths of .warc.gz files to merge, earlier files take precedence
+            merged_outpath (str): path to write merged archive to
+            mode (str, {rewrite, copy}): How records are merged (default: 'rewrite')
+                rewrite: re-encode the first response record for each exact target uri, drop all others
+                copy: copy gzip members byte-for-byte, see `copy_merge_archives`
+            index_outpath (str): (copy mode only) path to write the merged index (default: merged_outpath+'.idx')
+        '''
+        if mode == 'copy':
+            return self.copy_merge_archives(archive_files, merged_outpath, index_outpath)
+        elif mode != 'rewrite':
+            raise ValueError(f'Invalid mode: {mode}')
+        
         #arcpath = 
         arcfiles = [Path(p) for p in archive_files]#[*arcpath.glob('*.warc.gz')]
         
@@ -152,3 +407,66 @@ class ArchiveManager:
         
         print('Merged {} archives into {} records:  {})'.format(len(arcfiles), len(observed), merged_outpath))
 
+    def copy_merge_archives(self, archive_files, merged_outpath, index_outpath=None):
+        '''Merge archives by copying kept gzip members byte-for-byte, without recompression.
+
+        Records are deduplicated by canonicalized target uri (`uri.canonicalize_url`) and record type. 
+        A response whose WARC-Payload-Digest was already written under another url is replaced with a 
+        `revisit` record pointing at the first copy. Request, metadata, and warcinfo records are kept.
+        A JSON lines index (offset, length, warc-type, warc-target-uri, warc-payload-digest) of the 
+        merged archive is written in the same pass, readable by `member_offsets(index_file=...)`.
+        '''
+        arcfiles = [Path(p) for p in archive_files]
+        index_outpath = index_outpath if index_outpath is not None else f'{merged_outpath}.idx'
+        
+        observed = set() # (warc_type, canonical url)
+        payloads = {} # payload digest -> (target uri, warc date) of first response written
+        counts = {'copied':0, 'revisit':0, 'dropped':0}
+        
+        with open(merged_outpath, 'wb') as output, open(index_outpath, 'w') as index:
+            writer = WARCWriter(output, gzip=True)
+            
+            def _index_entry(offset, warc_type, target_uri, digest):
+                entry = {'offset':offset, 'length':output.tell()-offset, 'warc-type':warc_type, 'warc-target-uri':target_uri, 'warc-payload-digest':digest}
+                index.write(json.dumps(entry)+'\n')
+            
+            for arc in arcfiles:
+                print('Merging', arc.name)
+                with arc.open('rb') as stream, arc.open('rb') as raw:
+                    if raw.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+                        raise ValueError(f'{arc.name} is not gzipped, members cannot be copied. Use mode="rewrite"')
+                    
+                    arc_iter = ArchiveIterator(stream)
+                    for record in arc_iter:
+                        rec_head = record.rec_headers
+                        warc_type, target_uri = rec_head.get_header('WARC-Type'), rec_head.get_header('WARC-Target-URI')
+                        digest = rec_head.get_header('WARC-Payload-Digest')
+                        key = (warc_type, uutil.canonicalize_url(target_uri)) if target_uri else None
+
+                        arc_iter.read_to_end(record)
+                        offset = output.tell()
+                        
+                        if key is not None and key in observed:
+                            counts['dropped'] += 1
+                            continue
+                        
+                        if warc_type == 'response' and digest in payloads:
+                            refers_to_uri, refers_to_date = payloads[digest]
+                            revisit = writer.create_revisit_record(target_uri, digest, refers_to_uri, refers_to_date, http_headers=record.http_headers)
+                            writer.write_record(revisit)
+                            _index_entry(offset, 'revisit', target_uri, digest)
+                            counts['revisit'] += 1
+                        else:
+                            raw.seek(arc_iter.get_record_offset())
+                            output.write(raw.read(arc_iter.get_record_length()))
+                            _index_entry(offset, warc_type, target_uri, digest)
+                            counts['copied'] += 1
+                            
+                            if warc_type == 'response' and digest is not None:
+                                payloads[digest] = (target_uri, rec_head.get_header('WARC-Date'))
+                        
+                        if key is not None:
+                            observed.add(key)
+        
+        print('Merged {} archives ({}):  {}'.format(len(arcfiles), counts, merged_outpath))
+        return counts
@@ -0,0 +1,207 @@
+import math
+import itertools
+import pickle
+import hashlib
+from pathlib import Path
+from urllib import parse
+from collections import Counter, defaultdict
+
+import lxml.html
+
+from crawchet.process import archive
+from crawchet.utils import uri as uutil
+from crawchet.utils.lazy import lazy_callable
+
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
+
+# elements that can be removed as template blocks
+BLOCK_TAGS = frozenset([
+    'div', 'section', 'aside', 'nav', 'header', 'footer', 'ul', 'ol', 'dl', 'table', 'form', 'iframe', 'center'])
+# ignored when hashing, they are removed or rewritten by preprocessing
+HASH_SKIP_TAGS = frozenset(['script', 'style', 'noscript', 'link', 'meta'])
+
+
+def host_key(url):
+    '''Host a page's template is learned under, e.g. https://web.archive.org/web/2022/https://www.example.com/a -> example.com'''
+    return parse.urlsplit(uutil.canonicalize_url(url)).netloc
+
+
+def _norm_text(text):
+    return ' '.join(text.split()) if text else ''
+
+
+def block_hashes(ldoc):
+    '''Hash every text-bearing block (BLOCK_TAGS) of a tree by its tags and whitespace-normalized text.
+    Attributes, comments, and HASH_SKIP_TAGS are ignored, so the hashes survive link rewriting, css inlining and minifying.
+
+    Returns:
+        dict: {element: 8 byte hash} for blocks that contain text
+    '''
+    subtree = {}
+    blocks = {}
+    # reversed pre-order visits children before their parents
+    for el in reversed(list(ldoc.iter())):
+        if not isinstance(el.tag, str) or el.tag in HASH_SKIP_TAGS:
+            continue
+        text = _norm_text(el.text)
+        parts = [el.tag, text]
+        has_text = bool(text)
+        for child in el:
+            if child in subtree:
+                child_hash, child_has_text = subtree[child]
+                parts.append(child_hash.hex())
+                has_text |= child_has_text
+            # empty tails are left out, so that a skipped (e.g. <style>, removed by preprocessing) child leaves no trace
+            tail = _norm_text(child.tail)
+            if tail:
+                parts.append(tail)
+                has_text = True
+
+        digest = hashlib.blake2b('\x1f'.join(parts).encode(), digest_size=8).digest()
+        subtree[el] = (digest, has_text)
+        if has_text and el.tag in BLOCK_TAGS:
+            blocks[el] = digest
+
+    return blocks
+
+
+def _page_block_hashes(html_content):
+    if not html_content:
+        return set()
+    try:
+        ldoc = lxml.html.fromstring(html_content)
+    except Exception:
+        return set()
+    return set(block_hashes(ldoc).values())
+
+
+def _hash_pages(html_contents):
+    return [_page_block_hashes(html) for html in html_contents]
+
+
+def _hash_records(warc_file, offsets):
+    return [_page_block_hashes(rec['content']) for rec in archive.read_records_at(warc_file, offsets)]
+
+
+class HostTemplates:
+    '''Per-host page templates, learned as the DOM blocks that repeat across many pages of the same host.
+
+    Blogger/WordPress hosts share one template per host, so their sidebars, navs and footers hash identically on every page.
+    Stripping them before text extraction leaves less markup for the parsers and cleaner text.
+
+    Args:
+        min_pages (int): hosts with fewer sampled pages get no template (default: 5)
+        min_frac (float): fraction of a host's sampled pages a block must appear on to be part of its template (default: 0.5)
+        max_pages (int): pages sampled per host when learning (default: 200)
+    '''
+    def __init__(self, min_pages=5, min_frac=0.5, max_pages=200) -> None:
+        self.min_pages = min_pages
+        self.min_frac = min_frac
+        self.max_pages = max_pages
+        self.templates = {}
+        # hosts with enough pages when learned, with or without a template
+        self.hosts = set()
+
+    def __repr__(self) -> str:
+        # content digest so that parser fingerprints change with the learned templates
+        digest = hashlib.sha1()
+        for host in sorted(self.templates):
+            digest.update(host.encode())
+            digest.update(b''.join(sorted(self.templates[host])))
+        return f'HostTemplates(min_pages={self.min_pages}, min_frac={self.min_frac}, hosts={len(self.templates)}, digest={digest.hexdigest()[:12]})'
+
+    def _sample(self, urls, hosts=None):
+        '''Indices of at most max_pages pages per host, for hosts (default: all) with at least min_pages pages'''
+        by_host = defaultdict(list)
+        for i, url in enumerate(urls):
+            host = host_key(url)
+            if hosts is not None and host not in hosts:
+                continue
+            pages = by_host[host]
+            if len(pages) < self.max_pages:
+                pages.append(i)
+        return {host:idx for host,idx in by_host.items() if len(idx) >= self.min_pages}
+
+    def _learn(self, by_host, hash_sets, update=False):
+        if not update:
+            self.templates, self.hosts = {}, set()
+        n_learned = 0
+        for host, idx in by_host.items():
+            counts = Counter(h for i in idx for h in hash_sets[i])
+            min_count = max(self.min_pages, math.ceil(self.min_frac*len(idx)))
+            template = frozenset(h for h,c in counts.items() if c >= min_count)
+            if template:
+                self.templates[host] = template
+                n_learned += 1
+            self.hosts.add(host)
+
+        print(f'Learned templates for {n_learned} of {len(by_host)} hosts')
+        return self
+
+    def unfitted_hosts(self, urls):
+        '''Hosts with at least min_pages pages in urls that no template was learned for yet, 
+        e.g. new hosts or hosts with too few pages before'''
+        counts = Counter(host_key(url) for url in urls)
+        return {host for host,c in counts.items() if c >= self.min_pages} - self.hosts
+
+    def fit(self, html_contents, urls, batch_size=64, n_jobs=-5, hosts=None):
+        '''Learn templates from raw page content. 
+        If hosts is given, learn templates for those hosts only, keeping the templates of other hosts.'''
+        by_host = self._sample(urls, hosts)
+        idx = sorted(i for host_idx in by_host.values() for i in host_idx)
+        html_contents = list(html_contents)
+        batches = [[html_contents[i] for i in idx[b:b+batch_size]] for b in range(0, len(idx), batch_size)]
+
+        hashed = Parallel(n_jobs=n_jobs)(delayed(_hash_pages)(batch) for batch in tqdm(batches))
+        hash_sets = dict(zip(idx, (h for batch in hashed for h in batch)))
+
+        return self._learn(by_host, hash_sets, update=hosts is not None)
+
+    def fit_records(self, record_refs, urls, batch_size=64, n_jobs=-5, hosts=None):
+        '''Learn templates from (warc_file, offset) record references, read by the workers (see `parsehtml.iter_parse_warc`).
+        If hosts is given, learn templates for those hosts only, keeping the templates of other hosts.'''
+        by_host = self._sample(urls, hosts)
+        idx = sorted(i for host_idx in by_host.values() for i in host_idx)
+        record_refs = list(record_refs)
+        sampled = (record_refs[i] for i in idx)
+        # batches of consecutive records from the same file, so results stay in sampled order
+        batches = [(warc_file, offsets[b:b+batch_size]) 
+                   for warc_file,refs in itertools.groupby(sampled, key=lambda ref: ref[0]) 
+                   for offsets in [[off for _,off in refs]] for b in range(0, len(offsets), batch_size)]
+
+        hashed = Parallel(n_jobs=n_jobs)(delayed(_hash_records)(warc_file, offsets) for warc_file,offsets in tqdm(batches))
+        hash_sets = dict(zip(idx, (h for batch in hashed for h in batch)))
+
+        return self._learn(by_host, hash_sets, update=hosts is not None)
+
+    def strip(self, ldoc, url):
+        '''Remove the host's template blocks from ldoc in-place, keeping their tail text.
+
+        Returns:
+            int: number of blocks removed
+        '''
+        template = self.templates.get(host_key(url))
+        if not template:
+            return 0
+
+        removed = [el for el,h in block_hashes(ldoc).items() if h in template]
+        # drop only the outermost template blocks, their descendants go with them
+        removed_set = set(removed)
+        outermost = [el for el in removed if not any(anc in removed_set for anc in el.iterancestors())]
+        for el in outermost:
+            el.drop_tree()
+
+        return len(outermost)
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
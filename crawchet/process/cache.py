@@ -0,0 +1,79 @@
+import json
+import pickle
+import sqlite3
+import hashlib
+from pathlib import Path
+
+from crawchet.process import parsehtml, boilerplate
+from crawchet.utils import html as hutil, uri as uutil
+from crawchet.utils.lazy import lazy_import
+
+metadata = lazy_import('importlib.metadata')
+
+# distributions whose behavior changes parse_page output
+PARSE_DISTRIBUTIONS = ['beautifulsoup4', 'lxml', 'html2text', 'css-inline', 'minify-html']
+# crawchet modules whose code changes parse_page output: parsing, preprocessing, link filters and template stripping
+PARSE_MODULES = [parsehtml, hutil, uutil, boilerplate]
+
+
+def _dist_version(dist):
+    try:
+        return metadata.version(dist)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def parser_fingerprint(parser):
+    '''Hash of everything besides the page itself that determines parse_page output:
+    parser class and settings, parsing library versions, and the source of crawchet's parsing modules (PARSE_MODULES).'''
+    config = {k:repr(v) for k,v in sorted(vars(parser).items())}
+    versions = {dist:_dist_version(dist) for dist in PARSE_DISTRIBUTIONS}
+    sources = [Path(mod.__file__).read_bytes() for mod in PARSE_MODULES]
+
+    fp = hashlib.sha1(json.dumps([type(parser).__name__, config, versions]).encode())
+    for src in sources:
+        fp.update(src)
+
+    return fp.hexdigest()
+
+
+class ParseCache:
+    '''On-disk (sqlite) cache of `parse_page` outputs keyed by (payload digest, url, parser fingerprint).
+
+    The url is part of the key since links are made absolute against it, e.g. the same payload
+    served from web.archive.org and the original site parse differently.
+
+    Args:
+        cache_path (str): sqlite file to store results in, created if it does not exist
+    '''
+    def __init__(self, cache_path) -> None:
+        self.cache_path = cache_path
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, result BLOB)')
+        self.conn.commit()
+
+    def make_keys(self, parser, payload_digests, urls):
+        '''Cache key for each record, None where the payload digest is missing (never cached)'''
+        fp = parser_fingerprint(parser)
+        return [hashlib.sha1(f'{fp}|{digest}|{url}'.encode()).hexdigest() if digest else None
+                for digest,url in zip(payload_digests, urls)]
+
+    def get_many(self, keys, chunk_size=500):
+        '''Return {key: parse_page output} for keys found in the cache'''
+        keys = [k for k in dict.fromkeys(keys) if k is not None]
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i+chunk_size]
+            rows = self.conn.execute(f'SELECT key, result FROM parsed WHERE key IN ({",".join("?"*len(chunk))})', chunk)
+            found.update((k, pickle.loads(r)) for k,r in rows)
+
+        return found
+
+    def put_many(self, keys, results):
+        rows = [(k, pickle.dumps(r, protocol=pickle.HIGHEST_PROTOCOL)) for k,r in zip(keys, results) if k is not None]
+        self.conn.executemany('INSERT OR REPLACE INTO parsed VALUES (?, ?)', rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,169 @@
+import json
+import shutil
+import functools
+from pathlib import Path
+
+from crawchet.utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+ds = lazy_import('pyarrow.dataset')
+
+# columns stored apart from the rest, only read when asked for
+LARGE_COLUMNS = ['content', 'html', 'body_extracts', 'images', 'links', 'link_texts']
+
+
+@functools.lru_cache(maxsize=None)
+def ptid_partitioning():
+    '''Hive partitioning by ptid_range, kept as zero padded strings rather than letting them be inferred as ints'''
+    return ds.partitioning(pa.schema([('ptid_range', pa.string())]), flavor='hive')
+
+
+def _is_nested(value):
+    '''True for values parquet can't store as list<string>, i.e. dicts or lists holding anything but strings'''
+    if isinstance(value, dict):
+        return True
+    if isinstance(value, (list, tuple)):
+        return not all(isinstance(v, str) for v in value)
+    return False
+
+
+def _ptid_ranges(ptids, ptid_bucket):
+    width = len(ptids.iloc[0]) if len(ptids) else 5
+    return (ptids.astype(int)//ptid_bucket*ptid_bucket).astype(str).str.zfill(width)
+
+
+def _to_pandas(table):
+    '''Table to dataframe with list columns as python lists (pyarrow gives numpy arrays), as they were written'''
+    df = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type):
+            df[field.name] = df[field.name].map(lambda v: list(v) if v is not None else v)
+    return df
+
+
+def write_master_dataset(df_master, dataset_dir='../data/interim/df_master', ptid_bucket=1000, large_columns=LARGE_COLUMNS):
+    '''Write the master dataframe as a Parquet dataset partitioned by ptid range, replacing any previous one.
+
+    dataset_dir/main holds the small columns and dataset_dir/large the large_columns present, both partitioned
+    into ptid_range=NNNNN directories and joined on `row_id`. Columns holding dicts or non-string lists are
+    stored as json strings. Read it back with `read_master_dataset`.
+    '''
+    dataset_dir = Path(dataset_dir)
+    df_master = df_master.reset_index(drop=True)
+    df_master.insert(0, 'row_id', df_master.index)
+    df_master['ptid_range'] = _ptid_ranges(df_master['ptid'], ptid_bucket)
+
+    json_columns = [c for c in df_master.columns[df_master.dtypes==object] if df_master[c].map(_is_nested).any()]
+    for col in json_columns:
+        df_master[col] = df_master[col].map(json.dumps)
+
+    large_columns = [c for c in large_columns if c in df_master]
+    main_columns = [c for c in df_master.columns if c not in large_columns]
+
+    for part, cols in [('main', main_columns), ('large', ['row_id', *large_columns, 'ptid_range'])]:
+        if (dataset_dir/part).exists():
+            shutil.rmtree(dataset_dir/part)
+        table = pa.Table.from_pandas(df_master[cols], preserve_index=False)
+        pq.write_to_dataset(table, dataset_dir/part, partitioning=ptid_partitioning())
+
+    schema = {'ptid_bucket': ptid_bucket, 'json_columns': json_columns, 'large_columns': large_columns, 'n_rows': len(df_master),
+              'columns': [c for c in df_master.columns if c not in ('row_id', 'ptid_range')]}
+    (dataset_dir/'_schema.json').write_text(json.dumps(schema, indent=1))
+
+    return dataset_dir
+
+
+def read_master_dataset(dataset_dir='../data/interim/df_master', columns=None, ptids=None, memory_map=True):
+    '''Read columns of a dataset written by `write_master_dataset`.
+
+    Only the parts (main/large) holding the requested columns and, if ptids are given, the matching ptid_range
+    partitions are read. Files are memory mapped unless memory_map=False.
+
+    Args:
+        columns (list): columns to read (default: None, all columns)
+        ptids (list): only rows of these ptids (default: None, all rows)
+
+    Example:
+        df = read_master_dataset('../data/interim/df_master', columns=['ptid','url','content'], ptids=['00012','01234'])
+    '''
+    dataset_dir = Path(dataset_dir)
+    schema = json.loads((dataset_dir/'_schema.json').read_text())
+
+    filters = None
+    if ptids is not None:
+        ptids = pd.Series(list(ptids), dtype=str)
+        filters = [('ptid_range', 'in', set(_ptid_ranges(ptids, schema['ptid_bucket'])))]
+
+    return _read_parts(dataset_dir, schema, columns, ptids, filters, memory_map)
+
+
+def _read_parts(dataset_dir, schema, columns=None, ptids=None, filters=None, memory_map=True):
+    large_columns = schema['large_columns']
+    main_names = ds.dataset(dataset_dir/'main', format='parquet', partitioning=ptid_partitioning()).schema.names
+    if columns is None:
+        main_columns, read_large = None, large_columns
+    else:
+        # columns missing from the dataset are ignored, as when selecting from a pickled frame
+        main_columns = ['row_id', *[c for c in columns if c in main_names and c != 'row_id']]
+        if ptids is not None and 'ptid' not in main_columns:
+            main_columns.append('ptid')
+        read_large = [c for c in columns if c in large_columns]
+
+    df = pq.read_table(dataset_dir/'main', columns=main_columns, filters=filters, partitioning=ptid_partitioning(), memory_map=memory_map)
+    df = _to_pandas(df)
+    if ptids is not None:
+        df = df[df['ptid'].isin(set(ptids))]
+
+    if read_large:
+        df_large = _to_pandas(pq.read_table(dataset_dir/'large', columns=['row_id', *read_large], filters=filters, partitioning=ptid_partitioning(), memory_map=memory_map))
+        df = df.merge(df_large, on='row_id', how='left')
+
+    df = df.sort_values('row_id').set_index('row_id')
+    df.index.name = None
+    if 'ptid_range' in df:
+        df = df.drop(columns='ptid_range')
+
+    for col in df.columns.intersection(schema['json_columns']):
+        df[col] = df[col].map(json.loads)
+
+    # columns in the order asked for, or as written
+    columns = columns if columns is not None else schema.get('columns', df.columns)
+    df = df[[c for c in columns if c in df]]
+
+    return df
+
+
+def iter_master_dataset(dataset_dir='../data/interim/df_master', columns=None, memory_map=True):
+    '''Read a dataset written by `write_master_dataset` one ptid_range partition at a time, as `read_master_dataset` would.
+
+    Example:
+        for df_part in iter_master_dataset('../data/interim/df_master', columns=['ptid','text']):
+            ...
+    '''
+    dataset_dir = Path(dataset_dir)
+    schema = json.loads((dataset_dir/'_schema.json').read_text())
+    ptid_ranges = sorted(p.name.split('=',1)[1] for p in (dataset_dir/'main').glob('ptid_range=*'))
+    for ptid_range in ptid_ranges:
+        yield _read_parts(dataset_dir, schema, columns, filters=[('ptid_range', '=', ptid_range)], memory_map=memory_map)
+
+
+def iter_master(df_master_path, columns=None, batch_size=10000):
+    '''Batches of a master dataframe saved as a pickle (.pkl) or a dataset directory, by partition for datasets'''
+    if Path(df_master_path).suffix == '.pkl':
+        df_master = read_master(df_master_path, columns)
+        for i in range(0, len(df_master), batch_size):
+            yield df_master.iloc[i:i+batch_size]
+    else:
+        yield from iter_master_dataset(df_master_path, columns=columns)
+
+
+def read_master(df_master_path, columns=None):
+    '''Read a master dataframe saved either as a pickle (.pkl) or a dataset directory from `write_master_dataset`'''
+    if Path(df_master_path).suffix == '.pkl':
+        df_master = pd.read_pickle(df_master_path)
+        return df_master if columns is None else df_master[[c for c in columns if c in df_master]]
+
+    return read_master_dataset(df_master_path, columns=columns)
+
@@ -0,0 +1,157 @@
+import re
+
+from crawchet.utils.lazy import lazy_import, lazy_callable
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+sp = lazy_import('scipy.sparse')
+connected_components = lazy_callable('scipy.sparse.csgraph', 'connected_components')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
+
+RE_WORD = re.compile(r'\w+')
+# odd multiplier for rolling word hashes into shingle hashes. Python ints, which numpy casts to the array's
+# unsigned type, so that importing this module does not import numpy
+SHINGLE_MULT = 0x9E3779B97F4A7C15
+MAX_HASH = 0xFFFFFFFF
+
+
+def shingle_hashes(texts, k=5):
+    '''64 bit hashes of the k-word shingles of each text, lowercased. Texts with fewer than k words are a single shingle.
+
+    Returns:
+        tuple: (flat shingle hashes, start offset of each text's shingles, with a final end offset)
+    '''
+    words = [RE_WORD.findall(text.lower()) if isinstance(text, str) else [] for text in texts]
+    n_words = np.array([len(w) for w in words])
+    word_starts = np.concatenate([[0], np.cumsum(n_words)])
+    if word_starts[-1] == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(len(texts)+1, dtype=np.int64)
+
+    word_hashes = pd.util.hash_array(np.array([w for ws in words for w in ws], dtype=object))
+    n_shingles = np.where(n_words > 0, np.maximum(n_words-k+1, 1), 0)
+
+    offsets = np.concatenate([[0], np.cumsum(n_shingles)])
+    # a shingle starts at each word followed by k-1 words of the same text
+    starts = np.repeat(word_starts[:-1], n_shingles) + np.arange(offsets[-1]) - np.repeat(offsets[:-1], n_shingles)
+    ends = np.minimum(starts+k, np.repeat(word_starts[1:], n_shingles))
+
+    padded = np.concatenate([word_hashes, np.zeros(k, dtype=np.uint64)])
+    shingles = np.zeros(len(starts), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(k):
+            shingles = shingles*SHINGLE_MULT + np.where(starts+i < ends, padded[starts+i], np.uint64(0))
+
+    return shingles, offsets
+
+
+def _perm_params(num_perm, seed):
+    rng = np.random.default_rng(seed)
+    # multiply-shift hashing: odd 64 bit multipliers, top 32 bits of (a*x + b)
+    a = rng.integers(0, 2**64, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**64, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def _minhash_batch(texts, k, a, b, perm_chunk=32):
+    '''MinHash signatures (len(texts) x num_perm, uint32) of a batch. Texts without words get MAX_HASH everywhere'''
+    shingles, offsets = shingle_hashes(texts, k)
+    signatures = np.full((len(texts), len(a)), MAX_HASH, dtype=np.uint32)
+    has_shingles = offsets[1:] > offsets[:-1]
+    if not has_shingles.any():
+        return signatures
+
+    seg_starts = offsets[:-1][has_shingles]
+    with np.errstate(over='ignore'):
+        for p in range(0, len(a), perm_chunk):
+            hashed = a[p:p+perm_chunk, None]*shingles[None, :]
+            hashed += b[p:p+perm_chunk, None]
+            # the shift is monotone, so it is applied to the minima rather than every hash
+            signatures[has_shingles, p:p+perm_chunk] = (np.minimum.reduceat(hashed, seg_starts, axis=1) >> np.uint64(32)).T
+
+    return signatures
+
+
+def minhash_signatures(texts, num_perm=128, k=5, batch_size=1000, n_jobs=1, seed=0):
+    '''MinHash signatures of the k-word shingle sets of texts, computed in batches.
+
+    Returns:
+        np.ndarray: (n_texts x num_perm) uint32, rows of MAX_HASH for texts without words
+    '''
+    a, b = _perm_params(num_perm, seed)
+    texts = list(texts)
+    batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+    if n_jobs == 1 or len(batches) <= 1:
+        parts = [_minhash_batch(batch, k, a, b) for batch in tqdm(batches)]
+    else:
+        parts = Parallel(n_jobs=n_jobs)(delayed(_minhash_batch)(batch, k, a, b) for batch in tqdm(batches))
+
+    if not parts:
+        return np.zeros((0, num_perm), dtype=np.uint32)
+    return np.concatenate(parts)
+
+
+def lsh_params(threshold, num_perm):
+    '''(bands, rows) with bands*rows <= num_perm whose S-curve midpoint (1/bands)^(1/rows) is closest to threshold'''
+    return min(((num_perm//r, r) for r in range(1, num_perm+1)), key=lambda br: abs((1/br[0])**(1/br[1]) - threshold))
+
+
+def _band_keys(band):
+    '''Hash each row of a (n x rows) uint32 band to one uint64'''
+    keys = np.zeros(len(band), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for col in band.T:
+            keys = (keys ^ col.astype(np.uint64))*SHINGLE_MULT
+    return keys
+
+
+def lsh_clusters(signatures, threshold=0.8, chunk_size=100_000):
+    '''Cluster ids of near duplicates, documents whose estimated Jaccard similarity is at least threshold.
+
+    Signatures are split into bands, and documents sharing a band bucket become candidates. Rather than comparing
+    all pairs in a bucket, each document is compared with the first document of the bucket, so the work grows with
+    the number of documents, not the bucket sizes. Clusters are the connected components of the confirmed pairs.
+    Documents without words (all MAX_HASH signatures) are each their own cluster.
+
+    Returns:
+        np.ndarray: cluster id of each document, the smallest index of its cluster
+    '''
+    n_docs, num_perm = signatures.shape
+    bands, rows = lsh_params(threshold, num_perm)
+    valid = np.flatnonzero((signatures != MAX_HASH).any(axis=1))
+
+    edges = []
+    for band in range(bands):
+        keys = _band_keys(signatures[valid, band*rows:(band+1)*rows])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        # representative (first document) of each document's bucket
+        reps = order[np.maximum.accumulate(np.where(is_first, np.arange(len(order)), 0))]
+        docs, reps = valid[order[~is_first]], valid[reps[~is_first]]
+
+        for i in range(0, len(docs), chunk_size):
+            d, r = docs[i:i+chunk_size], reps[i:i+chunk_size]
+            similar = (signatures[d] == signatures[r]).mean(axis=1) >= threshold
+            edges.append(np.stack([d[similar], r[similar]]))
+
+    edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=np.int64)
+    graph = sp.coo_matrix((np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])), shape=(n_docs, n_docs))
+    _, labels = connected_components(graph, directed=False)
+
+    # name clusters by their first document, stable across runs
+    first_of_label = np.full(labels.max()+1 if n_docs else 0, n_docs)
+    np.minimum.at(first_of_label, labels, np.arange(n_docs))
+    return first_of_label[labels]
+
+
+def near_duplicate_clusters(texts, threshold=0.8, num_perm=128, k=5, batch_size=1000, n_jobs=1, seed=0):
+    '''Cluster id of each text, texts with estimated k-word shingle Jaccard similarity >= threshold share one.
+
+    Example:
+        df['dup_cluster'] = near_duplicate_clusters(df['text'], threshold=0.8)
+    '''
+    signatures = minhash_signatures(texts, num_perm=num_perm, k=k, batch_size=batch_size, n_jobs=n_jobs, seed=seed)
+    return lsh_clusters(signatures, threshold)
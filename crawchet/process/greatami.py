@@ -1,11 +1,21 @@
 import re
+import gc
 import json
+import itertools
 from typing import List, Dict, Union
 from pathlib import Path
 from datetime import datetime
-import pandas as pd
+from contextlib import contextmanager
 
 from crawchet.utils import uri as uutil
+from crawchet.utils import io as ioutil
+from crawchet.utils.lazy import lazy_import
+from crawchet.process.manifest import post_digest
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pc = lazy_import('pyarrow.compute')
 
 def fix_bodylinks(body_extract):
     '''Modifies in-place'''
@@ -16,35 +26,161 @@ def fix_bodylinks(body_extract):
         
     return body_extract
 
-def extract_languages(df_gaf):
-    # https://en.wikipedia.org/wiki/Languages_used_on_the_Internet
-    langs = ['English','Russian','Spanish','French','German','Japanese','Turkish','Persian',
+def _flatten(list_col):
+    '''Elements of a list column as one Series, with the row position of each element and each row's length'''
+    lengths = np.fromiter(map(len, list_col), dtype=int, count=len(list_col))
+    flat = pd.Series(list(itertools.chain.from_iterable(list_col)), dtype=object)
+    return flat, np.repeat(np.arange(len(list_col)), lengths), lengths
+
+def _regroup(values, lengths):
+    '''Flat values back into consecutive lists of the given lengths'''
+    values = list(values)
+    ends = np.cumsum(lengths).tolist()
+    return [values[end-n:end] for end,n in zip(ends, lengths.tolist())]
+
+def fix_all_bodylinks(body_extracts):
+    '''fix_bodylinks for a column of body extracts, with the urls of all posts fixed at once. Modifies in-place'''
+    extracts, _, _ = _flatten(body_extracts)
+    for extr, img_link in zip(extracts, uutil.fix_imgurls([extr.get('img_link') for extr in extracts])):
+        extr['img_link'] = img_link
+    for extr, text_link in zip(extracts, uutil.fix_urlschemes([extr.get('text_link') for extr in extracts])):
+        extr['text_link'] = text_link
+    for extr, src in zip(extracts, uutil.fix_imgurls([extr['img_attrs'].get('src') for extr in extracts])):
+        extr['img_attrs']['src'] = src
+    
+    return body_extracts
+
+# https://en.wikipedia.org/wiki/Languages_used_on_the_Internet
+LANGUAGES = ['English','Russian','Spanish','French','German','Japanese','Turkish','Persian',
             'Portuguese','Italian','Chinese','Dutch','Vietnamese','Polish','Arabic','Korean',
             'Czech','Indonesian','Ukrainian','Greek','Hebrew','Thai','Swedish','Romanian',
             'Hungarian','Danish','Finnish','Slovak','Bulgarian','Serbian','Norwegian','Croatian',
             'Lithuanian','Slovenian','Norwegian','Catalan','Estonian','Latvian','Hindi']
 
-    text_langs = df_gaf['raw_text'].str.extractall(f"({'|'.join(langs)})", re.I|re.M).groupby(level=0).agg(list)[0]
-    tag_langs = df_gaf['tag_list'].apply(lambda x: list(set(x)&set(langs)))
-    lang_extracts = text_langs.reindex(tag_langs.index, fill_value=[])+tag_langs
-    lang_extracts = lang_extracts.apply(lambda x: list(dict.fromkeys([l.title() for l in x]))) # unique, preserve order
-    return lang_extracts
+# matched against lowercased text, much faster than an ignore-case alternation. No group, which halves the time of findall
+RE_LANGUAGES = re.compile('|'.join(dict.fromkeys(LANGUAGES)).lower())
+
+def extract_languages(df_gaf):
+    '''Languages named in each post's text, then in its tags, title cased and unique in order of appearance'''
+    text_langs, text_rows, _ = _flatten([RE_LANGUAGES.findall(text.lower()) if isinstance(text, str) else [] for text in df_gaf['raw_text']])
+    tags, tag_rows, _ = _flatten(df_gaf['tag_list'])
+    is_lang = tags.isin(LANGUAGES).values
+    
+    df_langs = pd.DataFrame({
+        'row': np.concatenate([text_rows, tag_rows[is_lang]]),
+        'lang': pd.concat([text_langs, tags[is_lang]], ignore_index=True).str.title()})
+    df_langs = df_langs.drop_duplicates().sort_values('row', kind='stable')
+    lengths = np.bincount(df_langs['row'], minlength=len(df_gaf))
+    
+    return pd.Series(_regroup(df_langs['lang'], lengths), index=df_gaf.index)
 
 
+def is_jsonl(path):
+    '''If path is a JSON Lines file of posts (.jsonl or .ndjson, optionally .gz) rather than a JSON list of pages'''
+    return Path(path).name.removesuffix('.gz').endswith(('.jsonl','.ndjson'))
+
+def iter_gaposts(ga_file):
+    '''Posts of a JSON Lines scrape (see `scrape.GreatAmigurumiScraper.scrape_jsonl`), read one line at a time.
+    An interrupted scrape can leave a partial last line or a truncated gzip stream, reading stops there.'''
+    with ioutil.open_text(ga_file) as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f'incomplete line in {ga_file}, stopping')
+                    return
+        except EOFError:
+            print(f'{ga_file} ends early, stopping')
+
 def flatten_gadata(gadata: Union[str, Path, List[Dict]]) -> List[Dict]:
     if isinstance(gadata,(str, Path)):
-        with open(gadata,'r') as f:
+        if is_jsonl(gadata):
+            return list(iter_gaposts(gadata))
+        with ioutil.open_text(gadata) as f:
             gadata = json.load(f)
         
     flat_post_data = [post for page in gadata for post in page['page_data']]
     return flat_post_data
 
-def process_gafile(ga_file='../data/interim/greatamigurumi.json'):    
-    df_gaf = pd.json_normalize(flatten_gadata(ga_file))
+def post_key(post):
+    '''Identity of a post across scrapes, its link or, for posts without one, a digest of its content'''
+    return post['header'].get('title_link') or post_digest(post)
+
+def assign_ptids(posts, ptid_map=None):
+    '''Post ids, positional unless ptid_map is given.
     
-    df_gaf.insert(0,'ptid',[f'{i:05d}' for i in range(len(df_gaf))])
+    With a ptid_map {post_link: ptid} (see `post_key`), known posts keep their ptid and new posts are numbered 
+    after the highest one, so ids stay stable when a scrape adds posts at the top. ptid_map is updated in-place.
+    '''
+    if ptid_map is None:
+        return [f'{i:05d}' for i in range(len(posts))]
+    
+    next_id = max(map(int, ptid_map.values()), default=-1) + 1
+    for post in posts:
+        if post_key(post) not in ptid_map:
+            ptid_map[post_key(post)] = f'{next_id:05d}'
+            next_id += 1
+    return [ptid_map[post_key(post)] for post in posts]
+
+@contextmanager
+def _gc_paused():
+    '''Pause cyclic garbage collection. Loading and processing posts allocates millions of small containers, none of them 
+    in reference cycles, and each collection they trigger scans every post already loaded'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def process_gafile(ga_file='../data/interim/greatamigurumi.jsonl', ptid_map=None, chunk_size=20000):
+    '''Processed GA posts. Posts are processed chunk_size at a time and each chunk is released once processed, 
+    so intermediate frames are held for one chunk at a time'''
+    with _gc_paused():
+        posts = flatten_gadata(ga_file)
+        ptids = assign_ptids(posts, ptid_map)
+        df_chunks = []
+        for i in range(0, len(posts), chunk_size):
+            df_chunks.append(process_posts(posts[i:i+chunk_size], ptids[i:i+chunk_size]))
+            posts[i:i+chunk_size] = [None]*len(df_chunks[-1])
+        return pd.concat(df_chunks, ignore_index=True)
+
+def clean_raw_texts(raw_texts):
+    '''Strip texts, collapse runs of spaces, and escape newlines with any space around them. 
+    The replacements run as pyarrow kernels, the patterns match the same in re2 as in Python's re. Non-strings are kept'''
+    texts = raw_texts.str.strip()
+    is_str = texts.map(type).eq(str).values
+    arr = pa.array(texts.where(is_str, None), type=pa.large_string(), from_pandas=True)
+    arr = pc.replace_substring_regex(arr, ' {2,}', ' ')
+    arr = pc.replace_substring_regex(arr, ' ?\n ?', r'\\n')
+    texts[is_str] = arr.filter(pa.array(is_str)).to_numpy(zero_copy_only=False)
+    return texts
+
+def _json_normalize(records):
+    '''pd.json_normalize for records whose nested values are dicts in every record or in none, built column-wise 
+    instead of flattening each record. Falls back to pd.json_normalize otherwise'''
+    df = pd.DataFrame(records)
+    is_dict = {col: df[col].map(type).eq(dict) for col in df.columns}
+    if any(d.any() and not d.all() for d in is_dict.values()):
+        return pd.json_normalize(records)
+    # as json_normalize, a record's nested keys come after its other keys
+    nested = [col for col in df.columns if len(df) and is_dict[col].all()]
+    parts = [df.drop(columns=nested)]
+    for col in nested:
+        parts.append(_json_normalize(df[col].tolist()).rename(columns=lambda c: f'{col}.{c}'))
+    return pd.concat(parts, axis=1)
+
+def process_posts(posts, ptids):
+    df_gaf = _json_normalize(posts)
+    
+    df_gaf.insert(0,'ptid',ptids)
     # extract just the tags, since links can be easily recovered
-    df_gaf['tag_list'] = df_gaf.footer.apply(lambda taglist: [t.get('tag') for t in taglist])
+    footer, _, lengths = _flatten(df_gaf['footer'])
+    df_gaf['tag_list'] = _regroup([t.get('tag') for t in footer], lengths)
 
     df_gaf = df_gaf.rename(columns={
         'header.title_text':'post_title',
@@ -52,42 +188,58 @@ def process_gafile(ga_file='../data/interim/greatamigurumi.json'):
         'body.parsed': 'body_extracts',
     }).rename(lambda c: c.replace('body.',''),axis=1)
 
-    df_gaf['raw_text'] = (
-        df_gaf['raw_text']
-        .str.strip()
-        .str.replace(r' {2,}',' ', regex=True)
-        .str.replace(r' ?\n ?','\n', regex=True)
-        .str.replace(r'\n',r'\\n', regex=True))
+    df_gaf['raw_text'] = clean_raw_texts(df_gaf['raw_text'])
     
     df_gaf = df_gaf.drop(columns='footer')
     
-    df_gaf['raw_images'] = df_gaf['raw_images'].apply(lambda img_urls: [uutil.fix_imgurl(img) for img in img_urls])
-    df_gaf['raw_links'] = df_gaf['raw_links'].apply(lambda urls: [uutil.fix_urlscheme(url) for url in urls])
-    df_gaf['body_extracts'].apply(fix_bodylinks) # In place OP
+    # url lists are flattened, fixed in one pass, and regrouped by post
+    raw_images, _, lengths = _flatten(df_gaf['raw_images'])
+    df_gaf['raw_images'] = _regroup(uutil.fix_imgurls(raw_images), lengths)
+    raw_links, _, lengths = _flatten(df_gaf['raw_links'])
+    df_gaf['raw_links'] = _regroup(uutil.fix_urlschemes(raw_links), lengths)
+    fix_all_bodylinks(df_gaf['body_extracts']) # In place OP
 
     df_gaf['languages'] = extract_languages(df_gaf)
     
     #df_gaf['dirslug'] = df_gaf['ptid'] + '_' + df_gaf['post_link'].apply(uutil.url_to_dirname)
 
-    df_gaf['text_links'] = df_gaf['body_extracts'].apply(lambda subp: [i['text_link'] for i in subp])
+    extracts, _, lengths = _flatten(df_gaf['body_extracts'])
+    df_gaf['text_links'] = _regroup([extr['text_link'] for extr in extracts], lengths)
     
     return df_gaf
 
-def extract_img_links(df_gaf):
+def extract_img_links(df_gaf, chunk_size=20000):
     '''
     Extracts all image links from raw_images, raw_links, and body_extracts columns and return frame with imgurl and ptid 
+    Posts are processed chunk_size at a time.
     '''
-    df_gaimg = df_gaf[['ptid','raw_images','body_extracts','raw_links']].copy()
-    df_gaimg['imgurl'] = (
-        df_gaimg['raw_images']
-        + df_gaimg['body_extracts'].apply(lambda xtrcs: [x['img_attrs']['src'] for x in xtrcs]
-                                        + [*filter(uutil.is_imageurl, [x['img_link'] for x in xtrcs])])
-        + df_gaimg['raw_links'].apply(lambda links: [*filter(uutil.is_imageurl,links)])
-    )
-
-    df_gaimg = df_gaimg[['imgurl','ptid']]
-    df_gaimg = df_gaimg.explode('imgurl')
-    df_gaimg['imgurl'] = df_gaimg['imgurl'].apply(uutil.fix_imgurl)
+    with _gc_paused():
+        df_gaimg = pd.concat([_chunk_img_links(df_gaf.iloc[i:i+chunk_size]) for i in range(0, len(df_gaf) or 1, chunk_size)])
+        return df_gaimg.drop_duplicates('imgurl')
+
+def _chunk_img_links(df_gaf):
+    raw_images, image_rows, _ = _flatten(df_gaf['raw_images'])
+    extracts, extract_rows, _ = _flatten(df_gaf['body_extracts'])
+    srcs = pd.Series([x['img_attrs']['src'] for x in extracts], dtype=object)
+    img_links = pd.Series([x['img_link'] for x in extracts], dtype=object)
+    raw_links, link_rows, _ = _flatten(df_gaf['raw_links'])
+    is_img_link, is_img_raw_link = uutil.are_imageurls(img_links).values, uutil.are_imageurls(raw_links).values
+    
+    # each post's urls in order: raw images, body image sources, body image links, raw image links
+    sources = [(image_rows, raw_images), (extract_rows, srcs), (extract_rows[is_img_link], img_links[is_img_link]), 
+               (link_rows[is_img_raw_link], raw_links[is_img_raw_link])]
+    # posts without any image keep a null imgurl row, as exploding an empty list does
+    no_images = np.setdiff1d(np.arange(len(df_gaf)), np.concatenate([rows for rows,_ in sources]))
+    sources.append((no_images, pd.Series([np.nan]*len(no_images), dtype=object)))
+    
+    df_gaimg = pd.DataFrame({
+        'row': np.concatenate([rows for rows,_ in sources]),
+        'source': np.repeat(np.arange(len(sources)), [len(rows) for rows,_ in sources]),
+        'imgurl': pd.concat([urls for _,urls in sources], ignore_index=True)})
+    df_gaimg = df_gaimg.sort_values(['row','source'], kind='stable')
+    
+    df_gaimg = pd.DataFrame({'imgurl': uutil.fix_imgurls(df_gaimg['imgurl']).values, 'ptid': df_gaf['ptid'].values[df_gaimg['row']]}, 
+                            index=df_gaf.index[df_gaimg['row']])
     df_gaimg = df_gaimg.drop_duplicates('imgurl')
     
     return df_gaimg
@@ -98,7 +250,7 @@ def get_datelinkdf(df_gaf):
     df_dlinks = df_gaf[['post_date','raw_links']].copy()
     df_dlinks['post_date'] = pd.to_datetime(df_dlinks.post_date, format='%b %d, %Y').dt.date
     df_dlinks = df_dlinks.explode('raw_links')
-    df_dlinks = df_dlinks[df_dlinks.raw_links.apply(uutil.link_filter)]
+    df_dlinks = df_dlinks[uutil.link_filters(df_dlinks.raw_links).values]
     df_dlinks = df_dlinks.rename(columns={'raw_links':'url'})
 
     return df_dlinks
\ No newline at end of file
@@ -0,0 +1,27 @@
+/*
+ * Long-lived Readability.js worker for crawchet.process.readability.ReadabilityPool
+ *
+ * Reads one JSON request {"id", "html"} per stdin line and writes one JSON response {"id", "article", "error"}
+ * per stdout line, with article as returned by Readability.parse() (see readabilipy's ExtractArticle.js).
+ * Dependencies are resolved from readabilipy's javascript/node_modules through NODE_PATH.
+ */
+
+const readline = require('readline');
+const { Readability } = require('@mozilla/readability');
+const { JSDOM } = require('jsdom');
+
+const rl = readline.createInterface({input: process.stdin, crlfDelay: Infinity});
+
+rl.on('line', (line) => {
+	const request = JSON.parse(line);
+	let article = null;
+	let error = null;
+	try {
+		const doc = new JSDOM(request.html.trim());
+		article = new Readability(doc.window.document).parse();
+		doc.window.close();
+	} catch (e) {
+		error = String(e);
+	}
+	process.stdout.write(JSON.stringify({id: request.id, article: article, error: error}) + '\n');
+});
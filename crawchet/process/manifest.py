@@ -0,0 +1,156 @@
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from datetime import datetime
+
+from crawchet.utils.lazy import lazy_import
+from crawchet.process.boilerplate import HostTemplates
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def record_keys(df_records):
+    '''64 bit key of each record by target uri, payload digest and length. A key changes when a page's content does'''
+    return pd.util.hash_pandas_object(df_records[['target_uri','payload_digest','content_length']].astype(str), index=False).values
+
+
+def post_digest(post):
+    return hashlib.sha1(json.dumps(post, sort_keys=True).encode()).hexdigest()
+
+
+class BuildManifest:
+    '''State kept between incremental `transform.build_masterframe` runs.
+
+    state_dir holds:
+        manifest.json: parse settings, GA post ids and digests {post_link: ptid}, {post_link: digest}, a log of runs, 
+            and the size and modification time of each file below
+        records.parquet: keys (see `record_keys`) of every WARC record already parsed, kept or filtered out
+        textracts/: text extracts of parsed records, one part-NNNNN.parquet per run
+        gaf.pkl: the processed GA posts
+        templates.pkl: the learned `boilerplate.HostTemplates`, if templates are stripped
+
+    Files written during a run are kept as hidden temp files (read back by this manifest) until `save` moves them 
+    into place and then writes manifest.json. If a run stops before `save`, the previous state is kept as is. 
+    If it stops within `save`, the files no longer match manifest.json and the next run starts over, keeping only the ptids.
+
+    Args:
+        state_dir (str): directory to keep state in, created if it does not exist
+    '''
+    def __init__(self, state_dir) -> None:
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.state_dir/'manifest.json'
+        self.records_path = self.state_dir/'records.parquet'
+        self.textracts_dir = self.state_dir/'textracts'
+        self.gaf_path = self.state_dir/'gaf.pkl'
+        self.templates_path = self.state_dir/'templates.pkl'
+        self._pending = {} # {final path: temp file} written this run
+        self._discard_records = False # committed records and textracts are replaced on save
+
+        manifest = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.settings = manifest.get('settings')
+        self.ptid_map = manifest.get('ptid_map', {})
+        self.post_digests = manifest.get('post_digests', {})
+        self.runs = manifest.get('runs', [])
+        if manifest.get('files', {}) != self._file_stamps():
+            print(f'{self.state_dir} does not match its manifest (interrupted save?), reprocessing all posts and records')
+            self._clear()
+            self.post_digests = {}
+
+    def _file_stamps(self):
+        files = [self.records_path, self.gaf_path, self.templates_path, *self.textracts_dir.glob('part-*.parquet')]
+        return {f.relative_to(self.state_dir).as_posix(): [f.stat().st_size, f.stat().st_mtime_ns] for f in files if f.exists()}
+
+    def _clear(self):
+        for path in [self.records_path, self.gaf_path, self.templates_path]:
+            path.unlink(missing_ok=True)
+        if self.textracts_dir.exists():
+            shutil.rmtree(self.textracts_dir)
+        self._pending = {}
+        self._discard_records = False
+
+    def _current(self, path):
+        '''File to read path from, the temp file if path was written this run'''
+        return self._pending.get(path, path)
+
+    def _write(self, path, write):
+        tmp_file = path.with_name(f'.{path.name}.tmp')
+        write(tmp_file)
+        self._pending[path] = tmp_file
+
+    def _is_record_file(self, path):
+        return path == self.records_path or path.parent == self.textracts_dir
+
+    def check_settings(self, settings):
+        '''Discard parsed records if they were parsed with other settings. GA post ids are always kept.
+        The committed records and textracts are only replaced on `save`.'''
+        if self.settings is not None and self.settings != settings:
+            print(f'parse settings changed from {self.settings}, reparsing all records')
+            for path in [p for p in self._pending if self._is_record_file(p)]:
+                self._pending.pop(path).unlink(missing_ok=True)
+            self._discard_records = True
+        self.settings = settings
+
+    def processed_keys(self):
+        records_file = self._current(self.records_path)
+        if not records_file.exists() or records_file == self.records_path and self._discard_records:
+            return np.zeros(0, dtype=np.uint64)
+        return pd.read_parquet(records_file)['record_key'].values
+
+    def _textract_parts(self):
+        committed = [] if self._discard_records else self.textracts_dir.glob('part-*.parquet')
+        parts = {*committed, *(p for p in self._pending if p.parent == self.textracts_dir)}
+        return [self._current(part) for part in sorted(parts)]
+
+    def add_records(self, df_textracts, keys):
+        '''Write the text extracts parsed from records with keys as a new part, and mark the records as processed'''
+        self.textracts_dir.mkdir(exist_ok=True)
+        part_file = self.textracts_dir/f'part-{len(self._textract_parts()):05d}.parquet'
+        self._write(part_file, lambda f: df_textracts.to_parquet(f, index=False))
+
+        all_keys = np.concatenate([self.processed_keys(), np.asarray(keys, dtype=np.uint64)])
+        self._write(self.records_path, lambda f: pd.DataFrame({'record_key': np.unique(all_keys)}).to_parquet(f, index=False))
+
+    def read_textracts(self, columns=None):
+        '''All stored text extracts, latest row per record key'''
+        parts = self._textract_parts()
+        if not parts:
+            return None
+        df_textracts = pd.concat([pd.read_parquet(part, columns=columns) for part in parts], ignore_index=True)
+        return df_textracts.drop_duplicates('record_key', keep='last').reset_index(drop=True)
+
+    def read_gaf(self):
+        gaf_file = self._current(self.gaf_path)
+        return pd.read_pickle(gaf_file) if gaf_file.exists() else None
+
+    def write_gaf(self, df_gaf):
+        self._write(self.gaf_path, df_gaf.to_pickle)
+
+    def read_templates(self):
+        templates_file = self._current(self.templates_path)
+        return HostTemplates.load(templates_file) if templates_file.exists() else None
+
+    def write_templates(self, templates):
+        self._write(self.templates_path, templates.save)
+
+    def log_run(self, **counts):
+        self.runs.append({'time': datetime.now().isoformat(timespec='seconds'), **counts})
+
+    def save(self):
+        '''Move the files written this run into place, then write manifest.json'''
+        for path, tmp_file in self._pending.items():
+            tmp_file.replace(path)
+        if self._discard_records:
+            stale = [self.records_path, *self.textracts_dir.glob('part-*.parquet')]
+            for path in stale:
+                if path not in self._pending:
+                    path.unlink(missing_ok=True)
+            self._discard_records = False
+        self._pending = {}
+        manifest = {'settings': self.settings, 'ptid_map': self.ptid_map, 'post_digests': self.post_digests, 'runs': self.runs, 
+                    'files': self._file_stamps()}
+        tmp_file = self.path.with_name(f'.{self.path.name}.tmp')
+        tmp_file.write_text(json.dumps(manifest, indent=1))
+        tmp_file.replace(self.path)
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+import importlib.util
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from crawchet.utils.lazy import lazy_import, lazy_callable
+
+simple_json = lazy_import('readabilipy.simple_json')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+effective_n_jobs = lazy_callable('joblib', 'effective_n_jobs')
+
+# located without importing readabilipy
+READABILIPY_JS_DIR = Path(importlib.util.find_spec('readabilipy').origin).parent/'javascript'
+WORKER_JS = Path(__file__).parent/'js'/'readability_worker.js'
+
+
+def article_from_readability(input_json, content_digests=False, node_indexes=False):
+    '''Format a Readability.parse() result the way `readabilipy.simple_json_from_html_string(use_readability=True)` does'''
+    article_json = {'title': None, 'byline': None, 'date': None, 'content': None, 'plain_content': None, 'plain_text': None}
+    if input_json:
+        for key in ['title', 'byline', 'date', 'content']:
+            if input_json.get(key):
+                article_json[key] = input_json[key]
+        if article_json['content']:
+            article_json['plain_content'] = simple_json.plain_content(article_json['content'], content_digests, node_indexes)
+            article_json['plain_text'] = simple_json.extract_text_blocks_js(article_json['plain_content'])
+
+    return article_json
+
+
+class ReadabilityWorker:
+    '''A single Node.js process running Readability.js over documents sent through stdin/stdout (see js/readability_worker.js)'''
+    def __init__(self, node='node', errors='ignore') -> None:
+        self.node = node
+        self.errors = errors
+        self.n_sent = 0
+        self.proc = None
+        self.start()
+
+    def start(self):
+        env = {**os.environ, 'NODE_PATH': (READABILIPY_JS_DIR/'node_modules').as_posix()}
+        self.proc = subprocess.Popen(
+            [self.node, WORKER_JS.as_posix()], cwd=READABILIPY_JS_DIR, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', bufsize=1)
+
+    def parse(self, html):
+        '''Readability.parse() output for one document, None if it failed'''
+        self.n_sent += 1
+        try:
+            self.proc.stdin.write(json.dumps({'id': self.n_sent, 'html': html}) + '\n')
+            self.proc.stdin.flush()
+            response = self.proc.stdout.readline()
+        except (BrokenPipeError, OSError):
+            response = ''
+
+        if not response:
+            # the process died (e.g. out of memory on a huge page), replace it and give up on this document
+            self.close()
+            self.start()
+            response = json.dumps({'id': self.n_sent, 'article': None, 'error': 'worker exited'})
+
+        response = json.loads(response)
+        if response['error'] is not None:
+            if self.errors == 'print':
+                print(response['error'], file=sys.stderr)
+            elif self.errors == 'raise':
+                raise RuntimeError(response['error'])
+
+        return response['article']
+
+    def parse_batch(self, htmls):
+        return [article_from_readability(self.parse(html)) for html in htmls]
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
+
+class ReadabilityPool:
+    '''Pool of long-lived Readability.js workers, replacing a Node.js process spawn and temp files per document.
+
+    Each thread of the pool feeds batches to its own worker, so documents are simplified by n_jobs Node.js processes at once.
+    Output matches `simple_json_from_html_string(html, use_readability=True)`. If Node.js or readabilipy's node
+    dependencies are unavailable, it falls back to readabilipy's pure-Python mode as readabilipy does.
+
+    Args:
+        n_jobs (int): number of worker processes, as in joblib (default: -1)
+        batch_size (int): documents per batch sent to a worker (default: 32)
+        errors (str, {ignore, print, raise}): How to handle documents Readability.js fails on (default: 'ignore')
+
+    Example:
+        with ReadabilityPool(n_jobs=4) as pool:
+            articles = pool.map(html_strings)
+    '''
+    def __init__(self, n_jobs=-1, batch_size=32, errors='ignore') -> None:
+        self.n_jobs = effective_n_jobs(n_jobs)
+        self.batch_size = batch_size
+        self.errors = errors
+        self.use_readability = simple_json.have_node()
+        if not self.use_readability:
+            print('Warning: node or readabilipy node dependencies not found, reverting to pure-Python mode.', file=sys.stderr)
+
+        self._local = threading.local()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(self.n_jobs)
+
+    def _worker(self):
+        if getattr(self._local, 'worker', None) is None:
+            self._local.worker = ReadabilityWorker(errors=self.errors)
+            with self._lock:
+                self._workers.append(self._local.worker)
+        return self._local.worker
+
+    def _simplify_batch(self, htmls):
+        if not self.use_readability:
+            return [simple_json.simple_json_from_html_string(html, use_readability=False) for html in htmls]
+        return self._worker().parse_batch(htmls)
+
+    def map(self, htmls, total=None):
+        '''simple_json_from_html_string output for each html string, in order'''
+        htmls = iter(htmls)
+        batches = iter(lambda: [html for _,html in zip(range(self.batch_size), htmls)], [])
+
+        results = []
+        with tqdm(total=total) as pbar:
+            for batch in self._executor.map(self._simplify_batch, batches):
+                results.extend(batch)
+                pbar.update(len(batch))
+        return results
+
+    def close(self):
+        self._executor.shutdown()
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
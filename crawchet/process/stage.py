@@ -0,0 +1,134 @@
+import io
+import json
+import zipfile
+import tarfile
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from crawchet.utils.lazy import lazy_import
+
+yaml = lazy_import('yaml')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_dumper():
+    '''(Dumper, width). libyaml's emitter renders the same yaml several times faster, but only takes an int width'''
+    if getattr(yaml, '__with_libyaml__', False):
+        return yaml.CSafeDumper, 2**31-1
+    return yaml.SafeDumper, float('inf')
+
+
+def iter_frames(source, batch_size=10000):
+    '''Batches of at most batch_size rows from a dataframe or an iterable of dataframes (e.g. `dataset.iter_master`)'''
+    frames = [source] if isinstance(source, pd.DataFrame) else source
+    for df in frames:
+        for i in range(0, len(df), batch_size):
+            yield df.iloc[i:i+batch_size]
+
+
+def render_front_matter(df_frontmatter):
+    '''YAML front matter block of each row, as a list of strings.
+    Rows are converted to python objects for the whole batch at once rather than row by row.'''
+    records = df_frontmatter.to_dict('records')
+    dumper, width = yaml_dumper()
+    return ['---\n' + yaml.dump({k:(v.item() if isinstance(v,np.generic) else v) for k,v in rec.items()}, Dumper=dumper,
+                                default_flow_style=None, sort_keys=False, width=width) + '---\n\n'
+            for rec in records]
+
+
+class StagedWriter:
+    '''Write batches of (relative path, text) items as loose files, sharded NDJSON, or a single zip/tar bundle.
+
+    - files: out_path/<name>, written by a pool of threads, each parent directory created once
+    - ndjson: out_path/part-NNNNN.ndjson shards of shard_size {"name":..., "text":...} lines
+    - zip/tar: one archive at out_path (tar is gzipped if out_path ends in .gz)
+
+    Args:
+        out_path (str): output directory (files, ndjson) or archive file (zip, tar)
+        fmt (str, {files, ndjson, zip, tar}): output format (default: 'files')
+        n_threads (int): writer threads for loose files (default: 8)
+        shard_size (int): lines per ndjson shard (default: 50000)
+
+    Example:
+        with StagedWriter('../data/staged/html.zip', fmt='zip') as writer:
+            for df in dataset.iter_master('../data/interim/df_master', columns=['term_count','content_length','post_title','text']):
+                writer.write(text_filenames(df, 'html'), df['text'])
+    '''
+    def __init__(self, out_path, fmt='files', n_threads=8, shard_size=50000) -> None:
+        if fmt not in ('files', 'ndjson', 'zip', 'tar'):
+            raise ValueError(f'unknown fmt {fmt!r}, expected one of files, ndjson, zip, tar')
+        self.out_path = Path(out_path)
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.n_written = 0
+        self._made_dirs = set()
+        self._shard = None
+        self._executor = ThreadPoolExecutor(n_threads) if fmt == 'files' else None
+
+        if fmt in ('files', 'ndjson'):
+            self.out_path.mkdir(parents=True, exist_ok=True)
+        else:
+            self.out_path.parent.mkdir(parents=True, exist_ok=True)
+        if fmt == 'zip':
+            self._archive = zipfile.ZipFile(self.out_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        elif fmt == 'tar':
+            self._archive = tarfile.open(self.out_path, 'w:gz' if self.out_path.suffix == '.gz' else 'w')
+
+    def _write_files(self, names, texts):
+        paths = [self.out_path/name for name in names]
+        for parent in {path.parent for path in paths} - self._made_dirs:
+            parent.mkdir(parents=True, exist_ok=True)
+            self._made_dirs.add(parent)
+        # consume the results so that errors are raised here
+        list(self._executor.map(lambda pt: pt[0].write_text(pt[1]), zip(paths, texts)))
+
+    def _write_lines(self, lines):
+        for line in lines:
+            if self._shard is None or self.n_written % self.shard_size == 0:
+                if self._shard is not None:
+                    self._shard.close()
+                self._shard = open(self.out_path/f'part-{self.n_written//self.shard_size:05d}.ndjson', 'w')
+            self._shard.write(line + '\n')
+            self.n_written += 1
+
+    def write(self, names, texts):
+        '''Write a batch of texts to their relative paths (names)'''
+        names, texts = list(names), list(texts)
+        if self.fmt == 'files':
+            self._write_files(names, texts)
+        elif self.fmt == 'ndjson':
+            self._write_lines(json.dumps({'name': name, 'text': text}) for name,text in zip(names, texts))
+            return
+        elif self.fmt == 'zip':
+            for name, text in zip(names, texts):
+                self._archive.writestr(name, text)
+        else:
+            for name, text in zip(names, texts):
+                data = text.encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                self._archive.addfile(info, io.BytesIO(data))
+        self.n_written += len(names)
+
+    def write_records(self, records):
+        '''Write a batch of json serializable records as ndjson lines (fmt='ndjson' only)'''
+        if self.fmt != 'ndjson':
+            raise ValueError('write_records requires fmt="ndjson"')
+        self._write_lines(json.dumps(rec) for rec in records)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._shard is not None:
+            self._shard.close()
+        if self.fmt in ('zip', 'tar'):
+            self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
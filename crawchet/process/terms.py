@@ -0,0 +1,125 @@
+import re
+
+from crawchet.utils.lazy import lazy_import, lazy_callable
+
+np = lazy_import('numpy')
+sp = lazy_import('scipy.sparse')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
+
+# Stitch abbreviations per language, matched between word boundaries or stitch counts (e.g. "6sc", "sc2tog").
+# The english set, in this order, matches exactly what RE_CROCHET_TERMS matches.
+ABBREVIATIONS = {
+    'en': {'st': r'sts?', 'ch': r'ch', 'sl_st': r'sl[ -]?st', 'inc': r'inc', 'dec': r'dec', 'sc': r'sc', 'hdc': r'hdc', 'dc': r'dc',
+           'rep': r'rep', 'row': r'row', 'rnd': r'rnd', 'round': r'round'},
+    'es': {'pb': r'pb', 'mp': r'mp', 'pa': r'pa', 'aum': r'aum', 'dism': r'dism', 'cad': r'cad', 'pr': r'pr', 'vta': r'vta', 'vuelta': r'vuelta'},
+    'pt': {'pb': r'pb', 'mpa': r'mpa', 'aum': r'aum', 'dim': r'dim', 'corr': r'corr', 'pbx': r'pbx', 'carr': r'carr', 'volta': r'volta'},
+    'fr': {'ms': r'ms', 'ml': r'ml', 'mc': r'mc', 'aug': r'aug', 'dim': r'dim', 'rg': r'rg', 'tour': r'tour'},
+    'de': {'fm': r'f\.?m', 'lm': r'lm', 'km': r'km', 'zun': r'zun', 'abn': r'abn', 'rd': r'rd', 'runde': r'runde'},
+    'nl': {'hv': r'hv', 'meerd': r'meerd', 'mind': r'mind', 'tr': r'tr', 'toer': r'toer'},
+    'it': {'mb': r'mb', 'cat': r'cat', 'mbss': r'mbss', 'aum': r'aum', 'dim': r'dim', 'giro': r'giro'},
+}
+# abbreviations that are also ordinary words or markup (single letters, "br" of <br/>), only matched right after 
+# a stitch count, e.g. "6 v" or "3br"
+COUNTED_ABBREVIATIONS = {
+    'fr': {'br': r'br'},
+    'nl': {'v': r'v', 'l': r'l'},
+}
+# phrases matched anywhere
+PHRASES = {
+    'en': {'single_crochet': r'single crochet', 'magic_ring': r'magic ring'},
+    'es': {'anillo_magico': r'anillo m[aá]gico', 'punto_bajo': r'punto bajo'},
+    'pt': {'anel_magico': r'anel m[aá]gico', 'ponto_baixo': r'ponto baixo'},
+    'fr': {'cercle_magique': r'cercle magique', 'maille_serree': r'maille serr[ée]e'},
+    'de': {'magischer_ring': r'magischer ring', 'fadenring': r'fadenring', 'feste_masche': r'feste maschen?'},
+    'nl': {'magische_ring': r'magische ring', 'vaste_steek': r'vaste steken?'},
+    'it': {'anello_magico': r'anello magico', 'maglia_bassa': r'maglie? bass[ae]'},
+}
+
+
+def build_term_pattern(languages=('en',)):
+    '''One regex with a capture group per term of the given languages.
+    Terms shared between languages (e.g. "aum") are a single feature, named by the first language that has them.
+
+    Returns:
+        tuple: (compiled pattern, term names in group order)
+    '''
+    abbrevs, counted, phrases = {}, {}, {}
+    for lang in languages:
+        for terms, lang_terms in [(abbrevs, ABBREVIATIONS), (counted, COUNTED_ABBREVIATIONS), (phrases, PHRASES)]:
+            for name, pat in lang_terms.get(lang, {}).items():
+                if pat not in terms.values():
+                    terms[f'{lang}:{name}'] = pat
+
+    alternatives = [rf'(?:\b|\d+)(?:{"|".join(f"({pat})" for pat in abbrevs.values())})(?:\b|\d+)']
+    if counted:
+        alternatives.append(rf'\d+ ?(?:{"|".join(f"({pat})" for pat in counted.values())})\b')
+    alternatives += [f'({pat})' for pat in phrases.values()]
+    # every match starts with a digit or a term's first letter. Checking that first lets the engine skip 
+    # most positions without trying each alternative, and doesn't change what is matched
+    first_chars = ''.join(sorted({pat[0] for pat in [*abbrevs.values(), *phrases.values()]}))
+    pattern = re.compile(rf'(?=[\d{first_chars}])(?:{"|".join(alternatives)})', re.IGNORECASE|re.MULTILINE)
+
+    return pattern, [*abbrevs, *counted, *phrases]
+
+
+def _count_batch(pattern, n_terms, texts):
+    '''Sparse (len(texts) x n_terms) term counts of a batch of texts.
+
+    The texts are joined by NUL, which no term or digit run can cross and which bounds words like the ends of
+    a string do, so a single finditer over the batch finds the same matches as one per text.
+    '''
+    texts = [text if isinstance(text, str) else '' for text in texts]
+    starts = np.cumsum([0, *[len(text)+1 for text in texts[:-1]]])
+    matches = [(m.start(), m.lastindex) for m in pattern.finditer('\x00'.join(texts))]
+    
+    shape = (len(texts), n_terms)
+    if not matches:
+        return sp.csr_matrix(shape, dtype=np.int32)
+    
+    positions, groups = np.array(matches).T
+    docs = np.searchsorted(starts, positions, side='right') - 1
+    # duplicate (doc, term) entries are summed into counts
+    return sp.csr_matrix((np.ones(len(docs), dtype=np.int32), (docs, groups-1)), shape=shape)
+
+
+class TermCounter:
+    '''Count crochet terms of one or more languages in a single regex pass per text.
+
+    Args:
+        languages (list): keys of ABBREVIATIONS/PHRASES (default: ('en',), same total as RE_CROCHET_TERMS)
+
+    Example:
+        counts = TermCounter(['en','es']).count_matrix(df_textracts['text'], n_jobs=-1)
+        df_textracts['term_count'] = np.asarray(counts.sum(axis=1)).ravel()
+    '''
+    def __init__(self, languages=('en',)) -> None:
+        self.languages = tuple(languages)
+        self.pattern, self.terms = build_term_pattern(self.languages)
+
+    def count(self, text):
+        '''{term: count} for the terms found in text'''
+        counts = _count_batch(self.pattern, len(self.terms), [text])
+        return {self.terms[i]:int(c) for i,c in zip(counts.indices, counts.data)}
+
+    def count_matrix(self, texts, batch_size=2000, n_jobs=1):
+        '''Sparse (n_texts x n_terms) matrix of term counts, batches of texts counted in parallel
+
+        Returns:
+            scipy.sparse.csr_matrix: int32 counts, columns in the order of self.terms
+        '''
+        texts = list(texts)
+        batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+        if n_jobs == 1 or len(batches) <= 1:
+            parts = [_count_batch(self.pattern, len(self.terms), batch) for batch in batches]
+        else:
+            parts = Parallel(n_jobs=n_jobs)(delayed(_count_batch)(self.pattern, len(self.terms), batch) for batch in tqdm(batches))
+
+        if not parts:
+            return sp.csr_matrix((0, len(self.terms)), dtype=np.int32)
+        return sp.vstack(parts, format='csr')
+
+    def count_totals(self, texts, batch_size=2000, n_jobs=1):
+        '''Total term count per text, as texts.str.count(RE_CROCHET_TERMS) for the english set'''
+        return np.asarray(self.count_matrix(texts, batch_size, n_jobs).sum(axis=1)).ravel()
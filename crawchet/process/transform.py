@@ -1,16 +1,22 @@
 import re
 import json
-import yaml
 from pathlib import Path
-import numpy as np
-import pandas as pd
-from tqdm.auto import tqdm
-
-from joblib import Parallel,delayed
-from readabilipy import simple_json_from_html_string
-
-from crawchet.process import archive, parsehtml, greatami
+from crawchet.process import archive, parsehtml, greatami, dataset, dedup
+from crawchet.process.cache import ParseCache, parser_fingerprint
+from crawchet.process.manifest import BuildManifest, record_keys, post_digest
+from crawchet.process.boilerplate import HostTemplates, host_key
+from crawchet.process.readability import ReadabilityPool
+from crawchet.process.terms import TermCounter
+from crawchet.process.stage import StagedWriter, iter_frames, render_front_matter
 from crawchet.utils import uri as uutil
+from crawchet.utils import instrument
+from crawchet.utils.lazy import lazy_import, lazy_callable
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
 
 
 # https://github.com/megagonlabs/tagruler
@@ -18,28 +24,73 @@ from crawchet.utils import uri as uutil
 # https://github.com/argilla-io/argilla#key-features
 # https://explosion.ai/blog/spancat
 
-RE_CROCHET_TERMS = re.compile( # Note: many non-english terms are not accounted for
-    r'(?:\b|\d+)(sts?|ch|sl[ -]?st|inc|dec|sc|h?dc|rep|row|rnd|round)(?:\b|\d+)|single crochet|magic ring', 
-    re.IGNORECASE|re.MULTILINE)
+RE_CROCHET_TERMS = parsehtml.RE_CROCHET_TERMS
 
 
-def warc_to_dftext(warc_file='../data/interim/merged.warc.gz', tag_transform='reduce', text_only=True, max_status=399, min_term_count=0):
-    print('processing warc file...')
-    df_records = archive.ArchiveManager().to_dataframe(warc_file)
-    
-    print('parsing html content...')
+def get_parser(tag_transform='reduce', text_only=True, preprocess_engine='legacy', templates=None, keep_preprocessed=False):
     if tag_transform == 'fast':
-        gp = parsehtml.FastParser(title_in_body=True)
-    else:
-        gp = parsehtml.GenericParser(tag_transform, text_only, title_in_body=True)
+        return parsehtml.FastParser(title_in_body=True, preprocess_engine=preprocess_engine, templates=templates, keep_preprocessed=keep_preprocessed)
+    elif tag_transform == 'fast_reduce':
+        # lxml implementation of 'reduce', same output in linear time
+        return parsehtml.FastParser(title_in_body=True, preprocess_engine=preprocess_engine, tag_transform='reduce', text_only=text_only, templates=templates, keep_preprocessed=keep_preprocessed)
     
-    df_textracts = pd.DataFrame(gp.parallel_parse(df_records['content'], df_records['target_uri']))
-    df_textracts = pd.concat([df_records[['status','content_length','content']], df_textracts], axis=1)
+    return parsehtml.GenericParser(tag_transform, text_only, title_in_body=True, preprocess_engine=preprocess_engine, templates=templates, keep_preprocessed=keep_preprocessed)
+
+
+def _parse_records(gp, df_records, by_offset=False, n_jobs=-5):
+    if by_offset:
+        record_refs = zip(df_records['warc_file'], df_records['offset'])
+        return list(gp.parallel_parse_warc(record_refs, n_jobs=n_jobs, total=len(df_records)))
     
+    return gp.parallel_parse(df_records['content'], df_records['target_uri'], n_jobs=n_jobs)
+
+
+def parse_records_cached(gp, df_records, cache_path, by_offset=False, n_jobs=-5):
+    '''Parse records, reusing cached outputs of unchanged records (see `cache.ParseCache`). Only cache misses are parsed.'''
+    cache = ParseCache(cache_path)
+    try:
+        keys = cache.make_keys(gp, df_records['payload_digest'], df_records['target_uri'])
+        cached = cache.get_many(keys)
+        miss_mask = [k not in cached for k in keys]
+        print(f'parse cache: {len(df_records)-sum(miss_mask)} hits, {sum(miss_mask)} misses')
+        
+        parsed_misses = _parse_records(gp, df_records[miss_mask], by_offset, n_jobs) if any(miss_mask) else []
+        miss_keys = [k for k,m in zip(keys, miss_mask) if m]
+        cache.put_many(miss_keys, parsed_misses)
+    finally:
+        cache.close()
+    
+    parsed_misses = iter(parsed_misses)
+    return [next(parsed_misses) if m else cached[k] for k,m in zip(keys, miss_mask)]
+
+
+@instrument.spanned('learn_templates')
+def _learn_templates(df_records, by_offset=False, n_jobs=-5, templates_outpath=None, templates=None, hosts=None):
+    print('learning host templates...')
+    instrument.set_items(len(df_records))
+    templates = HostTemplates() if templates is None else templates
+    if by_offset:
+        templates.fit_records(zip(df_records['warc_file'], df_records['offset']), df_records['target_uri'], n_jobs=n_jobs, hosts=hosts)
+    else:
+        templates.fit(df_records['content'], df_records['target_uri'], n_jobs=n_jobs, hosts=hosts)
+    if templates_outpath is not None:
+        templates.save(templates_outpath)
+    return templates
+
+
+@instrument.spanned('postprocess')
+def postprocess_textracts(df_textracts, tag_transform='reduce', max_status=399, min_term_count=0, verbose=True, 
+                          term_languages=('en',), term_features=False, n_jobs=1):
+    '''Filter by status, normalize whitespace, count crochet terms, and extract titles of parsed records.
+    
+    Terms are counted with `terms.TermCounter(term_languages)`. If term_features, a `tc_<lang>_<term>` count column 
+    is added for each term.
+    '''
+    instrument.set_items(len(df_textracts))
     if max_status>0:
-        df_textracts = df_textracts[df_textracts.status.values<=max_status]
+        df_textracts = df_textracts[df_textracts.status.values<=max_status].copy()
     
-    print('cleaning and transforming whitespace text...')
+    if verbose: print('cleaning and transforming whitespace text...')
     df_textracts['text'] = (
         df_textracts['text']
         .str.strip()
@@ -47,20 +98,25 @@ def warc_to_dftext(warc_file='../data/interim/merged.warc.gz', tag_transform='re
         .str.replace(r'(?:[ ]*\n[ ]*){2,}', r'\n\n', regex=True)
     ) # newlines are entirely removed by label-studio regardless, so just any number of newlines with 2 newlines
 
-    print('counting crochet terms...')
-    df_textracts['term_count'] = df_textracts['text'].str.count(RE_CROCHET_TERMS)
-    df_textracts = df_textracts[df_textracts.term_count>=min_term_count] # filter out pages with too few crochet terms
+    if verbose: print('counting crochet terms...')
+    counter = TermCounter(term_languages)
+    term_counts = counter.count_matrix(df_textracts['text'], n_jobs=n_jobs)
+    df_textracts['term_count'] = np.asarray(term_counts.sum(axis=1)).ravel()
+    if term_features:
+        term_cols = ['tc_'+t.replace(':','_') for t in counter.terms]
+        df_textracts[term_cols] = term_counts.toarray().astype(np.int16)
+    df_textracts = df_textracts[df_textracts.term_count>=min_term_count].copy() # filter out pages with too few crochet terms
 
-    df_textracts['origurl'] = df_textracts.url.apply(uutil.get_original_url, strip_port=True)
+    df_textracts['origurl'] = uutil.get_original_urls(df_textracts.url, strip_port=True).values
     #wb_msk = df_textracts.url.str.contains('web.archive.org/')
     # split out the original url from the web.archive.org url, remove the port number
     #df_textracts.loc[wb_msk,'origurl'] = df_textracts[wb_msk].url.str.split(r'\d{14}/').str[1].str.replace(':80','')
     #df_textracts['origurl'] = df_textracts['origurl'].fillna(df_textracts.url)
 
-    print('extracting page titles...')
+    if verbose: print('extracting page titles...')
     if tag_transform == 'markdown':
         page_titles = df_textracts['text'].str.extract(r'^# [*]{2}(.+)[*]{2}')[0].fillna('')
-    elif tag_transform in ['reduce','fast']:
+    elif tag_transform in ['reduce','fast','fast_reduce']:
         page_titles = df_textracts['text'].str.extract(r'<title>(.+)</title>')[0].fillna('')
     
     df_textracts.insert(df_textracts.columns.get_loc('text')+1, 'title', page_titles)
@@ -68,59 +124,385 @@ def warc_to_dftext(warc_file='../data/interim/merged.warc.gz', tag_transform='re
     return df_textracts
 
 
-def build_masterframe(ga_file, warc_file, df_master_outfile=None, tag_transform='reduce'):
+@instrument.spanned()
+def warc_to_dftext(warc_file='../data/interim/merged.warc.gz', tag_transform='reduce', text_only=True, max_status=399, min_term_count=0, n_jobs=-5, preprocess_engine='legacy', by_offset=False, cache_path=None, strip_templates=False, templates_outpath=None, keep_preprocessed=False, term_languages=('en',), term_features=False):
+    '''Parse the response records of a WARC file into a dataframe of text extracts.
+
+    If by_offset, records are located from their headers alone and each worker reads and parses its own batch of records 
+    (see `parsehtml.iter_parse_warc`). The raw `content` column is then replaced by `warc_file` and `offset`, 
+    which `parallel_simplify` uses to read content back.
+
+    If cache_path is given, parse outputs are cached there by payload digest, url, and parser settings, 
+    and only records whose key changed are parsed again.
+
+    If strip_templates, blocks repeated across pages of the same host are learned from the records and removed 
+    before text extraction (see `boilerplate.HostTemplates`), optionally saved to templates_outpath for `parallel_simplify`.
+
+    If keep_preprocessed, the preprocessed html of each page is kept in an `html` column, which `parallel_simplify` 
+    then uses instead of preprocessing the pages again.
+    '''
+    with instrument.span('read_warc') as span:
+        if by_offset:
+            print('indexing warc file...')
+            df_records = archive.ArchiveManager().index_records(warc_file, n_jobs=n_jobs)
+            keep_cols = ['status','content_length','warc_file','offset']
+        else:
+            print('processing warc file...')
+            df_records = archive.ArchiveManager().to_dataframe(warc_file, n_jobs=n_jobs)
+            keep_cols = ['status','content_length','content']
+        span.set_items(len(df_records))
+    instrument.set_items(len(df_records))
+    
+    templates = _learn_templates(df_records, by_offset, n_jobs, templates_outpath) if strip_templates else None
+    gp = get_parser(tag_transform, text_only, preprocess_engine, templates=templates, keep_preprocessed=keep_preprocessed)
+    
+    print('parsing html content...')
+    with instrument.span('parse', items=len(df_records)):
+        if cache_path is not None:
+            parsed = parse_records_cached(gp, df_records, cache_path, by_offset=by_offset, n_jobs=n_jobs)
+        else:
+            parsed = _parse_records(gp, df_records, by_offset=by_offset, n_jobs=n_jobs)
+    
+    print(gp.preprocess_stats.report())
+    df_textracts = pd.concat([df_records[keep_cols], pd.DataFrame(parsed)], axis=1)
+    
+    return postprocess_textracts(df_textracts, tag_transform, max_status, min_term_count, 
+                                 term_languages=term_languages, term_features=term_features, n_jobs=n_jobs)
+
+
+# nested parse outputs, stored as json strings since their structure varies between records and chunks
+JSON_COLUMNS = ['images', 'links', 'link_texts']
+
+
+@instrument.spanned()
+def warc_to_parquet(warc_file='../data/interim/merged.warc.gz', dataset_dir='../data/interim/textracts', chunk_size=2000, 
+                    tag_transform='reduce', text_only=True, max_status=399, min_term_count=0, n_jobs=-5, 
+                    preprocess_engine='legacy', cache_path=None, strip_templates=False, templates_outpath=None, keep_preprocessed=False, 
+                    term_languages=('en',), term_features=False):
+    '''Streaming `warc_to_dftext` that writes each chunk of records to a Parquet dataset as it is finished.
+
+    Only record headers (see `ArchiveManager.index_records`) are held for the whole archive. Each chunk of chunk_size records 
+    is read and parsed by workers (as with by_offset=True), postprocessed, written to dataset_dir/part-NNNNN.parquet and released. 
+    Chunks already written are skipped, so an interrupted run resumes at the first missing chunk. Rerunning with different 
+    settings for an existing dataset_dir raises a ValueError. Read the dataset back with `read_textracts`.
+    
+    Returns:
+        Path: dataset_dir
+    '''
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    
+    settings = {'warc_file': Path(warc_file).resolve().as_posix(), 'chunk_size': chunk_size, 'tag_transform': tag_transform, 
+                'text_only': text_only, 'max_status': max_status, 'min_term_count': min_term_count, 
+                'preprocess_engine': preprocess_engine, 'strip_templates': strip_templates, 'keep_preprocessed': keep_preprocessed, 
+                'term_languages': list(term_languages), 'term_features': term_features}
+    settings_file = dataset_dir/'_settings.json'
+    if settings_file.exists():
+        prev_settings = json.loads(settings_file.read_text())
+        if prev_settings != settings:
+            raise ValueError(f'{dataset_dir} was written with different settings {prev_settings}, use a new dataset_dir')
+    else:
+        settings_file.write_text(json.dumps(settings, indent=1))
+    
+    print('indexing warc file...')
+    df_records = archive.ArchiveManager().index_records(warc_file, n_jobs=n_jobs)
+    n_chunks = -(-len(df_records)//chunk_size)
+    chunk_files = [dataset_dir/f'part-{i:05d}.parquet' for i in range(n_chunks)]
+    todo = [i for i,f in enumerate(chunk_files) if not f.exists()]
+    print(f'{len(df_records)} records in {n_chunks} chunks, {n_chunks-len(todo)} already written')
+    instrument.set_items(len(df_records))
+    if not todo:
+        return dataset_dir
+
+    if strip_templates and templates_outpath is not None and Path(templates_outpath).exists():
+        templates = HostTemplates.load(templates_outpath) # same templates as the chunks already written
+    elif strip_templates:
+        templates = _learn_templates(df_records, by_offset=True, n_jobs=n_jobs, templates_outpath=templates_outpath)
+    else:
+        templates = None
+    gp = get_parser(tag_transform, text_only, preprocess_engine, templates=templates, keep_preprocessed=keep_preprocessed)
+    
+    for i in todo:
+        df_chunk = df_records.iloc[i*chunk_size:(i+1)*chunk_size].reset_index(drop=True)
+        print(f'chunk {i+1}/{n_chunks}: parsing {len(df_chunk)} records...')
+        with instrument.span('parse', items=len(df_chunk)):
+            if cache_path is not None:
+                parsed = parse_records_cached(gp, df_chunk, cache_path, by_offset=True, n_jobs=n_jobs)
+            else:
+                parsed = _parse_records(gp, df_chunk, by_offset=True, n_jobs=n_jobs)
+        
+        df_textracts = pd.concat([df_chunk[['status','content_length','warc_file','offset']], pd.DataFrame(parsed)], axis=1)
+        del parsed
+        df_textracts = postprocess_textracts(df_textracts, tag_transform, max_status, min_term_count, verbose=False, 
+                                             term_languages=term_languages, term_features=term_features, n_jobs=n_jobs)
+        for col in df_textracts.columns.intersection(JSON_COLUMNS):
+            df_textracts[col] = df_textracts[col].map(json.dumps)
+        
+        # write then rename, so a chunk file exists only once complete
+        tmp_file = chunk_files[i].with_name(f'.{chunk_files[i].name}.tmp') # hidden from parquet readers
+        df_textracts.to_parquet(tmp_file, index=False)
+        tmp_file.replace(chunk_files[i])
+        del df_textracts
+    
+    print(gp.preprocess_stats.report())
+    return dataset_dir
+
+
+def read_textracts(dataset_dir='../data/interim/textracts', columns=None, filters=None):
+    '''Read a dataset written by `warc_to_parquet` as the equivalent `warc_to_dftext(by_offset=True)` dataframe.
+    JSON encoded columns are decoded back, with tuples as lists.'''
+    df_textracts = pd.read_parquet(dataset_dir, columns=columns, filters=filters)
+    for col in df_textracts.columns.intersection(JSON_COLUMNS):
+        df_textracts[col] = df_textracts[col].map(json.loads)
+    return df_textracts
+
+
+def update_gafile(ga_file, manifest):
+    '''Processed GA posts, reprocessing only posts that are new or changed since the last run (see `manifest.BuildManifest`).
+    Posts keep their ptid between runs. Posts repeated in the file are kept once.'''
+    posts = {}
+    for post in greatami.flatten_gadata(ga_file):
+        posts.setdefault(greatami.post_key(post), post)
+    posts = list(posts.values())
+    digests = {greatami.post_key(post):post_digest(post) for post in posts}
+    changed = [post for post in posts if manifest.post_digests.get(greatami.post_key(post)) != digests[greatami.post_key(post)]]
+    changed_keys = {greatami.post_key(post) for post in changed}
+    
+    df_gaf = manifest.read_gaf()
+    if df_gaf is not None:
+        # keep only unchanged posts, by ptid since posts without a link are keyed by digest
+        unchanged_ptids = [manifest.ptid_map[key] for key in digests if key not in changed_keys]
+        df_gaf = df_gaf[df_gaf.ptid.isin(unchanged_ptids)]
+    print(f'{len(changed)} of {len(posts)} posts new or changed')
+    
+    if changed:
+        df_changed = greatami.process_posts(changed, greatami.assign_ptids(changed, manifest.ptid_map))
+        df_gaf = pd.concat([df_gaf, df_changed]) if df_gaf is not None else df_changed
+        df_gaf = df_gaf.sort_values('ptid').reset_index(drop=True)
+        manifest.write_gaf(df_gaf)
+    
+    manifest.post_digests = digests
+    return df_gaf
+
+
+@instrument.spanned()
+def update_textracts(warc_file, manifest, tag_transform='reduce', text_only=True, max_status=399, min_term_count=0, n_jobs=-5, 
+                     preprocess_engine='legacy', cache_path=None, strip_templates=False, templates_outpath=None, keep_preprocessed=False):
+    '''Text extracts of all response records of warc_file, parsing only records not parsed in a previous run (see `manifest.BuildManifest`).
+    
+    Records are identified by url, payload digest and length, so pages whose content changed are parsed again and pages 
+    no longer in the archive are dropped. warc_file and offset are taken from the current index, so the archive can be 
+    rebuilt (e.g. merged again with new crawls) between runs. Templates are kept between runs, and learned on each run for hosts 
+    that have none yet (see `HostTemplates.unfitted_hosts`). Records of hosts that get a new template are parsed again.
+    If templates_outpath is given, the templates are also saved there for `parallel_simplify`. All records are parsed again 
+    when the settings or the parser fingerprint (parsing code and library versions, see `cache.parser_fingerprint`) change.
+    Each row also gets the MinHash signature of its text (see `dedup.minhash_signatures`) as bytes in a `minhash` column.
+    '''
+    # the parser fingerprint covers the parsing code and library versions, learned templates are handled per host below
+    parser = parser_fingerprint(get_parser(tag_transform, text_only, preprocess_engine, keep_preprocessed=keep_preprocessed))
+    manifest.check_settings({'tag_transform': tag_transform, 'text_only': text_only, 'max_status': max_status, 'min_term_count': min_term_count, 
+                             'preprocess_engine': preprocess_engine, 'strip_templates': strip_templates, 'keep_preprocessed': keep_preprocessed,
+                             'parser': parser})
+    
+    print('indexing warc file...')
+    df_records = archive.ArchiveManager().index_records(warc_file, n_jobs=n_jobs)
+    df_records['record_key'] = record_keys(df_records)
+    is_new = ~np.isin(df_records['record_key'], manifest.processed_keys())
+    
+    templates = manifest.read_templates() if strip_templates else None
+    if strip_templates:
+        templates = HostTemplates() if templates is None else templates
+        new_hosts = templates.unfitted_hosts(df_records['target_uri'])
+        if new_hosts:
+            _learn_templates(df_records, by_offset=True, n_jobs=n_jobs, templates=templates, hosts=new_hosts)
+            manifest.write_templates(templates)
+            # records of these hosts parsed in earlier runs were parsed without their template
+            is_new |= df_records['target_uri'].map(host_key).isin(new_hosts & templates.templates.keys()).values
+        if templates_outpath is not None:
+            templates.save(templates_outpath)
+    
+    df_new = df_records[is_new].drop_duplicates('record_key').reset_index(drop=True)
+    print(f'{len(df_new)} of {len(df_records)} records new or changed')
+    instrument.set_items(len(df_new))
+    
+    if len(df_new):
+        gp = get_parser(tag_transform, text_only, preprocess_engine, templates=templates, keep_preprocessed=keep_preprocessed)
+        
+        print('parsing html content...')
+        with instrument.span('parse', items=len(df_new)):
+            if cache_path is not None:
+                parsed = parse_records_cached(gp, df_new, cache_path, by_offset=True, n_jobs=n_jobs)
+            else:
+                parsed = _parse_records(gp, df_new, by_offset=True, n_jobs=n_jobs)
+        print(gp.preprocess_stats.report())
+        
+        df_textracts = pd.concat([df_new[['status','content_length','payload_digest','record_key']], pd.DataFrame(parsed)], axis=1)
+        del parsed
+        df_textracts = postprocess_textracts(df_textracts, tag_transform, max_status, min_term_count, n_jobs=n_jobs)
+        with instrument.span('minhash', items=len(df_textracts)):
+            signatures = dedup.minhash_signatures(df_textracts['text'], n_jobs=n_jobs)
+        df_textracts['minhash'] = [sig.tobytes() for sig in signatures]
+        for col in df_textracts.columns.intersection(JSON_COLUMNS):
+            df_textracts[col] = df_textracts[col].map(json.dumps)
+        manifest.add_records(df_textracts, df_new['record_key'])
+        del df_textracts
+    
+    df_textracts = manifest.read_textracts()
+    if df_textracts is None:
+        return None
+    for col in df_textracts.columns.intersection(JSON_COLUMNS):
+        df_textracts[col] = df_textracts[col].map(json.loads)
+    
+    # records still in the archive, located by the current index
+    df_locs = df_records[['record_key','warc_file','offset']].drop_duplicates('record_key')
+    df_textracts = df_textracts.merge(df_locs, on='record_key', how='inner')
+    manifest.log_run(new_records=len(df_new), records=len(df_records), textracts=len(df_textracts))
+    
+    return df_textracts
+
+
+@instrument.spanned()
+def build_masterframe(ga_file, warc_file, df_master_outfile=None, tag_transform='reduce', preprocess_engine='legacy', by_offset=False, cache_path=None, strip_templates=False, templates_outpath=None, textracts_dir=None, keep_preprocessed=False, near_dup_threshold=None, state_dir=None):
     ''' Build the final combined dataframe from the raw data files.
     
-    ga_file = '../data/interim/greatamigurumi.json'
+    ga_file = '../data/interim/greatamigurumi.jsonl'
     warc_file= '../data/interim/merged.warc.gz'
-    df_master_outfile = '../data/interim/df_master.pkl'
+    df_master_outfile = '../data/interim/df_master' # partitioned parquet dataset (see `dataset.write_master_dataset`), or a .pkl file
+    textracts_dir = '../data/interim/textracts' # if given, text extracts are built in chunks with `warc_to_parquet` (implies by_offset)
+    near_dup_threshold = 0.8 # if given, also keep one page per cluster of near duplicate texts (see `dedup.near_duplicate_clusters`)
+    state_dir = '../data/interim/build_state' # if given, only posts and records new since the last run are processed (see `update_textracts`, implies by_offset)
     '''
+    if state_dir is not None and textracts_dir is not None:
+        raise ValueError('state_dir and textracts_dir are exclusive, incremental builds keep text extracts in state_dir')
+    manifest = BuildManifest(state_dir) if state_dir is not None else None
+    
     print('Processing Great Amigurumi Files')
-    df_gaf = greatami.process_gafile(ga_file)
+    with instrument.span('process_gafile') as span:
+        df_gaf = update_gafile(ga_file, manifest) if manifest is not None else greatami.process_gafile(ga_file)
+        span.set_items(len(df_gaf))
 
     print('Transforming WARC Files into Text Extracts Dataframe')
-    df_textracts = warc_to_dftext(warc_file= warc_file, tag_transform=tag_transform, text_only=True, max_status=399, min_term_count=0)
+    if manifest is not None:
+        df_textracts = update_textracts(warc_file, manifest, tag_transform=tag_transform, text_only=True, max_status=399, min_term_count=0, preprocess_engine=preprocess_engine, cache_path=cache_path, strip_templates=strip_templates, templates_outpath=templates_outpath, keep_preprocessed=keep_preprocessed)
+    elif textracts_dir is not None:
+        warc_to_parquet(warc_file, textracts_dir, tag_transform=tag_transform, text_only=True, max_status=399, min_term_count=0, preprocess_engine=preprocess_engine, cache_path=cache_path, strip_templates=strip_templates, templates_outpath=templates_outpath, keep_preprocessed=keep_preprocessed)
+        df_textracts = read_textracts(textracts_dir)
+    else:
+        df_textracts = warc_to_dftext(warc_file= warc_file, tag_transform=tag_transform, text_only=True, max_status=399, min_term_count=0, preprocess_engine=preprocess_engine, by_offset=by_offset, cache_path=cache_path, strip_templates=strip_templates, templates_outpath=templates_outpath, keep_preprocessed=keep_preprocessed)
 
     print('Merging Dataframes')
-    df_master = df_textracts.merge(df_gaf.explode('text_links'), left_on='origurl', right_on='text_links')
+    with instrument.span('merge', items=len(df_textracts)):
+        df_master = df_textracts.merge(df_gaf.explode('text_links'), left_on='origurl', right_on='text_links')
+    
+    with instrument.span('dedup', items=len(df_master)):
+        # drop where text is identical
+        df_dedup = df_master.drop_duplicates('text')
+        # drop where url is repeated, accounting for web.archive.org urls
+        # prefering the highest crocheted term count followed by longest content length
+        df_dedup = df_dedup.sort_values(['origurl','term_count','content_length'], ascending=(True,False,False)).drop_duplicates('origurl',keep='first')
     
-    # drop where text is identical
-    df_dedup = df_master.drop_duplicates('text')
-    # drop where url is repeated, accounting for web.archive.org urls
-    # prefering the highest crocheted term count followed by longest content length
-    df_dedup = df_dedup.sort_values(['origurl','term_count','content_length'], ascending=(True,False,False)).drop_duplicates('origurl',keep='first')
+    if near_dup_threshold is not None:
+        # drop reposts, archived copies, and pages differing only by comments, with the same preference
+        print('Removing Near Duplicates')
+        with instrument.span('near_dedup', items=len(df_dedup)):
+            if 'minhash' in df_dedup:
+                # signatures stored by update_textracts
+                dup_cluster = dedup.lsh_clusters(np.stack(df_dedup['minhash'].map(lambda sig: np.frombuffer(sig, dtype=np.uint32))), near_dup_threshold)
+            else:
+                dup_cluster = dedup.near_duplicate_clusters(df_dedup['text'], threshold=near_dup_threshold)
+            df_dedup = df_dedup.assign(dup_cluster=dup_cluster).sort_values(['dup_cluster','term_count','content_length'], ascending=(True,False,False))
+            df_dedup = df_dedup.drop_duplicates('dup_cluster',keep='first').drop(columns='dup_cluster').sort_values('origurl')
+        print(f'{len(dup_cluster)-len(df_dedup)} near duplicates removed')
+    df_dedup = df_dedup.drop(columns=['record_key','minhash'], errors='ignore')
+    instrument.set_items(len(df_dedup))
 
     if df_master_outfile is not None:
-        df_dedup.to_pickle(df_master_outfile)
+        with instrument.span('write', items=len(df_dedup)):
+            if Path(df_master_outfile).suffix == '.pkl':
+                df_dedup.to_pickle(df_master_outfile)
+            else:
+                dataset.write_master_dataset(df_dedup, df_master_outfile)
+    if manifest is not None:
+        # saved last, an interrupted run is redone from the previous manifest
+        manifest.save()
 
     return df_dedup
 
 
-def write_json(df_dedup, outfile):
-    ''' Write the deduplicated dataframe to a json file for import into label-studio.'''
-    df_jsub = df_dedup[['ptid','text','post_title','languages','term_count','content_length','url']].copy()
-    dedupe_json = [{'data': rec } for rec in df_jsub.to_dict('records')]
+def write_json(df_dedup, outfile, fmt='json', batch_size=10000, shard_size=50000):
+    ''' Write the deduplicated dataframe to a json file for import into label-studio.
     
-    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    Records are serialized and written a batch at a time, so df_dedup can also be an iterable of dataframes 
+    (e.g. `dataset.iter_master(path, columns)`) that never has to fit in memory.
+
+    Args:
+        fmt (str, {json, ndjson}): one json list at outfile, or outfile/part-NNNNN.ndjson shards of shard_size records (default: 'json')
+    '''
+    json_cols = ['ptid','text','post_title','languages','term_count','content_length','url']
+    if fmt == 'ndjson':
+        with StagedWriter(outfile, fmt='ndjson', shard_size=shard_size) as writer:
+            for df_batch in iter_frames(df_dedup, batch_size):
+                writer.write_records({'data': rec} for rec in df_batch[json_cols].to_dict('records'))
+        return df_dedup
     
+    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    # same output as json.dump of the whole list
     with open(outfile,'w') as f:
-        json.dump(dedupe_json,f)
+        f.write('[')
+        sep = ''
+        for df_batch in iter_frames(df_dedup, batch_size):
+            records = df_batch[json_cols].to_dict('records')
+            if records:
+                f.write(sep + ', '.join(json.dumps({'data': rec}) for rec in records))
+                sep = ', '
+        f.write(']')
 
     return df_dedup
 
-def parallel_simplify(df_master_path='../data/interim/df_master.pkl', json_out_path='../data/staged/simphtml.json', n_jobs=-5):
-    df_master = pd.read_pickle(df_master_path)
-    hproc = parsehtml.HTMLProcessor()
+def _preprocess_record(hproc, warc_file, offset):
+    record = next(archive.read_records_at(warc_file, [offset]))
+    return hproc.preprocess(record['content'], record['target_uri'], to_soup=False)
+
+@instrument.spanned()
+def parallel_simplify(df_master_path='../data/interim/df_master', json_out_path='../data/staged/simphtml.json', n_jobs=-5, templates_path=None, simplifier='readability'):
+    '''Simplify pages to their main content and write them for label-studio.
+
+    Args:
+        simplifier (str, {readability, lxml}): Readability.js worker pool (`readability.ReadabilityPool`), 
+            or the in-process `parsehtml.extract_main_content` (default: 'readability')
+    '''
+    # only the columns needed for simplifying and write_json
+    with instrument.span('read_master'):
+        df_master = dataset.read_master(df_master_path, columns=[
+            'ptid','post_title','languages','term_count','content_length','url','html','content','warc_file','offset'])
+    instrument.set_items(len(df_master))
+    # host templates saved by warc_to_dftext(strip_templates=True) are stripped before readability
+    templates = HostTemplates.load(templates_path) if templates_path is not None else None
+    hproc = parsehtml.HTMLProcessor(templates=templates)
     
-    pre_parsed = Parallel(n_jobs)(delayed(hproc.preprocess)(c,u,to_soup=False) for c,u in tqdm(zip(df_master.content,df_master.url), total=len(df_master)))
+    with instrument.span('preprocess', items=len(df_master)):
+        if 'html' in df_master:
+            # preprocessed by warc_to_dftext(keep_preprocessed=True)
+            pre_parsed = df_master.pop('html').tolist()
+        elif 'content' in df_master:
+            pre_parsed = Parallel(n_jobs)(delayed(hproc.preprocess)(c,u,to_soup=False) for c,u in tqdm(zip(df_master.content,df_master.url), total=len(df_master)))
+        else:
+            # built with warc_to_dftext(by_offset=True), workers read content back from the archive
+            pre_parsed = Parallel(n_jobs)(delayed(_preprocess_record)(hproc,w,o) for w,o in tqdm(zip(df_master.warc_file,df_master.offset), total=len(df_master)))
 
     #readable_jsons = Parallel(n_jobs)(delayed(simplify_html)(c.decode()) for c in tqdm(pre_parsed))
-    simphtml_jsons = Parallel(n_jobs)(delayed(simple_json_from_html_string)(c.decode(), use_readability=True) for c in tqdm(pre_parsed))
+    with instrument.span('simplify', items=len(pre_parsed)):
+        if simplifier == 'lxml':
+            simphtml_jsons = Parallel(n_jobs, batch_size=32)(delayed(parsehtml.extract_main_content)(c) for c in tqdm(pre_parsed))
+        else:
+            with ReadabilityPool(n_jobs) as pool:
+                simphtml_jsons = pool.map((c.decode() if isinstance(c, bytes) else c for c in pre_parsed), total=len(pre_parsed))
     
     df_rdable = pd.DataFrame(simphtml_jsons, index=df_master.index)
     df_rdable['ttext'] = (('<h1><strong>'+df_rdable.title+'</strong></h1>')+df_rdable.content).fillna('')
     df_master['text'] = df_rdable['ttext']
-    write_json(df_master, json_out_path)
+    with instrument.span('write_json', items=len(df_master)):
+        write_json(df_master, json_out_path)
     
     return df_master
 
@@ -138,33 +520,26 @@ def text_filenames(df_ddjoined, ext='md'):
     return filenames
 
 
-def write_html(df_ddjoined, outdir='../data/staged/html/'):
-    filenames = text_filenames(df_ddjoined, ext='html')    
-    stpath = Path(outdir)
-    
-    for fname, text in tqdm(zip(filenames, df_ddjoined.text), total=len(filenames)):
-        stpath.joinpath(fname).write_text(text)
+def write_html(df_ddjoined, outdir='../data/staged/html/', fmt='files', n_threads=8, batch_size=10000):
+    '''Write each text as an html file in outdir, or bundled into outdir as a zip/tar/ndjson (see `stage.StagedWriter`).
+    df_ddjoined can also be an iterable of dataframes, written a batch at a time.'''
+    with StagedWriter(outdir, fmt=fmt, n_threads=n_threads) as writer:
+        for df_batch in tqdm(iter_frames(df_ddjoined, batch_size)):
+            writer.write(text_filenames(df_batch, ext='html'), df_batch.text)
     
     return df_ddjoined
 
 
-def write_markdown(df_ddjoined, outdir='../data/staged/'):
+def write_markdown(df_ddjoined, outdir='../data/staged/', fmt='files', n_threads=8, batch_size=10000):
+    '''Write each text with yaml front matter to outdir/<dirslug>/texts/, or bundled into outdir as a zip/tar/ndjson (see `stage.StagedWriter`).
+    df_ddjoined can also be an iterable of dataframes, written a batch at a time.'''
     # how to pandoc all markdown files to html for import into label studio  
     # for f in `ls ../*/*/*.md`; do pandoc -f markdown -t html "$f" -o ./$(basename "$f" .md).html; done
-    def _build_front_matter(row):
-        row_dict = {k:(v.item() if isinstance(v,np.integer) else v) for k,v in row.to_dict().items()}
-        return '---\n' + yaml.safe_dump(row_dict, default_flow_style=None, sort_keys=False, width=float("inf")) + '---\n\n'
-
-    filenames = text_filenames(df_ddjoined, 'md')
-
-    df_frontmatter = df_ddjoined[['title','post_title','raw_text','languages','tag_list','term_count','content_length','url']]
-    front_matter = df_frontmatter.apply(_build_front_matter, axis=1)
-    
-    stpath = Path(outdir)
-    
-    for slug, fname, text, fmatter in tqdm(zip(df_ddjoined.dirslug, filenames, df_ddjoined.text, front_matter),total=len(filenames)):
-        tpath = stpath.joinpath(slug,'texts')
-        tpath.mkdir(parents=True, exist_ok=True)
-        tpath.joinpath(fname).write_text(fmatter+text)
+    fm_cols = ['title','post_title','raw_text','languages','tag_list','term_count','content_length','url']
+    with StagedWriter(outdir, fmt=fmt, n_threads=n_threads) as writer:
+        for df_batch in tqdm(iter_frames(df_ddjoined, batch_size)):
+            front_matter = render_front_matter(df_batch[fm_cols])
+            names = df_batch.dirslug + '/texts/' + text_filenames(df_batch, 'md')
+            writer.write(names, [fmatter+text for fmatter,text in zip(front_matter, df_batch.text)])
     
     return df_ddjoined
\ No newline at end of file
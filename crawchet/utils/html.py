@@ -1,6 +1,39 @@
-import css_inline
-import minify_html as _minify_html
+import re
+import time
+import functools
+import urllib.parse
 import lxml.html
+import lxml.html.defs
+import lxml.etree
+
+from crawchet.utils.lazy import lazy_import
+
+css_inline = lazy_import('css_inline')
+_minify_html = lazy_import('minify_html')
+
+# css properties that affect text presentation, the only ones kept after inlining
+CSS_TEXT_STYLES = frozenset([
+    'font', 'font-style', 'font-weight', 'font-size',' font-varient', 
+    'text-decoration', 'text-decoration-line', 'text-decoration-color', 'text-decoration-style', 'text-decoration-thickness', 
+    'text-transform', 'color', 'background-color'])
+
+WHITESPACE_SENSITIVE_TAGS = frozenset(['pre', 'textarea', 'script', 'style'])
+BLOCK_TAGS = frozenset([
+    'html', 'head', 'body', 'div', 'p', 'ul', 'ol', 'li', 'dl', 'dt', 'dd',
+    'table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th', 'caption',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'hr', 'form', 'fieldset',
+    'section', 'article', 'header', 'footer', 'nav', 'aside', 'main', 'figure', 'figcaption',
+])
+
+RE_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+RE_CSS_AT_RULE = re.compile(r'@[^{};]*(?:;|\{(?:[^{}]*\{[^{}]*\})*[^{}]*\})')
+RE_CSS_RULE = re.compile(r'([^{}]+)\{([^{}]*)\}')
+RE_CSS_COMPOUND = re.compile(r'^(\*|[a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$')
+RE_HTML_WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+
+# where lxml's iterlinks finds links: link attributes, and links inside css, meta refresh, object and param
+XPATH_LINK_ATTRS = lxml.etree.XPath('|'.join(f'//@{a}' if ':' not in a else f'//@*[name()="{a}"]' for a in sorted(lxml.html.defs.link_attrs)))
+XPATH_LINK_ELEMENTS = lxml.etree.XPath('//*[contains(@style, "url(")]|//style|//meta|//object|//param')
 
 def html_minify(html_content:str, 
            do_not_minify_doctype=False,
@@ -117,4 +150,411 @@ def try_minify_html(html_content, errors='ignore', **kwargs):
         elif errors == 'raise':
             raise e
 
-    return html_content
\ No newline at end of file
+    return html_content
+
+
+def _handle_error(e, errors):
+    if errors == 'print':
+        print(e)
+    elif errors == 'raise':
+        raise e
+
+
+def _patterns(pattern, flags=0):
+    return {str: re.compile(pattern, flags), bytes: re.compile(pattern.encode(), flags)}
+
+# cheap checks on raw (str or bytes) page content that let a preprocessing stage be skipped
+RE_STYLE_TAG = _patterns(r'<style', re.IGNORECASE)
+RE_STYLESHEET_LINK = _patterns(r'<link[^>]*stylesheet', re.IGNORECASE)
+# whitespace between tags, comments, or <html>/<head> opening tags, none of which minify_html leaves behind.
+# Its output keeps closing tags, so a full document must also have </head>
+RE_UNMINIFIED = _patterns(r'>\s+<|<!--|<html[\s>]|<head[\s>]', re.IGNORECASE)
+RE_HEAD_CLOSE = _patterns(r'</head>', re.IGNORECASE)
+
+# each takes (content, url, fetch_remote_css)
+SKIP_CONDITIONS = {
+    'no_url': lambda content, url, fetch_remote_css=False: not url,
+    # linked stylesheets only count when they are fetched
+    'no_style': lambda content, url, fetch_remote_css=False: (RE_STYLE_TAG[type(content)].search(content) is None 
+                                                              and not (fetch_remote_css and RE_STYLESHEET_LINK[type(content)].search(content))),
+    'minified': lambda content, url, fetch_remote_css=False: (RE_HEAD_CLOSE[type(content)].search(content) is not None 
+                                      and RE_UNMINIFIED[type(content)].search(content) is None),
+}
+
+
+def _as_str(html_content):
+    return html_content.decode(errors='replace') if isinstance(html_content, bytes) else html_content
+
+
+def _stage_absolute_links(html_content, url, fetch_remote_css=False):
+    if not isinstance(html_content, bytes):
+        html_content = html_content.encode()
+    return lxml.html.make_links_absolute(html_content, base_url=url)
+
+
+def _stage_inline_css(html_content, url, fetch_remote_css=False):
+    html_content = _as_str(html_content)
+    if fetch_remote_css:
+        try:
+            return css_inline.inline(html_content, remove_style_tags=True, load_remote_stylesheets=True)
+        except Exception:
+            pass
+    return css_inline.inline(html_content, remove_style_tags=True, load_remote_stylesheets=False)
+
+
+def _stage_minify(html_content, url, fetch_remote_css=False):
+    return html_minify(_as_str(html_content), remove_bangs=False)
+
+
+# stage name: (function, default skip conditions)
+PREPROCESS_STAGES = {
+    'absolute_links': (_stage_absolute_links, ('no_url',)),
+    'inline_css': (_stage_inline_css, ('no_style',)),
+    'minify': (_stage_minify, ('minified',)),
+}
+DEFAULT_STAGES = ('absolute_links', 'inline_css', 'minify')
+
+
+class PreprocessStats:
+    '''Per-stage call, skip, and error counts and wall time of preprocessing'''
+    def __init__(self) -> None:
+        self.stages = {}
+
+    def record(self, stage, seconds=0.0, skipped=False, error=False):
+        st = self.stages.setdefault(stage, {'calls':0, 'skips':0, 'errors':0, 'seconds':0.0})
+        st['calls'] += 1
+        st['skips'] += skipped
+        st['errors'] += error
+        st['seconds'] += seconds
+
+    def merge(self, other):
+        for stage, ost in other.stages.items():
+            st = self.stages.setdefault(stage, {'calls':0, 'skips':0, 'errors':0, 'seconds':0.0})
+            for k,v in ost.items():
+                st[k] += v
+        return self
+
+    def report(self):
+        '''Table of where preprocessing time goes'''
+        total = sum(st['seconds'] for st in self.stages.values()) or 1.0
+        lines = [f'{"stage":<16}{"calls":>8}{"skips":>8}{"errors":>8}{"seconds":>10}{"ms/run":>8}{"share":>7}']
+        for stage, st in self.stages.items():
+            runs = st['calls'] - st['skips']
+            ms_run = 1000*st['seconds']/runs if runs else 0.0
+            lines.append(f'{stage:<16}{st["calls"]:>8}{st["skips"]:>8}{st["errors"]:>8}{st["seconds"]:>10.2f}{ms_run:>8.2f}{st["seconds"]/total:>7.1%}')
+        return '\n'.join(lines)
+
+
+class PreprocessPipeline:
+    '''String-to-string preprocessing stages (legacy engine) run in order, with per-stage timing and error counts.
+
+    A stage is skipped when any of its skip conditions (see SKIP_CONDITIONS) holds for the current content.
+    A failing stage passes its input on unchanged, as the try_* functions do.
+
+    Args:
+        stages (list): stage names from PREPROCESS_STAGES, or (name, skip_conditions) pairs to override 
+            the default conditions, e.g. [('absolute_links', ['no_url']), ('inline_css', []), 'minify'] (default: DEFAULT_STAGES)
+        errors (str, {ignore, print, raise}): How to handle stage errors (default: 'ignore')
+    '''
+    def __init__(self, stages=None, errors='ignore') -> None:
+        stages = DEFAULT_STAGES if stages is None else stages
+        self.stages = [(st, tuple(PREPROCESS_STAGES[st][1])) if isinstance(st, str) else (st[0], tuple(st[1])) for st in stages]
+        self.errors = errors
+        self.stats = PreprocessStats()
+
+    def __repr__(self) -> str:
+        # config only, stats excluded so that parser fingerprints are stable
+        return f'PreprocessPipeline(stages={self.stages!r}, errors={self.errors!r})'
+
+    def __call__(self, html_content, url=None, fetch_remote_css=False):
+        for name, skip_if in self.stages:
+            if any(SKIP_CONDITIONS[cond](html_content, url, fetch_remote_css) for cond in skip_if):
+                self.stats.record(name, skipped=True)
+                continue
+            
+            func = PREPROCESS_STAGES[name][0]
+            t0 = time.perf_counter()
+            try:
+                html_content = func(html_content, url, fetch_remote_css=fetch_remote_css)
+                self.stats.record(name, time.perf_counter()-t0)
+            except Exception as e:
+                self.stats.record(name, time.perf_counter()-t0, error=True)
+                _handle_error(e, self.errors)
+        
+        return _as_str(html_content)
+
+
+def _parse_selector(selector):
+    '''Parse a css selector made of tag/class/id compounds joined by descendant or child combinators.
+    
+    Returns:
+        tuple: ([(combinator, tag, ids, classes), ...] right-to-left, specificity), or (None, None) for 
+        anything else (pseudo-classes, attribute selectors, sibling combinators...)
+    '''
+    tokens = [t for t in re.split(r'\s*(>)\s*|\s+', selector.strip()) if t]
+    if not tokens or tokens[0] == '>' or tokens[-1] == '>':
+        return None, None
+    
+    compounds, combinator, specificity = [], ' ', [0,0,0]
+    for token in tokens:
+        if token == '>':
+            combinator = '>'
+            continue
+        
+        match = RE_CSS_COMPOUND.match(token)
+        if match is None or not any(match.groups()):
+            return None, None
+        
+        tag, quals = match.groups()
+        tag = tag.lower() if tag and tag != '*' else None
+        ids = frozenset(re.findall(r'#([\w-]+)', quals))
+        classes = frozenset(re.findall(r'\.([\w-]+)', quals))
+        specificity = [specificity[0]+len(ids), specificity[1]+len(classes), specificity[2]+(tag is not None)]
+        
+        compounds.append((combinator, tag, ids, classes))
+        combinator = ' '
+    
+    # combinator of each compound relates it to the compound on its left
+    return compounds[::-1], tuple(specificity)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_text_styles(css_text):
+    '''Parse a stylesheet into [(compounds, specificity, {property: declaration})], keeping only CSS_TEXT_STYLES properties.
+    At-rules (e.g. @media, @font-face) are ignored, as are selectors `_parse_selector` cannot handle.
+    Cached, since pages from the same site usually share a template stylesheet.'''
+    css_text = RE_CSS_AT_RULE.sub('', RE_CSS_COMMENT.sub('', css_text))
+    
+    rules = []
+    for selectors, block in RE_CSS_RULE.findall(css_text):
+        decls = {}
+        for decl in block.split(';'):
+            prop, _, value = decl.partition(':')
+            prop = prop.strip().lower()
+            if prop in CSS_TEXT_STYLES and value.strip():
+                # declarations are inlined as written, like css_inline does
+                decls[prop] = decl.strip()
+        if not decls:
+            continue
+        
+        for selector in selectors.split(','):
+            compounds, specificity = _parse_selector(selector)
+            if compounds is not None:
+                rules.append((compounds, specificity, decls))
+    
+    return rules
+
+
+def _element_index(ldoc):
+    '''One pass index of elements by tag, class and id for selector matching'''
+    by_tag, by_class, by_id = {}, {}, {}
+    for el in ldoc.iter(tag=lxml.etree.Element):
+        by_tag.setdefault(el.tag, []).append(el)
+        if 'id' in el.attrib:
+            by_id.setdefault(el.attrib['id'], []).append(el)
+        for cls in el.attrib.get('class', '').split():
+            by_class.setdefault(cls, []).append(el)
+    
+    return by_tag, by_class, by_id
+
+
+def _compound_matches(el, tag, ids, classes):
+    if tag is not None and el.tag != tag:
+        return False
+    if ids and el.get('id') not in ids:
+        return False
+    return not classes or classes.issubset(el.get('class', '').split())
+
+
+def _select(compounds, index):
+    '''Elements matching a parsed selector. Candidates come from the index using the rightmost compound, 
+    then ancestors are checked against the remaining compounds.'''
+    by_tag, by_class, by_id = index
+    _, tag, ids, classes = compounds[0]
+    if ids:
+        candidates = by_id.get(next(iter(ids)), [])
+    elif classes:
+        candidates = min((by_class.get(c, []) for c in classes), key=len)
+    elif tag is not None:
+        candidates = by_tag.get(tag, [])
+    else:
+        candidates = [el for els in by_tag.values() for el in els]
+    
+    matched = []
+    for el in candidates:
+        if not _compound_matches(el, tag, ids, classes):
+            continue
+        
+        node, ok = el, True
+        for (combinator, _, _, _), (_, atag, aids, aclasses) in zip(compounds[:-1], compounds[1:]):
+            if combinator == '>':
+                node = node.getparent()
+                ok = node is not None and _compound_matches(node, atag, aids, aclasses)
+            else:
+                node = next((a for a in node.iterancestors() if _compound_matches(a, atag, aids, aclasses)), None)
+                ok = node is not None
+            if not ok:
+                break
+        if ok:
+            matched.append(el)
+    
+    return matched
+
+
+def inline_text_styles(ldoc, remove_style_tags=True):
+    '''Tree pass equivalent of `try_inline_css` for the properties kept by text extraction. Modifies ldoc in-place.
+    Rules are applied in specificity, then document order. Existing inline styles take precedence.'''
+    style_tags = ldoc.xpath('//style')
+    rules = [rule for st in style_tags for rule in parse_text_styles(st.text_content())]
+    
+    if remove_style_tags:
+        for st in style_tags:
+            st.drop_tree()
+    
+    if not rules:
+        return ldoc
+    
+    index = _element_index(ldoc)
+    sheet_styles = {}
+    # python's sort is stable, so document order breaks specificity ties
+    for compounds, _, decls in sorted(rules, key=lambda r: r[1]):
+        for el in _select(compounds, index):
+            sheet_styles.setdefault(el, {}).update(decls)
+    
+    for el, decls in sheet_styles.items():
+        inline_style = el.get('style', '').strip().rstrip(';')
+        inline_props = {d.partition(':')[0].strip().lower() for d in inline_style.split(';')}
+        sheet_decls = [decl for k,decl in decls.items() if k not in inline_props]
+        el.set('style', ';'.join(filter(None, [*sheet_decls, inline_style])))
+    
+    return ldoc
+
+
+def _collapse_text(text, strip_start, strip_end):
+    if not text:
+        return text
+    if '  ' in text or '\n' in text or '\t' in text or '\r' in text or '\f' in text:
+        text = RE_HTML_WHITESPACE.sub(' ', text)
+    if strip_start:
+        text = text.lstrip(' ')
+    if strip_end:
+        text = text.rstrip(' ')
+    return text
+
+
+class _LinkCandidates:
+    '''Stand-in document for `lxml.html.HtmlMixin.rewrite_links`, listing the same links as lxml's iterlinks 
+    without looking up every link attribute on every element'''
+    def __init__(self, ldoc):
+        self.ldoc = ldoc
+
+    def iterlinks(self):
+        link_attrs = lxml.html.defs.link_attrs
+        for el in XPATH_LINK_ELEMENTS(self.ldoc):
+            # lxml's own rules on a childless copy, so only el's links are found
+            stand_in = lxml.html.Element(el.tag, dict(el.attrib))
+            stand_in.text = el.text
+            yield from ((el, attrib, link, pos) for _, attrib, link, pos in stand_in.iterlinks() 
+                        if el.tag == 'object' or attrib not in link_attrs)
+        for value in XPATH_LINK_ATTRS(self.ldoc):
+            el = value.getparent()
+            if el.tag != 'object':
+                yield (el, value.attrname, str(value), 0)
+
+
+def make_links_absolute(ldoc, base_url):
+    '''Tree pass equivalent to ldoc.make_links_absolute(base_url, handle_failures='ignore'). 
+    lxml looks up every link attribute on every element, this only visits the elements an xpath finds links on.
+    Modifies ldoc in-place.'''
+    def link_repl(href):
+        try:
+            return urllib.parse.urljoin(base_url, href)
+        except ValueError:
+            return href
+    ldoc.resolve_base_href(handle_failures='ignore')
+    lxml.html.HtmlMixin.rewrite_links(_LinkCandidates(ldoc), link_repl, resolve_base_href=False)
+    return ldoc
+
+
+def collapse_whitespace(ldoc):
+    '''Tree pass approximating `try_minify_html`: drop comments, collapse whitespace runs to a single space, 
+    and trim whitespace at the edges of block elements. Whitespace inside pre, textarea, script and style is kept.
+    Modifies ldoc in-place.'''
+    for com in ldoc.xpath('//comment()'):
+        com.drop_tree()
+    
+    # whitespace in <head> is never rendered, minify_html drops it
+    for head in ldoc.iter('head'):
+        for el in head.iter(tag=lxml.etree.Element):
+            if el.text is not None and el.text.isspace() and el.tag not in WHITESPACE_SENSITIVE_TAGS:
+                el.text = None
+            if el.tail is not None and el.tail.isspace():
+                el.tail = None
+    
+    preserved = {d for el in ldoc.iter(*WHITESPACE_SENSITIVE_TAGS) for d in el.iter()}
+    
+    # one walk, each node's text and tail are collapsed in the context of its children and of its parent and next sibling
+    for el in ldoc.iter():
+        tag = el.tag
+        text = el.text
+        if text and isinstance(tag, str) and tag != 'title' and el not in preserved:
+            is_block = tag in BLOCK_TAGS
+            first_is_block = len(el) > 0 and el[0].tag in BLOCK_TAGS
+            el.text = _collapse_text(text, is_block, (not len(el) and is_block) or first_is_block)
+        
+        # a tail belongs to the parent's content, so it is collapsed using the parent's context
+        tail = el.tail
+        if not tail:
+            continue
+        parent = el.getparent()
+        if parent is None or (parent in preserved and parent.tag not in WHITESPACE_SENSITIVE_TAGS):
+            continue
+        following = el.getnext()
+        end_is_block = following.tag in BLOCK_TAGS if following is not None else parent.tag in BLOCK_TAGS
+        el.tail = _collapse_text(tail, tag in BLOCK_TAGS, end_is_block)
+    
+    return ldoc
+
+
+def preprocess_tree(html_content, base_url=None, inline_css=True, minify=True, errors='ignore', stats=None):
+    '''Single parse alternative to try_make_absolutelinks -> try_inline_css -> try_minify_html.
+
+    The page is parsed once with lxml and each step is applied as a pass over the tree.
+    Only the css properties used in text extraction (CSS_TEXT_STYLES) are inlined, remote stylesheets are never fetched.
+    If stats (PreprocessStats) is given, the parse and each pass are timed and counted in it.
+    
+    Returns:
+        lxml.html.HtmlElement: the document root, or None if the content could not be parsed
+    '''
+    stats = PreprocessStats() if stats is None else stats
+    if isinstance(html_content, str):
+        html_content = html_content.encode()
+    
+    passes = [
+        ('absolute_links', lambda ldoc: make_links_absolute(ldoc, base_url), not base_url),
+        ('inline_css', lambda ldoc: inline_text_styles(ldoc, remove_style_tags=True), not inline_css or SKIP_CONDITIONS['no_style'](html_content, base_url)),
+        ('minify', collapse_whitespace, not minify),
+    ]
+    
+    t0 = time.perf_counter()
+    try:
+        ldoc = lxml.html.fromstring(html_content, base_url=base_url)
+        stats.record('parse', time.perf_counter()-t0)
+    except Exception as e:
+        stats.record('parse', time.perf_counter()-t0, error=True)
+        _handle_error(e, errors)
+        return None
+    
+    for name, tree_pass, skip in passes:
+        if skip:
+            stats.record(name, skipped=True)
+            continue
+        t0 = time.perf_counter()
+        try:
+            tree_pass(ldoc)
+            stats.record(name, time.perf_counter()-t0)
+        except Exception as e:
+            stats.record(name, time.perf_counter()-t0, error=True)
+            _handle_error(e, errors)
+    
+    return ldoc
@@ -0,0 +1,232 @@
+'''Named spans around pipeline stages, recording wall time, cpu time, item counts and memory, with a per-run JSON report.
+
+Spans are always recorded, a report is only written at exit when one of these environment variables is set:
+    CRAWCHET_REPORT_DIR: directory for the run report, <script>-<time>-<pid>.json (default: current directory)
+    CRAWCHET_PROFILE: cprofile, tracemalloc, or both comma separated. cprofile adds the top functions by cumulative time
+        to the report and saves the full stats next to it (.prof, for snakeviz/pstats). tracemalloc adds each span's peak
+        of python allocations (traced_peak_mb), at a large slowdown.
+
+cpu_s is this process only, work done in joblib workers shows in wall_s but not cpu_s.
+
+Example:
+    with instrument.span('parse', items=len(df_records)):
+        parsed = gp.parallel_parse(...)
+
+    @instrument.spanned('parallel_simplify')
+    def parallel_simplify(...):
+        ...
+        instrument.set_items(len(df_master))
+
+    CRAWCHET_PROFILE=cprofile CRAWCHET_REPORT_DIR=../data/logs python build_datasets.py
+'''
+import io
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import resource
+import functools
+import itertools
+import threading
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+PROFILE = {p.strip() for p in os.environ.get('CRAWCHET_PROFILE', '').lower().split(',') if p.strip()}
+REPORT_DIR = os.environ.get('CRAWCHET_REPORT_DIR')
+N_TOP_FUNCTIONS = 40
+
+
+def memory_mb():
+    '''(current, peak) resident memory of this process in MB'''
+    try:
+        status = Path('/proc/self/status').read_text()
+        rss, hwm = (int(re.search(rf'{k}:\s+(\d+) kB', status).group(1))/1024 for k in ('VmRSS', 'VmHWM'))
+        return rss, hwm
+    except (OSError, AttributeError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        return peak, peak
+
+
+class Span:
+    def __init__(self, name, parent=None, items=None) -> None:
+        self.name = name
+        self.parent = parent
+        self.path = name if parent is None else f'{parent.path}/{name}'
+        self.depth = 0 if parent is None else parent.depth+1
+        self.items = items
+        self.traced_peak = 0
+
+    def set_items(self, items):
+        self.items = items
+
+    def start(self):
+        self.start_time = time.time()
+        self.rss_start, _ = memory_mb()
+        if tracemalloc.is_tracing():
+            # fold the peak so far into the enclosing spans before measuring this one from zero
+            peak = tracemalloc.get_traced_memory()[1]
+            for outer in _enclosing(self.parent):
+                outer.traced_peak = max(outer.traced_peak, peak)
+            tracemalloc.reset_peak()
+        self._cpu0 = time.process_time()
+        self._t0 = time.perf_counter()
+
+    def stop(self, error=None):
+        wall = time.perf_counter()-self._t0
+        cpu = time.process_time()-self._cpu0
+        rss, peak_rss = memory_mb()
+        record = {'name': self.name, 'path': self.path, 'depth': self.depth,
+                  'start': datetime.fromtimestamp(self.start_time).isoformat(timespec='milliseconds'),
+                  'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4), 'items': self.items,
+                  'items_per_s': round(self.items/wall, 2) if self.items and wall else None,
+                  'rss_mb': round(rss, 1), 'rss_delta_mb': round(rss-self.rss_start, 1), 'peak_rss_mb': round(peak_rss, 1)}
+        if tracemalloc.is_tracing():
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None:
+                self.parent.traced_peak = max(self.parent.traced_peak, self.traced_peak)
+            record['traced_peak_mb'] = round(self.traced_peak/2**20, 1)
+        if error is not None:
+            record['error'] = type(error).__name__
+        return record
+
+
+def _enclosing(parent):
+    while parent is not None:
+        yield parent
+        parent = parent.parent
+
+
+class Recorder:
+    '''Finished span records of this process, and the open spans of each thread'''
+    def __init__(self) -> None:
+        self.records = []
+        self.start_time = datetime.now()
+        self.profiler = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def push(self, name, items=None):
+        new_span = Span(name, self.current(), items)
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(new_span)
+        # the start time, to the ms, can't order a parent, its children, and the spans started right after them
+        new_span.seq = next(self._sequence)
+        new_span.start()
+        return new_span
+
+    def pop(self, open_span, error=None):
+        record = {'seq': open_span.seq, **open_span.stop(error)}
+        self._local.stack.remove(open_span)
+        with self._lock:
+            self.records.append(record)
+
+    def ordered_records(self):
+        '''Records in the order their spans started, parents before the spans they enclose'''
+        return sorted(self.records, key=lambda r: r['seq'])
+
+    def summary(self):
+        '''Totals per span path, in order of first appearance'''
+        totals = {}
+        for rec in self.ordered_records():
+            tot = totals.setdefault(rec['path'], {'path': rec['path'], 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'items': 0, 'peak_rss_mb': 0.0})
+            tot['calls'] += 1
+            tot['wall_s'] = round(tot['wall_s']+rec['wall_s'], 4)
+            tot['cpu_s'] = round(tot['cpu_s']+rec['cpu_s'], 4)
+            tot['items'] += rec['items'] or 0
+            tot['peak_rss_mb'] = max(tot['peak_rss_mb'], rec['peak_rss_mb'])
+        return list(totals.values())
+
+    def report(self):
+        _, peak_rss = memory_mb()
+        report = {'argv': sys.argv, 'pid': os.getpid(), 'start': self.start_time.isoformat(timespec='seconds'),
+                  'end': datetime.now().isoformat(timespec='seconds'), 'peak_rss_mb': round(peak_rss, 1),
+                  'profile': sorted(PROFILE), 'summary': self.summary(),
+                  'spans': self.ordered_records()}
+        if self.profiler is not None:
+            report['top_functions'] = top_functions(self.profiler)
+        return report
+
+    def write_report(self, report_dir=None):
+        '''Write the run report (and cProfile stats if profiling) to report_dir, returns the report path'''
+        report_dir = Path(report_dir or REPORT_DIR or '.')
+        report_dir.mkdir(parents=True, exist_ok=True)
+        script = Path(sys.argv[0]).stem if sys.argv and sys.argv[0] else 'python'
+        report_path = report_dir/f'{script}-{self.start_time:%Y%m%d-%H%M%S}-{os.getpid()}.json'
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(report_path.with_suffix('.prof'))
+        report_path.write_text(json.dumps(self.report(), indent=1, default=str))
+        return report_path
+
+
+def top_functions(profiler, n=N_TOP_FUNCTIONS):
+    '''The n functions with the most cumulative time'''
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (file, line, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({'function': f'{func} ({file}:{line})', 'ncalls': ncalls, 'tottime_s': round(tottime, 4), 'cumtime_s': round(cumtime, 4)})
+    return sorted(rows, key=lambda r: r['cumtime_s'], reverse=True)[:n]
+
+
+RECORDER = Recorder()
+
+
+@contextmanager
+def span(name, items=None):
+    '''Record a named span, nested spans are recorded under their parent's path (e.g. warc_to_dftext/parse).
+
+    Args:
+        name (str): span name
+        items (int): number of items processed, can also be set later with `set_items` (default: None)
+    '''
+    current = RECORDER.push(name, items)
+    try:
+        yield current
+    except BaseException as e:
+        RECORDER.pop(current, e)
+        raise
+    RECORDER.pop(current)
+
+
+def spanned(name=None):
+    '''Decorator recording each call of a function as a span, named after the function by default'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_items(items):
+    '''Set the item count of this thread's innermost open span, if any'''
+    current = RECORDER.current()
+    if current is not None:
+        current.set_items(items)
+
+
+def write_report(report_dir=None):
+    return RECORDER.write_report(report_dir)
+
+
+# only the process that first imports this module reports, not the joblib workers that inherit its environment
+if (REPORT_DIR is not None or PROFILE) and os.environ.setdefault('CRAWCHET_REPORT_PID', str(os.getpid())) == str(os.getpid()):
+    if 'tracemalloc' in PROFILE and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if 'cprofile' in PROFILE:
+        RECORDER.profiler = cProfile.Profile()
+        RECORDER.profiler.enable()
+    atexit.register(RECORDER.write_report)
@@ -1,3 +1,4 @@
+import gzip
 from pathlib import Path
 from collections import OrderedDict
 
@@ -8,6 +9,13 @@ def resolve_path(path, as_str=True):
     return abspath
 
 
+def open_text(path, mode='r'):
+    '''Open a text file for reading or writing (mode r, w, a), gzip compressed if path ends in .gz'''
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode+'t', encoding='UTF-8')
+    return open(path, mode, encoding='UTF-8')
+
+
 def read_list(file_path, drop_duplicates=False):
     with open(file_path,'r') as f:
         url_list = f.read().splitlines()
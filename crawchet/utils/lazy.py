@@ -0,0 +1,78 @@
+import sys
+import types
+import functools
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    '''Stand-in for a module that is imported on first attribute access, then behaves as the module itself.
+
+    Unlike `importlib.util.LazyLoader`, nothing is added to sys.modules before first use, so packages that import
+    each other (pandas and pyarrow) never see a half loaded module, and dotted names load without their parents.
+    '''
+    def __init__(self, name) -> None:
+        super().__init__(name)
+
+    def _load(self):
+        module = importlib.import_module(self.__name__)
+        # later lookups find the attributes directly, as fast as on the module
+        self.__dict__.update(module.__dict__)
+        self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_module') or self._load()
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(self.__dict__.get('_module') or self._load())
+
+
+def lazy_import(name):
+    '''Module name, imported when first used. Returns the module itself if it was already imported.
+
+    Example:
+        pd = lazy_import('pandas')
+        pc = lazy_import('pyarrow.compute')
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+class LazyCallable:
+    '''Stand-in for a function or class that is imported when first called, then takes its metadata (see `functools.wraps`).
+
+    Pickles as its import path rather than as the target, so it can be sent to workers (e.g. in `joblib.delayed`)
+    before or after it was loaded, and stays lazy there.
+    '''
+    def __init__(self, module_name, name) -> None:
+        self._module_name = module_name
+        self._target = None
+        self.__name__ = self.__qualname__ = name
+        self.__module__ = module_name
+
+    def _load(self):
+        self._target = getattr(importlib.import_module(self._module_name), self.__name__)
+        functools.update_wrapper(self, self._target)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        target = self._target if self._target is not None else self._load()
+        return target(*args, **kwargs)
+
+    def __reduce__(self):
+        return (LazyCallable, (self._module_name, self.__name__))
+
+    def __repr__(self) -> str:
+        return f'<lazy {self._module_name}.{self.__name__}>'
+
+
+def lazy_callable(module_name, name):
+    '''Function or class name of module module_name, imported when first called.
+    Only for names that are just called, isinstance and subclassing need the object itself (use `lazy_import`).
+
+    Example:
+        Parallel = lazy_callable('joblib', 'Parallel')
+    '''
+    return LazyCallable(module_name, name)
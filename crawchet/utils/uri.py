@@ -1,8 +1,29 @@
 import re
+import functools
 from urllib import parse
 from pathlib import Path
 import lxml.html
 
+from crawchet.utils.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pc = lazy_import('pyarrow.compute')
+
+# per-url functions remember this many recent urls, links repeat a lot across pages
+URL_CACHE_SIZE = 2**16
+
+RE_PORT = re.compile(r':\d{1,5}/')
+RE_BLOGSPOT_SIZE = re.compile(r'/s\d{1,4}/', re.I)
+RE_IMAGE_EXT = re.compile(r'\.(jpe?g|png|gif|bmp|webp|avif)', re.I)
+RE_NOT_CANDIDATE = re.compile(r'^(?:javascript|mailto):.+|.*share.*', flags=re.I)
+
+# links containing any of these, lowercased, will not contain HTML crochet patterns
+URL_IGNORE = ['www.amazon','amzn.to','amzn.com','ravelry.com','greatamigurumi.blogspot','mailto:','drive.google.com','youtube.com','facebook.com']
+EXT_IGNORE = ['.pdf']#['.jpg','.png','.jpeg','.pdf','.gif','.bmp']
+RE_URL_IGNORE = re.compile('|'.join(map(re.escape, URL_IGNORE)))
+
 
 def get_original_url(wb_url, strip_port=True):
     '''Extract original url from web.archive.org link
@@ -11,13 +32,35 @@ def get_original_url(wb_url, strip_port=True):
     '''
     if not isinstance(wb_url, str) or 'archive.org' not in wb_url:
         return wb_url
-    
+    return _original_url(wb_url, strip_port)
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _original_url(wb_url, strip_port):
     url = ''.join(wb_url.partition('/http')[1:]).lstrip('/')
     if strip_port:
-        url = re.sub(r':\d{1,5}/', '/', url)
+        url = RE_PORT.sub('/', url)
 
     return url
 
+def canonicalize_url(url):
+    '''Canonical form of a url for deduplication. Unwraps web.archive.org links, ignores scheme, 
+    port, "www.", fragment, and trailing slashes, and sorts the query string.
+
+    https://web.archive.org/web/20221210031853/https://www.Example.com:80/a/?b=2&a=1#c -> http://example.com/a?a=1&b=2
+    '''
+    if not isinstance(url, str):
+        return url
+    return _canonical_url(url)
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _canonical_url(url):
+    parts = parse.urlsplit(fix_urlscheme(get_original_url(url, strip_port=True)).strip())
+    netloc = (parts.hostname or '').removeprefix('www.')
+    path = parts.path.rstrip('/') or '/'
+    query = parse.urlencode(sorted(parse.parse_qsl(parts.query, keep_blank_values=True)))
+    
+    return parse.urlunsplit(('http', netloc, path, query, ''))
+
 def blogspot_full_size(src):
     '''
     blogspot image process params info
@@ -25,7 +68,7 @@ def blogspot_full_size(src):
     - https://www.amp-blogger.com/2019/10/url-image-parameter-for-custom-blogger.html
     - https://gist.github.com/Sauerstoffdioxid/2a0206da9f44dde1fdfce290f38d2703
     '''
-    return re.sub(r'/s\d{1,4}/', r'/s0/', src, flags=re.I)
+    return RE_BLOGSPOT_SIZE.sub('/s0/', src)
 
 
 def fix_urlscheme(url):
@@ -44,16 +87,166 @@ def fix_urlscheme(url):
 
 def fix_imgurl(src, resize_archive_link=False):
     '''Fix common issues with image urls'''
-    src = fix_urlscheme(src)
-    
     if not isinstance(src,str):
         return src
+    return _fixed_imgurl(src, resize_archive_link)
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _fixed_imgurl(src, resize_archive_link):
+    src = fix_urlscheme(src)
     # if it's an archived image, then it's unlikely that we can get the full size image
     if 'archive.org' not in src or resize_archive_link:
         src = blogspot_full_size(src)
     
     return src
 
+def _to_arrow(urls):
+    '''Series of urls as a pyarrow string array for compute kernels, with a mask of the values that can take the fast path:
+    ascii strings (Python's re treats unicode digits and case differently than the kernels' re2). Others become null.'''
+    urls = pd.Series(urls, dtype=object)
+    is_str = urls.map(type).eq(str).values
+    arr = pa.array(urls.where(is_str, None), type=pa.string(), from_pandas=True)
+    fast = pc.fill_null(pc.string_is_ascii(arr), False).to_numpy(zero_copy_only=False)
+    return urls, pc.if_else(fast, arr, None), fast
+
+
+def _from_arrow(arr, urls, fast, orig_arr, slow_func):
+    '''urls with the values arr changed from orig_arr where fast, and slow_func of urls elsewhere.
+    Unchanged urls keep their original objects rather than being converted back from arrow.'''
+    out = urls.copy()
+    changed = pc.fill_null(pc.not_equal(arr, orig_arr), False).to_numpy(zero_copy_only=False)
+    if changed.any():
+        out[changed] = arr.filter(changed).to_numpy(zero_copy_only=False)
+    if not fast.all():
+        out[~fast] = [slow_func(url) for url in urls[~fast]]
+    return out
+
+
+def _replace_where(arr, mask, func):
+    '''arr with func applied to the values where mask, func only sees (and allocates for) those values'''
+    mask = pc.fill_null(mask, False)
+    if not pc.any(mask).as_py():
+        return arr
+    return pc.replace_with_mask(arr, mask, func(arr.filter(mask)))
+
+
+def _in_chunks(func, urls, chunk_size):
+    '''func of a Series of urls, computed once per distinct url, in chunks of chunk_size so the arrow buffers stay small.
+    The pool keeps freed buffers cached otherwise, adding to the peak memory of the python objects made after.'''
+    urls = pd.Series(urls, dtype=object)
+    codes, uniques = pd.factorize(urls)
+    uniques = pd.Series(uniques, dtype=object)
+    parts = []
+    for i in range(0, max(len(uniques), 1), chunk_size):
+        parts.append(func(uniques.iloc[i:i+chunk_size]).values)
+        pa.default_memory_pool().release_unused()
+    
+    is_null = codes == -1
+    values = np.concatenate(parts)[codes[~is_null]]
+    if not is_null.any():
+        return pd.Series(values, index=urls.index)
+    
+    # nulls (code -1) are passed through func as they are
+    null_values = func(urls[is_null]).values
+    out = np.empty(len(urls), dtype=np.result_type(values, null_values))
+    out[~is_null], out[is_null] = values, null_values
+    return pd.Series(out, index=urls.index)
+
+
+def _fix_urlschemes(arr):
+    # the prefixes are exclusive, and no fix produces another's prefix
+    arr = _replace_where(arr, pc.starts_with(arr, '//'), lambda a: pc.binary_join_element_wise('http:', a, ''))
+    arr = _replace_where(arr, pc.starts_with(arr, '://'), lambda a: pc.binary_join_element_wise('http', a, ''))
+    return _replace_where(arr, pc.starts_with(arr, 'hhttp'), lambda a: pc.utf8_slice_codeunits(a, 1))
+
+
+def _fix_urlschemes_chunk(urls):
+    urls, arr, fast = _to_arrow(urls)
+    return _from_arrow(_fix_urlschemes(arr), urls, fast, arr, fix_urlscheme)
+
+
+def fix_urlschemes(urls, chunk_size=50000):
+    '''fix_urlscheme of each url in a Series, with pyarrow compute kernels for ascii strings. Non-string values are kept as is.'''
+    return _in_chunks(_fix_urlschemes_chunk, urls, chunk_size)
+
+
+def _fix_imgurls_chunk(srcs, resize_archive_link):
+    srcs, arr, fast = _to_arrow(srcs)
+    fixed = _fix_urlschemes(arr)
+    resize = pc.match_substring_regex(fixed, r'/s\d{1,4}/', ignore_case=True)
+    if not resize_archive_link:
+        resize = pc.and_(resize, pc.invert(pc.match_substring(fixed, 'archive.org')))
+    resized = _replace_where(fixed, resize, lambda a: pc.replace_substring_regex(a, r'(?i)/s\d{1,4}/', '/s0/'))
+    return _from_arrow(resized, srcs, fast, arr, lambda src: fix_imgurl(src, resize_archive_link))
+
+
+def fix_imgurls(srcs, resize_archive_link=False, chunk_size=50000):
+    '''fix_imgurl of each url in a Series, with pyarrow compute kernels for ascii strings. Non-string values are kept as is.'''
+    return _in_chunks(lambda chunk: _fix_imgurls_chunk(chunk, resize_archive_link), srcs, chunk_size)
+
+
+def _are_imageurls_chunk(links):
+    links, arr, fast = _to_arrow(links)
+    plain = pc.and_(pc.match_substring_regex(arr, r'^(?:https?:)?//', ignore_case=True), 
+                    pc.invert(pc.match_substring_regex(arr, r'[\x00-\x20;]')))
+    fast &= pc.fill_null(plain, False).to_numpy(zero_copy_only=False)
+    # the extension is searched in the path only, after the netloc up to the query or fragment
+    is_img = pc.match_substring_regex(arr, r'^(?:https?:)?//[^/?#]*/[^?#]*\.(?:jpe?g|png|gif|bmp|webp|avif)', ignore_case=True)
+    
+    images = pd.Series(pc.fill_null(is_img, False).to_numpy(zero_copy_only=False) & fast, index=links.index)
+    slow = ~fast & links.map(type).eq(str).values
+    if slow.any():
+        images[slow] = [is_imageurl(link) for link in links[slow]]
+    return images
+
+
+def are_imageurls(links, chunk_size=50000):
+    '''is_imageurl of each link in a Series as a boolean Series, False for non-string values.
+    
+    Plain http(s) urls are matched by a regex kernel on their path. The few others (other schemes, whitespace, 
+    params, non-ascii) are left to urlparse through is_imageurl.
+    '''
+    return _in_chunks(_are_imageurls_chunk, links, chunk_size)
+
+
+def _original_urls(arr):
+    # everything up to the first "/http" is dropped, archive links without one become empty
+    has_http = pc.match_substring(arr, '/http')
+    after = pc.list_element(pc.split_pattern(pc.if_else(has_http, arr, '/http'), '/http', max_splits=1), 1)
+    return pc.if_else(has_http, pc.binary_join_element_wise('http', after, ''), '')
+
+
+def _get_original_urls_chunk(urls, strip_port):
+    urls, arr, fast = _to_arrow(urls)
+    original = _replace_where(arr, pc.match_substring(arr, 'archive.org'), 
+                              lambda a: pc.replace_substring_regex(_original_urls(a), RE_PORT.pattern, '/') if strip_port else _original_urls(a))
+    return _from_arrow(original, urls, fast, arr, lambda url: get_original_url(url, strip_port))
+
+
+def get_original_urls(urls, strip_port=True, chunk_size=50000):
+    '''get_original_url of each url in a Series, with pyarrow compute kernels for ascii strings. Non-string values are kept as is.'''
+    return _in_chunks(lambda chunk: _get_original_urls_chunk(chunk, strip_port), urls, chunk_size)
+
+
+def _link_filters_chunk(links):
+    links, arr, fast = _to_arrow(links)
+    lower = pc.ascii_lower(arr)
+    ignore = pc.match_substring_regex(lower, RE_URL_IGNORE.pattern)
+    for ext in EXT_IGNORE:
+        ignore = pc.or_(ignore, pc.ends_with(lower, ext))
+    
+    keep = ~pc.fill_null(ignore, True).to_numpy(zero_copy_only=False) & ~_are_imageurls_chunk(links).values & fast
+    slow = ~fast & links.map(type).eq(str).values
+    if slow.any():
+        keep[slow] = [link_filter(link) for link in links[slow]]
+    return pd.Series(keep, index=links.index)
+
+
+def link_filters(links, chunk_size=50000):
+    '''link_filter of each link in a Series as a boolean Series, False for non-string values'''
+    return _in_chunks(_link_filters_chunk, links, chunk_size)
+
+
 def url_to_fname(url):
     '''
     https://1.bp.blogspot.com/.../.../.../.../s0/graduation_exam_success_crochet_bear.jpg ->
@@ -77,9 +270,10 @@ def url_to_dirname(url):
     return dirname
 
 
-def url_ptid_filepath(url, ptid, base_dir, force_unique=False, as_str=True):
+def url_ptid_filepath(url, ptid, base_dir, force_unique=False, as_str=True, make_dirs=True):
     out_path = Path(base_dir).joinpath(ptid)
-    out_path.mkdir(parents=True, exist_ok=True)
+    if make_dirs:
+        out_path.mkdir(parents=True, exist_ok=True)
     filename = url_to_fname(url)
     filepath = out_path.joinpath(filename)
     if filepath.exists() and force_unique:
@@ -91,30 +285,25 @@ def url_ptid_filepath(url, ptid, base_dir, force_unique=False, as_str=True):
     return filepath
 
 
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
 def is_imageurl(link):
     linkpath = parse.urlparse(link).path
-    match = re.search(r'\.(jpe?g|png|gif|bmp|webp|avif)', linkpath, re.I)
-    return match is not None
+    return RE_IMAGE_EXT.search(linkpath) is not None
 
 
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
 def link_filter(link):
     '''Filter out images and links that will not contain HTML crochet patterns like youtube, amazon, ravelry...'''
-    # TODO: use regex if faster/simpler
-    url_ignore = ['www.amazon','amzn.to','amzn.com','ravelry.com','greatamigurumi.blogspot','mailto:','drive.google.com','youtube.com','facebook.com']
-    ext_ignore = ['.pdf']#['.jpg','.png','.jpeg','.pdf','.gif','.bmp']
     llink = link.lower()
-    return not (any(dom in llink for dom in url_ignore) or is_imageurl(llink) or any(llink.endswith(ext) for ext in ext_ignore))
+    return not (RE_URL_IGNORE.search(llink) is not None or is_imageurl(llink) or llink.endswith(tuple(EXT_IGNORE)))
 
 
 def is_link_candidate(link_tup, keep_img=True):
     '''Return if is potentially useful link given tuple of (element, attribute, link, pos) from lxml iterlinks'''
-    rgx = re.compile(r'^(?:javascript|mailto):.+|.*share.*', flags=re.I)
-
     element, attribute, link, pos = link_tup
     
-    proper_link = element.tag in ['a']+(['img'] if keep_img else []) # ignore script, link, iframe 
-    proper_link &= (rgx.search(link) is None) # ignore onclick js, emails, share links
-    return proper_link
+    proper_link = element.tag == 'a' or (keep_img and element.tag == 'img') # ignore script, link, iframe 
+    return proper_link and RE_NOT_CANDIDATE.search(link) is None # ignore onclick js, emails, share links
 
 def classify_links(link_tups, host_name):
     '''Return dict of link and boolean properties for filtering'''
@@ -49,7 +49,7 @@ def crawl_save_warc(url_list, outfile):
 
 if __name__ == '__main__':
     urlfile_path = ioutil.resolve_path('../data/raw/urls/')
-    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.json')
+    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.jsonl')
 
     urllist_path = os.path.join(urlfile_path,'url_list.txt')
     wb_urllist_path = os.path.join(urlfile_path,'archive_url_list.txt')
@@ -4,21 +4,31 @@ from crawchet.process import transform
 
 def get_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gafile', type=str, default='../data/interim/greatamigurumi.json')
-    parser.add_argument('--warc', type=str, default='../data/interim/merged.warc.gz')
-    parser.add_argument('--df_out', type=str, default='../data/interim/df_master.pkl')
+    parser.add_argument('--gafile', type=str, default='../data/interim/greatamigurumi.jsonl')
+    parser.add_argument('--warc', type=str, default='../data/raw/pages/merged.warc.gz')
+    parser.add_argument('--df_out', type=str, default='../data/interim/df_master', help='parquet dataset directory, or a .pkl file')
     parser.add_argument('--simphtml_out', type=str, default='../data/staged/simphtml.json')
     parser.add_argument('--tag_transform', type=str, default='fast')
     parser.add_argument('--text_only', type=bool, default=True)
     parser.add_argument('--max_status', type=int, default=399)
     parser.add_argument('--min_term_count', type=int, default=0)
+    parser.add_argument('--preprocess_engine', type=str, default='legacy', choices=['legacy','tree'])
+    parser.add_argument('--parse_cache', type=str, default=None, help='sqlite file caching parse outputs by payload digest, e.g. ../data/interim/parse_cache.sqlite')
+    parser.add_argument('--templates_out', type=str, default=None, help='learn per-host page templates and strip them before extraction, saved here e.g. ../data/interim/templates.pkl')
+    parser.add_argument('--textracts_dir', type=str, default=None, help='build text extracts in resumable parquet chunks here, e.g. ../data/interim/textracts')
+    parser.add_argument('--keep_preprocessed', action='store_true', help='keep preprocessed html in df_master so simplifying does not preprocess again')
+    parser.add_argument('--simplifier', type=str, default='readability', choices=['readability','lxml'], help='main content extractor for simphtml_out')
+    parser.add_argument('--near_dup_threshold', type=float, default=None, help='also drop near duplicate texts with estimated Jaccard similarity at least this, e.g. 0.8')
+    parser.add_argument('--state_dir', type=str, default=None, help='build incrementally, processing only posts and records new since the last run, e.g. ../data/interim/build_state')
+    parser.add_argument('--by_offset', action='store_true', help='workers read records from the WARC by offset, content is not kept in df_master')
     return parser
 
 if __name__ == '__main__':
     args = get_parser().parse_args()
     #df = transform.warc_to_dftext(args.warc, args.tag_transform, args.text_only, args.max_status, args.min_term_count)
     
-    df_master = transform.build_masterframe(args.gafile, args.warc, args.df_out, args.tag_transform)
-    df_master = transform.parallel_simplify(args.df_out, args.simphtml_out, n_jobs=-5)
+    df_master = transform.build_masterframe(args.gafile, args.warc, args.df_out, args.tag_transform, args.preprocess_engine, args.by_offset, args.parse_cache, 
+                                           strip_templates=args.templates_out is not None, templates_outpath=args.templates_out, textracts_dir=args.textracts_dir, keep_preprocessed=args.keep_preprocessed, near_dup_threshold=args.near_dup_threshold, state_dir=args.state_dir)
+    df_master = transform.parallel_simplify(args.df_out, args.simphtml_out, n_jobs=-5, templates_path=args.templates_out, simplifier=args.simplifier)
     
     #df.to_csv('../data/interim/df_textracts.csv', index=False)
\ No newline at end of file
@@ -1,47 +1,16 @@
 import os
 import json
+import argparse
 import asyncio
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import requests
 import lxml.html
-from tqdm.auto import tqdm
 
-from crawchet.utils import uri as uutil, io as ioutil
+from crawchet.utils import uri as uutil, io as ioutil, instrument
 from crawchet.process import greatami
-from crawchet.collect.crawl import ImageAsyncCrawler
-
-
-def dl_greatami_imgs(ga_file, base_outdir, overwrite=False):
-    df_gaf = greatami.process_gafile(ga_file=ga_file)
-    df_gaimgs = greatami.extract_img_links(df_gaf)
-    
-    with requests.Session() as session:
-        
-        for img_url,ptid in tqdm(zip(df_gaimgs.imgurl, df_gaimgs.ptid), total=len(df_gaimgs)):    
-            filepath = uutil.url_ptid_filepath(img_url, ptid, base_outdir, force_unique=False, as_str=False)    
-            if not filepath.exists() or overwrite:
-                try:
-                    filepath.write_bytes(session.get(img_url).content)
-                    print('wrote to:', filepath.as_posix())
-                except Exception as e:
-                    print(f'Failed: {img_url}\n Reason: {e}',img_url)
-
-
-def write_image(url, ptid, content, base_outdir):
-    try:
-        filepath = uutil.url_ptid_filepath(url, ptid, base_outdir)
-        with open(filepath, 'wb') as f:
-            f.write(content)
-    except Exception as e:
-        print(e)
-
-def write_images(out_results, base_outdir):
-    for url,ptid,content in tqdm(out_results):
-        if content is not None:
-            write_image(url, ptid, content, base_outdir)
+from crawchet.collect.crawl import ImageFileCrawler
 
 
 def extract_imgurls(simphtml_path):
@@ -51,36 +20,94 @@ def extract_imgurls(simphtml_path):
     df_imgs = df_readti[['text','ptid']].copy()
     
     df_imgs['imgurl'] = df_imgs['text'].apply(lambda htx: lxml.html.fromstring(htx).xpath('//img/@src') if htx else [])
-    df_imgs['imgurl'] = df_imgs['imgurl'].apply(lambda iurls: [*map(uutil.fix_imgurl,iurls)])
-    
-    df_imgs = df_imgs[['imgurl','ptid']].explode('imgurl').dropna().drop_duplicates('imgurl')
+    df_imgs = df_imgs[['imgurl','ptid']].explode('imgurl').dropna()
+    df_imgs['imgurl'] = uutil.fix_imgurls(df_imgs['imgurl']).values
+    df_imgs = df_imgs.drop_duplicates('imgurl')
     
     return df_imgs
 
 
-if __name__ == '__main__':
-    img_dir =  ioutil.resolve_path('../data/raw/images/')
-    simphtml_path = ioutil.resolve_path('../data/staged/simphtml.json')
-    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.json')
-
-    #dl_greatami_imgs(gafile_path, img_dir, overwrite=False)
-
-    df_gaimgs = greatami.extract_img_links(greatami.process_gafile(ga_file=gafile_path))
-    iac = ImageAsyncCrawler()
-    out_results = asyncio.get_event_loop().run_until_complete(iac.crawl_urls([*zip(df_gaimgs.imgurl, df_gaimgs.ptid)]))
-    
-    write_images(out_results, img_dir)
+def url_key(url):
+    try:
+        return uutil.canonicalize_url(url)
+    except ValueError: # malformed, e.g. bad ipv6 netloc
+        return url
+
+
+def collect_image_urls(ga_file=None, simphtml_path=None, exclude_urls=None):
+    '''Image urls and ptids of the GA posts, then of the simplified pages, each url kept once across both. 
+    Urls are compared by `uri.canonicalize_url`, so scheme, "www.", query order and archive.org wrapping don't matter. 
+    The first occurrence is kept, GA images first. Urls matching one of exclude_urls (e.g. already collected 
+    by a `--source ga` run) are dropped.'''
+    sources = []
+    if ga_file is not None:
+        sources.append(greatami.extract_img_links(greatami.process_gafile(ga_file=ga_file))[['imgurl','ptid']])
+    if simphtml_path is not None:
+        sources.append(extract_imgurls(simphtml_path)[['imgurl','ptid']])
     
-    df_imgs = extract_imgurls(simphtml_path)
-    iac = ImageAsyncCrawler()
-    out_results = asyncio.get_event_loop().run_until_complete(iac.crawl_urls([*zip(df_imgs.imgurl, df_imgs.ptid)]))
+    df_imgs = pd.concat(sources, ignore_index=True).dropna(subset='imgurl')
+    df_imgs['urlkey'] = df_imgs['imgurl'].map(url_key)
+    if exclude_urls is not None:
+        df_imgs = df_imgs[~df_imgs['urlkey'].isin(set(map(url_key, exclude_urls)))]
+    return df_imgs.drop_duplicates('urlkey').drop(columns='urlkey').reset_index(drop=True)
+
+
+def read_failed(base_outdir):
+    '''Urls recorded as failed by earlier downloads into base_outdir'''
+    records = [pd.read_csv(f) for f in Path(base_outdir).glob('*.csv')]
+    records = [df for df in records if {'imgurl','status'} <= set(df.columns)]
+    if not records:
+        return set()
+    df_records = pd.concat(records)
+    return set(df_records.loc[df_records.status=='failed', 'imgurl'])
+
+
+@instrument.spanned()
+def download_images(df_imgs, base_outdir, record_file, overwrite=False, retry_failed=False, max_tasks=200):
+    '''Download images (imgurl, ptid) into base_outdir/ptid/ in one crawl.
     
-    write_images(out_results, img_dir)
-
+    Images already on disk are skipped without a request, as are urls that failed before unless retry_failed, 
+    so downloading again only fetches what is new. Urls that would write the same file are fetched once. 
+    The status of each url (exists, skipped, duplicate, ok, failed) is written to record_file (csv).
+    '''
+    instrument.set_items(len(df_imgs))
+    df_imgs = df_imgs[['imgurl','ptid']].copy()
+    df_imgs['filepath'] = [uutil.url_ptid_filepath(url, ptid, base_outdir, make_dirs=False) for url,ptid in zip(df_imgs.imgurl, df_imgs.ptid)]
     
+    df_imgs['status'] = 'fetch'
+    df_imgs.loc[df_imgs.filepath.duplicated(), 'status'] = 'duplicate'
+    if not overwrite:
+        df_imgs.loc[[Path(p).is_file() for p in df_imgs.filepath], 'status'] = 'exists'
+        if not retry_failed:
+            df_imgs.loc[(df_imgs.status=='fetch') & df_imgs.imgurl.isin(read_failed(base_outdir)), 'status'] = 'skipped'
     
+    fetch = df_imgs.status=='fetch'
+    print(f'{fetch.sum()} of {len(df_imgs)} images to download ({(df_imgs.status=="exists").sum()} on disk, {(df_imgs.status=="skipped").sum()} failed before)')
+    if fetch.any():
+        crawler = ImageFileCrawler(max_tasks=max_tasks)
+        saved = asyncio.run(crawler.crawl_urls([*zip(df_imgs.imgurl[fetch], df_imgs.ptid[fetch], df_imgs.filepath[fetch])]))
+        df_imgs.loc[fetch, 'status'] = np.where(saved, 'ok', 'failed')
     
+    df_imgs.to_csv(record_file, index=False)
+    return df_imgs
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default='all', choices=['ga','pages','all'], help='images of the GA posts, of the simplified pages, or both')
+    parser.add_argument('--overwrite', action='store_true', help='download images even if already on disk')
+    parser.add_argument('--retry_failed', action='store_true', help='retry urls that failed in earlier runs')
+    parser.add_argument('--max_tasks', type=int, default=200, help='downloads in progress at once')
+    args = parser.parse_args()
     
-
+    img_dir =  ioutil.resolve_path('../data/raw/images/')
+    simphtml_path = ioutil.resolve_path('../data/staged/simphtml.json')
+    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.jsonl')
+    Path(img_dir).mkdir(parents=True, exist_ok=True)
+    
+    record_files = {'ga': 'greatamigurumi_images.csv', 'pages': 'page_images.csv', 'all': 'images.csv'}
+    # page images that a --source ga run already collected are left to it
+    ga_record_file = os.path.join(img_dir, record_files['ga'])
+    exclude_urls = pd.read_csv(ga_record_file)['imgurl'].dropna() if args.source == 'pages' and os.path.exists(ga_record_file) else None
+    df_imgs = collect_image_urls(gafile_path if args.source in ('ga','all') else None, simphtml_path if args.source in ('pages','all') else None, exclude_urls)
+    download_images(df_imgs, img_dir, os.path.join(img_dir, record_files[args.source]), args.overwrite, args.retry_failed, args.max_tasks)
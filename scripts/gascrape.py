@@ -1,4 +1,3 @@
-import json
 from pathlib import Path
 
 from crawchet.process import greatami
@@ -7,7 +6,7 @@ from crawchet.utils.io import resolve_path
 
 if __name__ == '__main__':
     warc_out = resolve_path('../data/raw/pages/greatamigurumi.warc.gz')
-    json_out = resolve_path('../data/interim/greatamigurumi.json')
+    json_out = resolve_path('../data/interim/greatamigurumi.jsonl')
     img_dir =  resolve_path('../data/raw/images/greatamigurumi/')
 
     Path(warc_out).parent.mkdir(parents=True, exist_ok=True)
@@ -15,8 +14,6 @@ if __name__ == '__main__':
     Path(img_dir).mkdir(parents=True, exist_ok=True)
     
     ga_scraper = scrape.GreatAmigurumiScraper()
-    gablog_data = ga_scraper.scrape(warc_out, timeout=1)
-    
-    with open(json_out,'w',encoding='UTF-8') as f:
-        json.dump(gablog_data, f)
+    n_posts = ga_scraper.scrape_jsonl(warc_out, json_out, timeout=1)
+    print(f'{n_posts} posts written to {json_out}')
     
\ No newline at end of file
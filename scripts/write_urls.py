@@ -54,7 +54,7 @@ if __name__ == '__main__':
 
     #wbpatches_file = Path('../data/raw/urls/only_wayback_patches.txt').resolve().as_posix()
     #wbreplace_warcout = Path('../data/raw/pages/only_wayback_replacements.warc.gz').resolve().as_posix()
-    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.json') 
+    gafile_path = ioutil.resolve_path('../data/interim/greatamigurumi.jsonl') 
     
     wb_resfile_out = os.path.join(url_dir, 'waybacklinks_result.json')  
     wburl_list_out = os.path.join(url_dir, 'archive_url_list.txt') #
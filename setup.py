@@ -5,6 +5,8 @@ setup(
     version='0.0.1',
     author='Rypo',
     packages=find_packages(),
+    package_data={'crawchet': ['process/js/*.js']},
+    entry_points={'console_scripts': ['crawchet=crawchet.pipeline:main']},
     description='Amigurumi crochet pattern crawler/scraper',
     url='',
 )
\ No newline at end of file
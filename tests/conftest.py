@@ -0,0 +1,59 @@
+import io
+
+import pytest
+from warcio.warcwriter import WARCWriter
+from warcio.statusandheaders import StatusAndHeaders
+
+
+def page_html(i, n_rounds=3):
+    rounds = '<br>'.join(f'Rnd {r}: sc in each st around ({6*r})' for r in range(1, n_rounds+1))
+    return (f'<html><head><title>Bear {i}</title></head><body><div class="post-body">'
+            f'<h3>Bear {i} free pattern</h3><p>Make a little bear with this free crochet pattern.</p><p>{rounds}</p>'
+            f'<img src="https://1.bp.blogspot.com/-x/s400/bear_{i}.jpg"></div></body></html>')
+
+
+def blog_page(host, i):
+    nav = '<ul class="nav"><li><a href="/">Home</a></li><li><a href="/about">About me</a></li></ul>'
+    sidebar = '<div id="sidebar"><h2>Popular posts</h2><p>Bunny, bear and cat patterns</p></div>'
+    footer = '<div id="footer"><p>All patterns (c) the author</p></div>'
+    post = f'<div class="post"><h3>Pattern {i}</h3><p>Rnd 1: {6+i} sc in magic ring</p><p>Rnd 2: inc x{6+i}</p></div>'
+    return f'<html><head><title>{host} {i}</title></head><body>{nav}<div id="main">{post}{sidebar}</div>{footer}</body></html>'
+
+
+def make_post(i, tags=(), n_items=2, raw_text=None):
+    parsed = [{'img_link': f'//1.bp.blogspot.com/-{i}/s400/bear_{i}_{j}.jpg' if j%2 else f'http://blog{i}.example.com/bear-{j}.html',
+               'img_attrs': {'src': f'https://1.bp.blogspot.com/-{i}/S1600/bear_{i}_{j}.png', 'alt': ''},
+               'text_link': f'//blog{i}.example.com/bear-{j}.html', 'text_desc': f'Bear {j}'} for j in range(n_items)]
+    return {
+        'post_date': 'Jan 01, 2022',
+        'header': {'title_text': f'Bear {i}', 'title_link': f'https://greatamigurumi.blogspot.com/2022/01/bear-{i}.html'},
+        'body': {'parsed': parsed,
+                 'raw_links': [p['text_link'] for p in parsed] + ['https://www.ravelry.com/patterns/bear.jpg?x=1'],
+                 'raw_images': [p['img_attrs']['src'] for p in parsed],
+                 'raw_text': raw_text if raw_text is not None else f'  Bear {i}   pattern \n in english  '},
+        'footer': [{'tag': tag, 'taglink': f'https://greatamigurumi.blogspot.com/search/label/{tag}'} for tag in tags]}
+
+
+def write_warc(warc_file, pages, gzip=True, with_requests=False):
+    '''Write (url, html) or (url, html, status) pages as response records, optionally each after its request record'''
+    with open(warc_file, 'wb') as f:
+        writer = WARCWriter(f, gzip=gzip)
+        for page in pages:
+            url, html, status = (*page, 200) if len(page) == 2 else page
+            if with_requests:
+                req_headers = StatusAndHeaders('GET / HTTP/1.1', [('Host', 'example.com')], is_http_request=True)
+                writer.write_record(writer.create_warc_record(url, 'request', http_headers=req_headers))
+            http_headers = StatusAndHeaders(f'{status} OK', [('Content-Type', 'text/html; charset=utf-8')], protocol='HTTP/1.1')
+            record = writer.create_warc_record(url, 'response', payload=io.BytesIO(html.encode()), http_headers=http_headers)
+            writer.write_record(record)
+    return warc_file
+
+
+@pytest.fixture
+def pages():
+    return [(f'http://blog{i%3}.example.com/2020/01/bear-{i}.html', page_html(i)) for i in range(12)]
+
+
+@pytest.fixture
+def warc_file(tmp_path, pages):
+    return write_warc(tmp_path/'pages.warc.gz', pages, with_requests=True)
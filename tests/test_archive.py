@@ -0,0 +1,147 @@
+import io
+import gzip
+import json
+
+from warcio.indexer import Indexer
+from warcio.archiveiterator import ArchiveIterator
+
+from crawchet.process import archive
+from conftest import page_html, write_warc
+
+
+def warcio_offsets(warc_file):
+    output = io.StringIO()
+    Indexer(['offset'], [str(warc_file)], output).process_all()
+    return [int(json.loads(line)['offset']) for line in output.getvalue().splitlines()]
+
+
+def test_scan_member_offsets_matches_warcio_index(warc_file):
+    offsets = archive.scan_member_offsets(warc_file)
+    assert offsets == warcio_offsets(warc_file)
+    assert len(offsets) == 24
+
+
+def test_member_start_needs_a_warc_record(warc_file):
+    buf = warc_file.read_bytes()
+    assert archive._is_member_start(buf, 0)
+    # gzip magic followed by junk, or by a gzip member that is not a WARC record
+    assert not archive._is_member_start(archive.GZIP_MAGIC + b'\x00'*64, 0)
+    assert not archive._is_member_start(gzip.compress(b'<html>not a record</html>'), 0)
+
+
+def test_scan_member_offsets_uncompressed(tmp_path, pages):
+    warc_file = write_warc(tmp_path/'pages.warc', pages, gzip=False)
+    assert archive.scan_member_offsets(warc_file) == [0]
+
+
+def test_read_index_offsets(tmp_path, warc_file):
+    index_file = tmp_path/'pages.idx'
+    with open(index_file, 'w') as f:
+        Indexer(['offset', 'warc-type'], [str(warc_file)], f).process_all()
+    assert archive.read_index_offsets(index_file) == warcio_offsets(warc_file)
+
+
+def test_split_byte_ranges_cover_file_on_offsets():
+    offsets = [0, 100, 250, 400, 800, 900]
+    ranges = archive.split_byte_ranges(offsets, 1000, 4)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 1000
+    assert all(e == s2 for (_, e), (s2, _) in zip(ranges[:-1], ranges[1:]))
+    assert all(s in offsets for s, _ in ranges)
+    assert archive.split_byte_ranges([0], 1000, 4) == [(0, 1000)]
+
+
+def test_parallel_parse_records_matches_sequential(warc_file):
+    arcm = archive.ArchiveManager(warc_file)
+    expected = arcm.parse_records()
+    assert len(expected) == 12
+    assert arcm.parallel_parse_records(n_jobs=2, chunks_per_job=3) == expected
+
+
+def test_read_records_at(warc_file):
+    with open(warc_file, 'rb') as stream:
+        arc_iter = ArchiveIterator(stream)
+        offsets = [arc_iter.get_record_offset() for record in arc_iter if record.rec_type == 'response']
+    expected = archive.ArchiveManager(warc_file).parse_records()
+    assert list(archive.read_records_at(warc_file, offsets[::-1])) == expected[::-1]
+
+
+def merge_inputs(tmp_path):
+    first = write_warc(tmp_path/'first.warc.gz', [('http://example.com/a.html', page_html(0)), ('http://example.com/b.html', page_html(1))], with_requests=True)
+    second = write_warc(tmp_path/'second.warc.gz', [
+        ('https://www.example.com/a.html', page_html(10)), # same canonical url as a first copy, dropped with its request
+        ('http://example.com/c.html', page_html(1)), # same payload as b, written as a revisit
+        ('http://example.com/d.html', page_html(3)),
+    ], with_requests=True)
+    return [first, second]
+
+
+def read_types(warc_file):
+    with open(warc_file, 'rb') as stream:
+        return [(r.rec_type, r.rec_headers.get_header('WARC-Target-URI')) for r in ArchiveIterator(stream)]
+
+
+def test_copy_merge_archives_dedup_and_revisit(tmp_path):
+    merged = tmp_path/'merged.warc.gz'
+    counts = archive.ArchiveManager().copy_merge_archives(merge_inputs(tmp_path), merged)
+    assert counts == {'copied': 7, 'revisit': 1, 'dropped': 2}
+    
+    records = read_types(merged)
+    assert [r for r in records if r[0] in ('response','revisit')] == [
+        ('response', 'http://example.com/a.html'), ('response', 'http://example.com/b.html'),
+        ('revisit', 'http://example.com/c.html'), ('response', 'http://example.com/d.html')]
+    
+    with open(merged, 'rb') as stream:
+        revisit = next(r for r in ArchiveIterator(stream) if r.rec_type == 'revisit')
+        assert revisit.rec_headers.get_header('WARC-Refers-To-Target-URI') == 'http://example.com/b.html'
+    
+    # copied members decode to the same records as the originals
+    parsed = archive.ArchiveManager(merged).parse_records()
+    assert [p['content'] for p in parsed] == [page_html(0).encode(), page_html(1).encode(), page_html(3).encode()]
+
+
+def test_copy_merge_archives_index(tmp_path):
+    merged = tmp_path/'merged.warc.gz'
+    archive.ArchiveManager().copy_merge_archives(merge_inputs(tmp_path), merged)
+    
+    entries = [json.loads(line) for line in open(f'{merged}.idx')]
+    assert [e['offset'] for e in entries] == warcio_offsets(merged)
+    assert sum(e['length'] for e in entries) == merged.stat().st_size
+    assert [e['warc-type'] for e in entries].count('revisit') == 1
+
+
+def test_merge_archives_rewrite_keeps_first_response(tmp_path):
+    merged = tmp_path/'merged.warc.gz'
+    archive.ArchiveManager().merge_archives(merge_inputs(tmp_path), merged)
+    # rewrite mode matches exact urls only and drops non-response records
+    assert read_types(merged) == [('response', u) for u in ['http://example.com/a.html', 'http://example.com/b.html', 
+                                                            'https://www.example.com/a.html', 'http://example.com/c.html', 'http://example.com/d.html']]
+
+
+def test_build_catalog_matches_records(tmp_path, warc_file, pages):
+    write_warc(tmp_path/'errors.warc.gz', [('http://blog9.example.com/gone.html', '<html>gone</html>', 404)])
+    catalog_path = tmp_path/'catalog.parquet'
+    df_cat = archive.ArchiveManager().build_catalog(tmp_path, catalog_path, n_jobs=2, chunks_per_job=3)
+    
+    assert df_cat.dtypes.astype(str).to_dict() == {**archive.CATALOG_DTYPES, 'date': 'datetime64[ns, UTC]'}
+    assert len(df_cat) == 2*len(pages)+1
+    assert set(df_cat.archive) == {'pages.warc.gz', 'errors.warc.gz'}
+    pages_cat = df_cat[df_cat.archive == 'pages.warc.gz']
+    assert pages_cat.offset.tolist() == warcio_offsets(warc_file)
+    
+    responses = df_cat[df_cat.warc_type == 'response']
+    assert sorted(responses.status.tolist()) == [200]*len(pages) + [404]
+    assert set(responses.mime) == {'text/html'}
+    assert set(responses.host.dropna()) == {'blog0.example.com', 'blog1.example.com', 'blog2.example.com', 'blog9.example.com'}
+    
+    df_read = archive.read_catalog(catalog_path, columns=['host','status'], filters=[('status', '=', 404)])
+    assert df_read.host.tolist() == ['blog9.example.com']
+
+
+def test_index_records_reads_back_as_to_dataframe(warc_file):
+    arcm = archive.ArchiveManager(warc_file)
+    df_full = arcm.to_dataframe()
+    df_index = arcm.index_records(n_jobs=1)
+    
+    assert df_index[['target_uri','content_length','status','payload_digest']].equals(df_full[['target_uri','content_length','status','payload_digest']])
+    contents = [r['content'] for r in archive.read_records_at(warc_file, df_index.offset)]
+    assert contents == df_full.content.tolist()
@@ -0,0 +1,66 @@
+import sys
+import urllib.request
+import urllib.error
+from pathlib import Path
+
+import lxml.html
+import pytest
+
+from crawchet.process import archive
+
+# the benchmark scripts import their helpers as top level modules, spawned benchmark processes inherit sys.path
+sys.path.insert(0, (Path(__file__).resolve().parents[1]/'benchmarks').as_posix())
+import harness, synthetic, bench_pipeline # noqa: E402
+
+
+def test_synthetic_page():
+    page = synthetic.synthetic_page(7, size=20_000)
+    assert page == synthetic.synthetic_page(7, size=20_000) != synthetic.synthetic_page(7, size=20_000, seed=1)
+    assert 20_000 <= len(page) < 21_000
+    ldoc = lxml.html.fromstring(page)
+    assert ldoc.findtext('.//title') == 'Amigurumi 7 free pattern'
+    assert 'Rnd ' in ldoc.find_class('post-body')[0].text_content()
+
+
+def test_write_synthetic_warc(tmp_path):
+    warc_file = tmp_path/'pages.warc.gz'
+    n_bytes = synthetic.write_synthetic_warc(warc_file, n_pages=40, page_size=2000, error_rate=0.25)
+    df_records = archive.ArchiveManager().index_records(warc_file, n_jobs=1)
+    assert df_records['target_uri'].tolist() == [synthetic.page_url(i) for i in range(40)]
+    assert df_records['status'].tolist() == [synthetic.page_status(i, 0.25)[0] for i in range(40)]
+    assert 0 < (df_records['status'] != 200).sum() < 40
+    records = archive.ArchiveManager().to_dataframe(warc_file)
+    assert sum(map(len, records['content'])) == n_bytes
+    assert records['content'][0].decode() == synthetic.synthetic_page(0, 2000)
+
+
+def test_stand_in_server():
+    statuses = [synthetic.page_status(i, 0.2)[0] for i in range(100)]
+    ok_page, error_page = statuses.index(200), next(i for i,s in enumerate(statuses) if s != 200)
+    with synthetic.StandInServer(page_size=3000, error_rate=0.2) as server:
+        with urllib.request.urlopen(server.url(ok_page)) as rsp:
+            body = rsp.read().decode()
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(server.url(error_page))
+        assert err.value.code == statuses[error_page]
+    assert body == synthetic.synthetic_page(ok_page, 3000)
+    assert server.bytes_served > len(body)
+
+
+def test_harness():
+    assert harness.peak_rss_mb() > 0
+    assert harness.throughput(2.0, 10, 4e6) == {'seconds': 2.0, 'n_pages': 10, 'mb': 4.0, 'pages_per_s': 5.0, 'mb_per_s': 2.0}
+    assert harness.throughput(0, 0, 0)['pages_per_s'] is None
+
+    result = harness.run_isolated(harness.throughput, seconds=1.0, n_pages=3, n_bytes=1e6)
+    assert result['pages_per_s'] == 3.0 and result['peak_rss_mb'] > 0 and 'total_s' in result
+    assert 'TypeError' in harness.run_isolated(harness.throughput, seconds=1.0)['error']
+
+
+def test_run_benchmarks():
+    report = bench_pipeline.run_benchmarks(['crawl', 'to_dataframe', 'parse_fast'], n_pages=20, page_size=3000, n_jobs=1, error_rate=0.1)
+    results = report['results']
+    assert not any('error' in r for r in results.values()), results
+    assert results['crawl']['n_pages'] == 20 and results['crawl']['hits'] == {'OK': 20, 'FAIL': 0}
+    assert results['to_dataframe']['n_pages'] == results['parse_fast']['n_pages'] == 20
+    assert results['parse_fast']['parser'] == 'FastParser'
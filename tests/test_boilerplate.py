@@ -0,0 +1,62 @@
+import lxml.html
+import pytest
+
+from crawchet.process import archive, boilerplate, parsehtml
+from conftest import write_warc, blog_page
+
+
+@pytest.fixture
+def host_pages():
+    pages = [(f'https://www.{host}/2020/{i}.html', blog_page(host, i)) for host in ['a.blogspot.com', 'b.blogspot.com'] for i in range(6)]
+    # too few pages to learn a template for
+    pages += [(f'https://c.blogspot.com/{i}.html', blog_page('c.blogspot.com', i)) for i in range(2)]
+    return pages
+
+
+def test_host_key():
+    assert boilerplate.host_key('https://web.archive.org/web/2022/https://www.example.com/a') == 'example.com'
+
+
+def test_block_hashes_ignore_attributes_and_whitespace():
+    a = lxml.html.fromstring('<div><div class="x" id="y"><p>Some   text</p><script>var a;</script><style>p{color:red}</style></div></div>')
+    b = lxml.html.fromstring('<div><div><p>Some text</p></div></div>')
+    assert set(boilerplate.block_hashes(a).values()) == set(boilerplate.block_hashes(b).values())
+    assert boilerplate.block_hashes(lxml.html.fromstring('<div><img src="a.jpg"></div>')) == {}
+
+
+def test_fit_and_strip(host_pages):
+    html_contents, urls = [html for _,html in host_pages], [url for url,_ in host_pages]
+    templates = boilerplate.HostTemplates(min_pages=5).fit(html_contents, urls, n_jobs=1)
+    assert set(templates.templates) == {'a.blogspot.com', 'b.blogspot.com'}
+
+    ldoc = lxml.html.fromstring(blog_page('a.blogspot.com', 99))
+    assert templates.strip(ldoc, 'http://a.blogspot.com/new.html') == 3
+    text = ldoc.text_content()
+    assert 'Rnd 1: 105 sc' in text and 'Pattern 99' in text
+    assert 'Popular posts' not in text and 'About me' not in text and '(c) the author' not in text
+
+    # hosts without a template are left alone
+    ldoc = lxml.html.fromstring(blog_page('c.blogspot.com', 0))
+    assert templates.strip(ldoc, 'https://c.blogspot.com/0.html') == 0
+
+
+def test_fit_records_matches_fit(tmp_path, host_pages):
+    warc_file = write_warc(tmp_path/'hosts.warc.gz', host_pages)
+    df_index = archive.ArchiveManager(warc_file).index_records(n_jobs=1)
+
+    from_records = boilerplate.HostTemplates().fit_records(zip(df_index.warc_file, df_index.offset), df_index.target_uri, batch_size=4, n_jobs=2)
+    from_pages = boilerplate.HostTemplates().fit([html for _,html in host_pages], [url for url,_ in host_pages], n_jobs=1)
+    assert from_records.templates == from_pages.templates
+    assert repr(from_records) == repr(from_pages)
+
+
+def test_parser_strips_templates_and_save_load(tmp_path, host_pages):
+    templates = boilerplate.HostTemplates().fit([html for _,html in host_pages], [url for url,_ in host_pages], n_jobs=1)
+    templates.save(tmp_path/'templates.pkl')
+    loaded = boilerplate.HostTemplates.load(tmp_path/'templates.pkl')
+    assert loaded.templates == templates.templates
+
+    url, html = host_pages[0]
+    for engine in ['legacy', 'tree']:
+        text = parsehtml.FastParser(preprocess_engine=engine, templates=loaded).parse_page(html, url)['text']
+        assert 'Rnd 1: 6 sc' in text and 'Popular posts' not in text
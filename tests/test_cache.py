@@ -0,0 +1,35 @@
+from crawchet.process import cache, parsehtml, boilerplate
+from crawchet.utils import uri as uutil
+
+
+def test_fingerprint_depends_on_settings():
+    fp = cache.parser_fingerprint(parsehtml.FastParser())
+    assert fp == cache.parser_fingerprint(parsehtml.FastParser())
+    assert fp != cache.parser_fingerprint(parsehtml.FastParser(tag_transform='reduce'))
+    assert fp != cache.parser_fingerprint(parsehtml.GenericParser())
+
+
+def test_fingerprint_depends_on_parsing_modules(monkeypatch, tmp_path):
+    parser = parsehtml.FastParser()
+    fp = cache.parser_fingerprint(parser)
+    for mod in (uutil, boilerplate):
+        edited = tmp_path/f'{mod.__name__}.py'
+        edited.write_bytes(open(mod.__file__, 'rb').read() + b'\n# edited\n')
+        with monkeypatch.context() as m:
+            m.setattr(mod, '__file__', str(edited))
+            assert cache.parser_fingerprint(parser) != fp
+
+
+def test_parse_cache_round_trip(tmp_path):
+    parser = parsehtml.FastParser()
+    parse_cache = cache.ParseCache(tmp_path/'cache'/'parse.sqlite')
+    keys = parse_cache.make_keys(parser, ['sha1:A', None, 'sha1:A'], ['http://a.com/1', 'http://a.com/2', 'http://web.archive.org/web/1/http://a.com/1'])
+    assert keys[1] is None and keys[0] != keys[2]
+
+    results = [parser.parse_page('<p>one</p>', 'http://a.com/1'), {'text': 'not cached'}, parser.parse_page('<p>two</p>', 'http://a.com/1')]
+    parse_cache.put_many(keys, results)
+    parse_cache.close()
+
+    reopened = cache.ParseCache(tmp_path/'cache'/'parse.sqlite')
+    assert reopened.get_many(keys + ['missing']) == {keys[0]: results[0], keys[2]: results[2]}
+    assert reopened.make_keys(parsehtml.FastParser(tag_transform='reduce'), ['sha1:A'], ['http://a.com/1'])[0] != keys[0]
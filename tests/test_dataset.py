@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from crawchet.process import dataset
+
+
+@pytest.fixture
+def df_master():
+    ptids = ['00003', '00003', '00999', '01000', '02500']
+    return pd.DataFrame({
+        'ptid': ptids,
+        'url': [f'http://example.com/{i}' for i in range(5)],
+        'term_count': [3, 0, 12, 7, 1],
+        'title': ['a', 'b', None, 'd', 'e'],
+        'tags': [['bear'], [], ['cat','dog'], ['bunny'], None],
+        'images': [[{'src':'a.jpg'}], [], [{'src':'b.jpg', 'alt':'b'}], [], []],
+        'links': [{'link':'http://a.com'}, {}, {}, {'link':'http://d.com'}, {}],
+        'content': [b'<html>0</html>', b'<html>1</html>', b'', b'<html>3</html>', b'<html>4</html>'],
+    }, index=[10, 11, 12, 13, 14])
+
+
+def test_write_read_round_trip(tmp_path, df_master):
+    dataset_dir = dataset.write_master_dataset(df_master, tmp_path/'df_master', ptid_bucket=1000)
+    assert sorted(p.name for p in (dataset_dir/'main').iterdir()) == ['ptid_range=00000', 'ptid_range=01000', 'ptid_range=02000']
+    assert (dataset_dir/'large').exists()
+
+    df_read = dataset.read_master_dataset(dataset_dir)
+    pd.testing.assert_frame_equal(df_read, df_master.reset_index(drop=True))
+    assert dataset.read_master(dataset_dir).equals(df_read)
+
+
+def test_read_columns_and_ptids(tmp_path, df_master):
+    dataset_dir = dataset.write_master_dataset(df_master, tmp_path/'df_master', ptid_bucket=1000)
+
+    df_read = dataset.read_master_dataset(dataset_dir, columns=['url', 'content', 'missing'], ptids=['00003', '02500'])
+    expected = df_master.reset_index(drop=True).iloc[[0, 1, 4]][['url', 'content']]
+    assert df_read.equals(expected)
+
+
+def test_iter_master_dataset_by_partition(tmp_path, df_master):
+    dataset_dir = dataset.write_master_dataset(df_master, tmp_path/'df_master', ptid_bucket=1000)
+    parts = list(dataset.iter_master(dataset_dir, columns=['ptid', 'tags']))
+    assert [len(p) for p in parts] == [3, 1, 1]
+    assert pd.concat(parts).equals(df_master.reset_index(drop=True)[['ptid', 'tags']])
+
+
+def test_rewrite_replaces_dataset(tmp_path, df_master):
+    dataset_dir = dataset.write_master_dataset(df_master, tmp_path/'df_master', ptid_bucket=1000)
+    dataset.write_master_dataset(df_master.iloc[:2], dataset_dir, ptid_bucket=1000)
+    assert len(dataset.read_master_dataset(dataset_dir)) == 2
+
+
+def test_read_master_pickle(tmp_path, df_master):
+    df_master.to_pickle(tmp_path/'df_master.pkl')
+    assert dataset.read_master(tmp_path/'df_master.pkl', columns=['ptid', 'missing']).equals(df_master[['ptid']])
+    assert [len(b) for b in dataset.iter_master(tmp_path/'df_master.pkl', batch_size=2)] == [2, 2, 1]
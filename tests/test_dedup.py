@@ -0,0 +1,84 @@
+import random
+
+import numpy as np
+import pytest
+
+from crawchet.process import dedup
+
+WORDS = ('bear bunny cat doll yarn hook stuffing eyes round stitch magic ring repeat around sew head body arms legs ears '
+         'tail nose mouth pink white brown black soft cute little easy free pattern tutorial make finish').split()
+
+
+def random_text(seed, n_words=120):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def edit_words(text, n_edits, seed):
+    rng = random.Random(seed)
+    words = text.split()
+    for i in rng.sample(range(len(words)), n_edits):
+        words[i] = 'edited'
+    return ' '.join(words)
+
+
+def exact_jaccard(a, b, k=5):
+    shingles = lambda t: {tuple(t.lower().split()[i:i+k]) for i in range(len(t.split())-k+1)}
+    sa, sb = shingles(a), shingles(b)
+    return len(sa & sb)/len(sa | sb)
+
+
+def test_shingle_hashes_offsets():
+    shingles, offsets = dedup.shingle_hashes(['one two three four five six', 'one two', '', None, 'ONE two three four five'], k=5)
+    assert offsets.tolist() == [0, 2, 3, 3, 3, 4]
+    # case is ignored, and the same shingle hashes the same in any text
+    assert shingles[0] == shingles[3]
+    assert dedup.shingle_hashes([None, ''], k=5)[1].tolist() == [0, 0, 0]
+
+
+def test_minhash_estimates_jaccard():
+    base = random_text(0, 400)
+    texts = [base, edit_words(base, 10, 1), edit_words(base, 60, 2), random_text(3, 400)]
+    signatures = dedup.minhash_signatures(texts, num_perm=256)
+    assert signatures.shape == (4, 256) and signatures.dtype == np.uint32
+    for i in range(1, 4):
+        estimate = (signatures[0] == signatures[i]).mean()
+        assert abs(estimate - exact_jaccard(texts[0], texts[i])) < 0.1
+
+    # batching and workers do not change signatures
+    assert np.array_equal(dedup.minhash_signatures(texts, num_perm=256, batch_size=1, n_jobs=2), signatures)
+
+
+def test_lsh_params():
+    bands, rows = dedup.lsh_params(0.8, 128)
+    assert bands*rows <= 128
+    assert abs((1/bands)**(1/rows) - 0.8) < 0.05
+
+
+def test_lsh_clusters():
+    bases = [random_text(i, 200) for i in range(5)]
+    texts = []
+    for i, base in enumerate(bases):
+        texts += [base, edit_words(base, 2, 10+i), edit_words(base, 3, 20+i)]
+    texts += ['', None, '', 'short text', 'short text']
+
+    clusters = dedup.near_duplicate_clusters(texts, threshold=0.8, n_jobs=1)
+    assert clusters[:15].tolist() == [i - i%3 for i in range(15)]
+    # texts without words are never clustered, identical short texts are
+    assert clusters[15:].tolist() == [15, 16, 17, 18, 18]
+
+
+def test_lsh_clusters_transitive_and_threshold():
+    base = random_text(0, 300)
+    # a chain of edits: neighbours are near duplicates, the ends may not be
+    chain = [base]
+    for i in range(4):
+        chain.append(edit_words(chain[-1], 3, i))
+    clusters = dedup.near_duplicate_clusters(chain + [edit_words(base, 150, 9)], threshold=0.8)
+    assert clusters.tolist() == [0, 0, 0, 0, 0, 5]
+
+
+def test_lsh_clusters_empty():
+    assert dedup.lsh_clusters(np.zeros((0, 128), dtype=np.uint32)).tolist() == []
+    assert dedup.near_duplicate_clusters([]).tolist() == []
+    assert dedup.near_duplicate_clusters(['', None, 'one']).tolist() == [0, 1, 2]
@@ -0,0 +1,97 @@
+import json
+import threading
+import importlib.util
+from pathlib import Path
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+from conftest import make_post
+
+SCRIPT = Path(__file__).resolve().parents[1]/'scripts'/'dl_images.py'
+
+
+@pytest.fixture(scope='module')
+def dl_images():
+    spec = importlib.util.spec_from_file_location('dl_images', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def image_server():
+    '''Local server answering /img/* with the path as image bytes, anything else with a 404. Counts requests per path'''
+    requests = Counter()
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            if self.path.startswith('/img/'):
+                body = self.path.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.requests = requests
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def test_collect_image_urls(tmp_path, dl_images):
+    posts = [make_post(0, n_items=1), make_post(1, n_items=0)]
+    posts[1]['body']['raw_links'] = []
+    ga_file = tmp_path/'ga.jsonl'
+    ga_file.write_text(''.join(json.dumps(post)+'\n' for post in posts))
+    simphtml = tmp_path/'simphtml.json'
+    simphtml.write_text(json.dumps([
+        {'data': {'ptid': '00007', 'text': '<div><img src="//1.bp.blogspot.com/-0/s0/bear_0_0.png"><img src="https://www.example.com/a.jpg?b=2&a=1"></div>'}},
+        {'data': {'ptid': '00008', 'text': '<p><img src="http://example.com/a.jpg?a=1&b=2"><img src="https://example.com/c.jpg"></p>'}},
+        {'data': {'ptid': '00009', 'text': ''}}]))
+
+    df_imgs = dl_images.collect_image_urls(ga_file, simphtml)
+    # the GA image comes first and the page's copy of it (same url up to the scheme) is dropped
+    assert df_imgs.values.tolist() == [
+        ['https://1.bp.blogspot.com/-0/s0/bear_0_0.png', '00000'],
+        ['https://www.ravelry.com/patterns/bear.jpg?x=1', '00000'],
+        ['https://www.example.com/a.jpg?b=2&a=1', '00007'],
+        ['https://example.com/c.jpg', '00008']]
+
+    pages_only = dl_images.collect_image_urls(None, simphtml, exclude_urls=df_imgs['imgurl'][:2])
+    assert pages_only['imgurl'].tolist() == ['https://www.example.com/a.jpg?b=2&a=1', 'https://example.com/c.jpg']
+
+
+def test_download_images_fetches_each_file_once(tmp_path, dl_images, image_server):
+    base = image_server.base_url
+    df_imgs = pd.DataFrame({
+        'imgurl': [f'{base}/img/a.jpg', f'{base}/img/b.jpg', f'{base}/other/b.jpg', f'{base}/missing/c.jpg', f'{base}/img/a.jpg?s=1'],
+        'ptid': ['00001', '00001', '00001', '00002', '00003']})
+    img_dir, record_file = tmp_path/'images', tmp_path/'images'/'images.csv'
+    img_dir.mkdir()
+
+    df_status = dl_images.download_images(df_imgs, img_dir, record_file, max_tasks=2)
+    assert df_status['status'].tolist() == ['ok', 'ok', 'duplicate', 'failed', 'ok']
+    assert (img_dir/'00001'/'a.jpg').read_bytes() == b'/img/a.jpg' and (img_dir/'00003'/'a.jpg').exists()
+    assert sum(image_server.requests.values()) == 4 and '/other/b.jpg' not in image_server.requests
+    assert pd.read_csv(record_file)['status'].tolist() == df_status['status'].tolist()
+
+    # nothing new: files on disk and urls that failed before are not requested again
+    image_server.requests.clear()
+    df_status = dl_images.download_images(df_imgs, img_dir, record_file)
+    assert df_status['status'].tolist() == ['exists', 'exists', 'exists', 'skipped', 'exists']
+    assert not image_server.requests
+
+    df_status = dl_images.download_images(df_imgs, img_dir, record_file, retry_failed=True)
+    assert df_status['status'].tolist() == ['exists', 'exists', 'exists', 'failed', 'exists']
+    assert list(image_server.requests) == ['/missing/c.jpg']
@@ -0,0 +1,58 @@
+import json
+
+import pandas as pd
+import pytest
+
+from crawchet.process import greatami
+from conftest import make_post
+
+
+@pytest.fixture
+def ga_file(tmp_path):
+    posts = [make_post(0, ['bear', 'French', 'Spanish'], raw_text='Pattern in Spanish and english, also SPANISH'),
+             make_post(1, [], n_items=0),
+             make_post(2, ['English', 'bunny'], n_items=3)]
+    posts += [make_post(i, ['cat', 'German'][:i%3], n_items=i%4) for i in range(3, 12)]
+    posts[1]['body']['raw_links'] = []
+    path = tmp_path/'ga.jsonl'
+    path.write_text(''.join(json.dumps(post)+'\n' for post in posts))
+    return path
+
+
+def test_process_gafile(ga_file):
+    df_gaf = greatami.process_gafile(ga_file)
+    assert df_gaf['ptid'].tolist() == [f'{i:05d}' for i in range(12)]
+    row = df_gaf.iloc[0]
+    assert row['post_title'] == 'Bear 0' and row['tag_list'] == ['bear', 'French', 'Spanish']
+    assert row['languages'] == ['Spanish', 'English', 'French']
+    assert row['raw_images'] == ['https://1.bp.blogspot.com/-0/s0/bear_0_0.png', 'https://1.bp.blogspot.com/-0/s0/bear_0_1.png']
+    assert row['text_links'] == ['http://blog0.example.com/bear-0.html', 'http://blog0.example.com/bear-1.html']
+    assert row['body_extracts'][1]['img_link'] == 'http://1.bp.blogspot.com/-0/s0/bear_0_1.jpg'
+    assert df_gaf.loc[1, 'raw_images'] == [] and df_gaf.loc[1, 'languages'] == ['English']
+    assert df_gaf.loc[2, 'raw_text'] == 'Bear 2 pattern\\nin english'
+
+
+def test_chunks_match_whole_file(ga_file):
+    df_whole = greatami.process_gafile(ga_file, chunk_size=100)
+    df_chunked = greatami.process_gafile(ga_file, chunk_size=5)
+    pd.testing.assert_frame_equal(df_chunked, df_whole)
+    pd.testing.assert_frame_equal(greatami.extract_img_links(df_whole, chunk_size=4), greatami.extract_img_links(df_whole, chunk_size=100))
+
+
+def test_extract_img_links(ga_file):
+    df_gaf = greatami.process_gafile(ga_file)
+    df_gaimg = greatami.extract_img_links(df_gaf)
+    # raw images, then body image sources (same urls), then body image links, then raw image links
+    assert df_gaimg.loc[0, 'imgurl'].tolist() == ['https://1.bp.blogspot.com/-0/s0/bear_0_0.png', 'https://1.bp.blogspot.com/-0/s0/bear_0_1.png',
+                                                  'http://1.bp.blogspot.com/-0/s0/bear_0_1.jpg', 'https://www.ravelry.com/patterns/bear.jpg?x=1']
+    # posts without images keep a null row, repeated urls are kept once
+    assert df_gaimg.loc[[1], 'imgurl'].isna().all() and df_gaimg['ptid'].loc[1] == '00001'
+    assert df_gaimg['imgurl'].dropna().is_unique and (df_gaimg.index.to_series().diff().dropna() >= 0).all()
+
+
+def test_ptid_map_keeps_ids(ga_file):
+    ptid_map = {'https://greatamigurumi.blogspot.com/2022/01/bear-5.html': '00100'}
+    df_gaf = greatami.process_gafile(ga_file, ptid_map=ptid_map, chunk_size=4)
+    # new posts are numbered after the highest known ptid
+    assert df_gaf.loc[5, 'ptid'] == '00100' and df_gaf.loc[[0, 4, 6], 'ptid'].tolist() == ['00101', '00105', '00106']
+    assert len(ptid_map) == 12
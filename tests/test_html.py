@@ -0,0 +1,90 @@
+import lxml.html
+import pytest
+
+from crawchet.utils import html as hutil
+from conftest import page_html
+
+URL = 'http://blog.example.com/2020/01/bear.html'
+
+
+def legacy_preprocess(html_content, url):
+    html_content = hutil.try_make_absolutelinks(html_content, url, decode=True)
+    html_content = hutil.try_inline_css(html_content)
+    return hutil.try_minify_html(html_content)
+
+
+@pytest.mark.parametrize('html', [page_html(0), '<html><head><style>p{color:red}</style></head><body><a href="/a">a</a> <p>x</p></body></html>'])
+def test_pipeline_matches_try_functions(html):
+    pipeline = hutil.PreprocessPipeline()
+    assert pipeline(html, URL) == legacy_preprocess(html, URL)
+    assert pipeline(html.encode(), URL) == legacy_preprocess(html, URL)
+
+
+def test_pipeline_skip_conditions_and_stats():
+    pipeline = hutil.PreprocessPipeline()
+    minified = pipeline(page_html(0), URL)
+    pipeline(minified, None)
+
+    stages = pipeline.stats.stages
+    assert [stages[st]['calls'] for st in hutil.DEFAULT_STAGES] == [2, 2, 2]
+    # no url on the second call, no <style> in either page, already minified on the second call
+    assert [stages[st]['skips'] for st in hutil.DEFAULT_STAGES] == [1, 2, 1]
+    assert 'minify' in pipeline.stats.report()
+
+
+def test_pipeline_stage_overrides_and_errors(monkeypatch):
+    pipeline = hutil.PreprocessPipeline([('inline_css', []), 'minify'], errors='ignore')
+    assert pipeline.stages == [('inline_css', ()), ('minify', ('minified',))]
+
+    def fail(*args, **kwargs):
+        raise ValueError('broken stage')
+    monkeypatch.setitem(hutil.PREPROCESS_STAGES, 'inline_css', (fail, ()))
+    # a failing stage passes its input on unchanged
+    assert pipeline('<p>a</p>', URL) == hutil.try_minify_html('<p>a</p>')
+    assert pipeline.stats.stages['inline_css']['errors'] == 1
+
+    with pytest.raises(ValueError):
+        hutil.PreprocessPipeline([('inline_css', [])], errors='raise')('<p>a</p>', URL)
+
+
+def test_stats_merge():
+    a, b = hutil.PreprocessStats(), hutil.PreprocessStats()
+    a.record('minify', 0.5)
+    b.record('minify', 0.25, error=True)
+    b.record('inline_css', skipped=True)
+    a.merge(b)
+    assert a.stages == {'minify': {'calls': 2, 'skips': 0, 'errors': 1, 'seconds': 0.75},
+                        'inline_css': {'calls': 1, 'skips': 1, 'errors': 0, 'seconds': 0.0}}
+
+
+LINKS_PAGE = '''<html><head><base href="http://x.com/d/"><style>a{background:url(i.png)} @import "s.css";</style>
+<meta http-equiv="refresh" content="0; url=/r"></head><body style="background:url('bg.png')" background="bg2.png">
+<object codebase="/c/" data="d.swf"><param valuetype="ref" value="v"><a href="in">o</a></object>
+<div style="color: red; background: url( b.png )"><a href=" rel ">x</a><svg><use xlink:href="#s"/></svg>
+<form action="f"><button formaction="../g">y</button></form></div><a href="http://[bad">z</a><img src="../i.jpg"></body></html>'''
+
+
+@pytest.mark.parametrize('html', [page_html(0), LINKS_PAGE])
+def test_make_links_absolute_matches_lxml(html):
+    expected = lxml.html.fromstring(html)
+    expected.resolve_base_href(handle_failures='ignore')
+    expected.make_links_absolute(URL, resolve_base_href=False, handle_failures='ignore')
+    ldoc = hutil.make_links_absolute(lxml.html.fromstring(html), URL)
+    assert lxml.html.tostring(ldoc) == lxml.html.tostring(expected)
+
+
+
+def test_linked_stylesheet_inlined_when_fetched(monkeypatch):
+    calls = []
+    class StubInline:
+        def inline(self, html, remove_style_tags, load_remote_stylesheets):
+            calls.append(load_remote_stylesheets)
+            return html.replace('<p>', '<p style="color: red">')
+    monkeypatch.setattr(hutil, 'css_inline', StubInline())
+    html = '<html><head><link rel="stylesheet" href="http://blog.example.com/style.css"></head><body><p>Rnd 1</p></body></html>'
+    pipeline = hutil.PreprocessPipeline([('inline_css', ['no_style'])])
+    # without fetching, a linked stylesheet has nothing to inline
+    assert pipeline(html, URL) == html and not calls
+    assert pipeline(html, URL, fetch_remote_css=True) == html.replace('<p>', '<p style="color: red">')
+    assert calls == [True]
+    assert pipeline.stats.stages['inline_css']['skips'] == 1
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+import tracemalloc
+
+import pytest
+
+from crawchet.utils import instrument
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = instrument.Recorder()
+    monkeypatch.setattr(instrument, 'RECORDER', recorder)
+    return recorder
+
+
+@instrument.spanned()
+def parse_pages(n):
+    instrument.set_items(n)
+    with instrument.span('inner', items=2):
+        pass
+    return n
+
+
+def test_nested_spans(recorder):
+    with instrument.span('build') as outer:
+        assert parse_pages(5) == 5
+        with pytest.raises(ValueError):
+            with instrument.span('fails'):
+                raise ValueError('bad page')
+        outer.set_items(10)
+    instrument.set_items(3) # no open span, ignored
+
+    records = {rec['path']: rec for rec in recorder.records}
+    assert list(records) == ['build/parse_pages/inner', 'build/parse_pages', 'build/fails', 'build']
+    assert [records[p]['depth'] for p in records] == [2, 1, 1, 0]
+    assert records['build/parse_pages']['items'] == 5 and records['build']['items'] == 10
+    assert records['build/fails']['error'] == 'ValueError' and 'error' not in records['build']
+    assert records['build']['wall_s'] >= records['build/parse_pages']['wall_s']
+    assert parse_pages.__name__ == 'parse_pages'
+    assert recorder.current() is None
+
+
+def test_ordered_records(recorder):
+    # spans started within the same ms, siblings after a nested span still come after its children
+    with instrument.span('build'):
+        parse_pages(1)
+        with instrument.span('write'):
+            pass
+    with instrument.span('report'):
+        pass
+    assert [rec['path'] for rec in recorder.ordered_records()] == ['build', 'build/parse_pages', 'build/parse_pages/inner', 'build/write', 'report']
+    assert [tot['path'] for tot in recorder.summary()] == ['build', 'build/parse_pages', 'build/parse_pages/inner', 'build/write', 'report']
+
+
+def test_threads_have_their_own_stack(recorder):
+    def work(i):
+        with instrument.span(f'thread{i}'):
+            with instrument.span('step'):
+                pass
+    with instrument.span('main'):
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    paths = sorted(rec['path'] for rec in recorder.records)
+    assert paths == ['main'] + sorted([f'thread{i}' for i in range(4)] + [f'thread{i}/step' for i in range(4)])
+
+
+def test_summary(recorder):
+    for i in range(3):
+        parse_pages(i+1)
+    summary = {tot['path']: tot for tot in recorder.summary()}
+    assert list(summary) == ['parse_pages', 'parse_pages/inner']
+    assert summary['parse_pages']['calls'] == 3 and summary['parse_pages']['items'] == 6
+    assert summary['parse_pages/inner']['items'] == 6
+
+
+def test_traced_peak_includes_nested_spans(recorder):
+    tracemalloc.start()
+    try:
+        with instrument.span('outer'):
+            with instrument.span('alloc'):
+                data = bytearray(20*2**20)
+                del data
+            with instrument.span('small'):
+                pass
+    finally:
+        tracemalloc.stop()
+    records = {rec['path']: rec for rec in recorder.records}
+    assert records['outer/alloc']['traced_peak_mb'] >= 20 > records['outer/small']['traced_peak_mb']
+    assert records['outer']['traced_peak_mb'] >= records['outer/alloc']['traced_peak_mb']
+
+
+def test_write_report(recorder, tmp_path):
+    parse_pages(4)
+    report_path = instrument.write_report(tmp_path/'logs')
+    report = json.loads(report_path.read_text())
+    assert report_path.suffix == '.json' and report['pid'] == os.getpid()
+    assert [s['path'] for s in report['spans']] == ['parse_pages', 'parse_pages/inner']
+    assert report['summary'][0]['items'] == 4
+
+
+SCRIPT = '''
+from crawchet.utils import instrument
+with instrument.span('work', items=3):
+    sum(range(10**5))
+'''
+
+
+@pytest.mark.parametrize('profile', ['', 'cprofile'])
+def test_report_at_exit(tmp_path, profile):
+    env = {k: v for k, v in os.environ.items() if not k.startswith('CRAWCHET_')}
+    env.update(CRAWCHET_REPORT_DIR=tmp_path.as_posix(), CRAWCHET_PROFILE=profile)
+    subprocess.run([sys.executable, '-c', SCRIPT], env=env, check=True)
+    reports = list(tmp_path.glob('*.json'))
+    assert len(reports) == 1
+    report = json.loads(reports[0].read_text())
+    assert report['spans'][0]['path'] == 'work' and report['spans'][0]['items'] == 3
+    assert ('top_functions' in report) == bool(profile)
+    assert len(list(tmp_path.glob('*.prof'))) == bool(profile)
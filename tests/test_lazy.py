@@ -0,0 +1,70 @@
+import sys
+import pickle
+import subprocess
+
+import pytest
+from joblib import Parallel, delayed
+
+from crawchet.utils import lazy
+from crawchet.utils.lazy import lazy_import, lazy_callable
+
+TARGET = '''
+"""Target module."""
+LOADS = []
+def double(x):
+    """Doubles x."""
+    return 2*x
+class Box:
+    def __init__(self, x):
+        self.x = x
+'''
+
+
+@pytest.fixture
+def target_module(tmp_path, monkeypatch):
+    (tmp_path/'lazy_target.py').write_text(TARGET)
+    monkeypatch.syspath_prepend(tmp_path.as_posix())
+    monkeypatch.delitem(sys.modules, 'lazy_target', raising=False)
+    yield 'lazy_target'
+    sys.modules.pop('lazy_target', None)
+
+
+def test_lazy_import(target_module):
+    module = lazy_import(target_module)
+    assert isinstance(module, lazy.LazyModule) and target_module not in sys.modules
+    assert module.double(2) == 4
+    assert target_module in sys.modules and 'Box' in dir(module)
+    assert lazy_import(target_module) is sys.modules[target_module]
+    with pytest.raises(AttributeError):
+        module.missing
+
+
+def test_lazy_callable(target_module):
+    double, Box = lazy_callable(target_module, 'double'), lazy_callable(target_module, 'Box')
+    assert double.__name__ == 'double' and target_module not in sys.modules
+    assert double(3) == 6 and Box(1).x == 1
+    # metadata of the target once loaded
+    assert double.__doc__ == 'Doubles x.' and double.__wrapped__ is sys.modules[target_module].double
+
+
+def test_pickle_round_trip(target_module):
+    double = lazy_callable(target_module, 'double')
+    unloaded = pickle.loads(pickle.dumps(double))
+    assert isinstance(unloaded, lazy.LazyCallable) and target_module not in sys.modules
+    assert unloaded(4) == 8 and double(1) == 2
+    loaded = pickle.loads(pickle.dumps(double))
+    assert loaded(5) == 10 and repr(loaded) == repr(double) == '<lazy lazy_target.double>'
+
+
+def test_in_workers():
+    dumps = lazy_callable('json', 'dumps')
+    # sent to the workers unloaded, then loaded
+    for _ in range(2):
+        assert Parallel(n_jobs=2)(delayed(dumps)([i]) for i in range(3)) == ['[0]', '[1]', '[2]']
+        assert dumps([]) == '[]'
+
+
+def test_import_deferred():
+    script = ('import sys; from crawchet.utils.lazy import lazy_callable; f = lazy_callable("colorsys", "rgb_to_hsv"); '
+              'assert "colorsys" not in sys.modules; f(0, 0, 0); assert "colorsys" in sys.modules')
+    subprocess.run([sys.executable, '-c', script], check=True)
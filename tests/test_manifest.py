@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from crawchet.process import manifest as mf, transform
+from conftest import write_warc, blog_page
+
+
+def host_pages(host, n):
+    return [(f'https://{host}/2020/{i}.html', blog_page(host, i)) for i in range(n)]
+
+
+def test_files_are_written_on_save(tmp_path):
+    state_dir = tmp_path/'state'
+    df_textracts = pd.DataFrame({'record_key': np.array([1, 2], dtype=np.uint64), 'text': ['a', 'b']})
+    manifest = mf.BuildManifest(state_dir)
+    manifest.add_records(df_textracts, df_textracts['record_key'])
+    manifest.write_gaf(pd.DataFrame({'ptid': ['00000']}))
+    manifest.ptid_map['http://a.com'] = '00000'
+
+    # read back within the run, invisible to other runs until saved
+    assert manifest.read_textracts().equals(df_textracts)
+    assert manifest.processed_keys().tolist() == [1, 2]
+    assert len(manifest.read_gaf()) == 1
+    assert mf.BuildManifest(state_dir).processed_keys().tolist() == []
+
+    manifest.save()
+    manifest = mf.BuildManifest(state_dir)
+    assert manifest.processed_keys().tolist() == [1, 2]
+    assert manifest.read_textracts().equals(df_textracts)
+    assert manifest.ptid_map == {'http://a.com': '00000'}
+
+
+def test_interrupted_save_starts_over(tmp_path):
+    state_dir = tmp_path/'state'
+    manifest = mf.BuildManifest(state_dir)
+    df_textracts = pd.DataFrame({'record_key': np.array([1], dtype=np.uint64), 'text': ['a']})
+    manifest.add_records(df_textracts, df_textracts['record_key'])
+    manifest.post_digests['http://a.com'] = 'x'
+    manifest.ptid_map['http://a.com'] = '00000'
+    manifest.save()
+
+    manifest = mf.BuildManifest(state_dir)
+    manifest.add_records(df_textracts.assign(record_key=np.array([2], dtype=np.uint64)), [2])
+    manifest.write_gaf(pd.DataFrame({'ptid': ['00000']}))
+    # files moved into place, stopped before manifest.json is written
+    for path, tmp_file in manifest._pending.items():
+        tmp_file.replace(path)
+
+    manifest = mf.BuildManifest(state_dir)
+    assert manifest.processed_keys().tolist() == []
+    assert manifest.read_textracts() is None and manifest.read_gaf() is None
+    assert manifest.post_digests == {} and manifest.ptid_map == {'http://a.com': '00000'}
+
+
+def test_templates_learned_for_new_hosts(tmp_path):
+    state_dir = tmp_path/'state'
+    # c.blogspot.com has too few pages for a template in the first run
+    first = write_warc(tmp_path/'first.warc.gz', host_pages('a.blogspot.com', 6) + host_pages('c.blogspot.com', 3))
+    second = write_warc(tmp_path/'second.warc.gz', host_pages('a.blogspot.com', 6) + host_pages('c.blogspot.com', 6) + host_pages('b.blogspot.com', 6))
+
+    manifest = mf.BuildManifest(state_dir)
+    df_textracts = transform.update_textracts(first, manifest, strip_templates=True, n_jobs=1)
+    manifest.save()
+    has_sidebar = df_textracts.set_index('url')['text'].str.contains('Popular posts')
+    assert not has_sidebar.filter(like='a.blogspot.com').any() and has_sidebar.filter(like='c.blogspot.com').all()
+
+    manifest = mf.BuildManifest(state_dir)
+    df_textracts = transform.update_textracts(second, manifest, strip_templates=True, n_jobs=1)
+    manifest.save()
+    assert manifest.runs[-1]['new_records'] == 12 # b, and all of c, but not a again
+    assert len(df_textracts) == 18 and not df_textracts['text'].str.contains('Popular posts').any()
+
+    templates = mf.BuildManifest(state_dir).read_templates()
+    assert set(templates.templates) == templates.hosts == {'a.blogspot.com', 'b.blogspot.com', 'c.blogspot.com'}
+
+
+def test_settings_change_replaces_records_on_save(tmp_path):
+    state_dir = tmp_path/'state'
+    manifest = mf.BuildManifest(state_dir)
+    manifest.check_settings({'parser': 'a'})
+    for key in [1, 2]:
+        manifest.add_records(pd.DataFrame({'record_key': np.array([key], dtype=np.uint64), 'text': ['old']}), [key])
+    manifest.save()
+
+    manifest = mf.BuildManifest(state_dir)
+    manifest.check_settings({'parser': 'b'})
+    assert manifest.processed_keys().tolist() == [] and manifest.read_textracts() is None
+    manifest.add_records(pd.DataFrame({'record_key': np.array([3], dtype=np.uint64), 'text': ['new']}), [3])
+    # stopped before save, the committed state is untouched
+    assert mf.BuildManifest(state_dir).processed_keys().tolist() == [1, 2]
+    assert len(list((state_dir/'textracts').glob('part-*.parquet'))) == 2
+
+    manifest.save()
+    manifest = mf.BuildManifest(state_dir)
+    assert manifest.settings == {'parser': 'b'} and manifest.processed_keys().tolist() == [3]
+    assert manifest.read_textracts()['text'].tolist() == ['new']
+    assert len(list((state_dir/'textracts').glob('part-*.parquet'))) == 1
+
+
+def test_parser_change_reparses_records(tmp_path, monkeypatch):
+    state_dir = tmp_path/'state'
+    warc_file = write_warc(tmp_path/'pages.warc.gz', host_pages('a.blogspot.com', 4))
+    for fingerprint, new_records in [('a', 4), ('a', 0), ('b', 4)]:
+        monkeypatch.setattr(transform, 'parser_fingerprint', lambda parser: fingerprint)
+        manifest = mf.BuildManifest(state_dir)
+        df_textracts = transform.update_textracts(warc_file, manifest, n_jobs=1)
+        manifest.save()
+        assert manifest.runs[-1]['new_records'] == new_records and len(df_textracts) == 4
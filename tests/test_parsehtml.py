@@ -0,0 +1,148 @@
+import lxml.html
+import pytest
+
+from crawchet.process import archive, parsehtml
+from conftest import page_html
+
+URL = 'http://blog.example.com/2020/01/bunny.html'
+
+TEMPLATE_PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Bunny   free pattern</title>
+<style>.post-body b{color:#333} h3.post-title{font-style: italic} @media screen{.nav{display:none}}</style>
+<script>var post_id = 1;</script></head>
+<body><div id="header"><ul class="nav"><li><a href="/">Home</a></li><li><a href="/search/label/bunny">bunny</a></li></ul></div>
+<div class="post"><h3 class="post-title"> Bunny free pattern </h3><!-- post body -->
+<div class="post-body"><p>Make a <b>little</b> bunny with this   free pattern.</p>
+<p>Rnd 1: 6 sc in magic ring (6)<br>Rnd 2: inc x6 (12)<br>Rnd 3: (sc, inc) x6 (18)</p>
+<p><a href="/2020/01/bunny-ears.html"><img src="../images/bunny.jpg" alt="bunny"></a></p>
+<ul><li>3mm hook</li><li>safety eyes</li></ul></div></div>
+<div id="footer"><p>&copy; Bunny blog</p></div></body></html>'''
+
+PARSERS = [
+    (parsehtml.GenericParser, {'tag_transform':'reduce'}),
+    (parsehtml.GenericParser, {'tag_transform':'reduce', 'text_only':False}),
+    (parsehtml.GenericParser, {'tag_transform':'markdown'}),
+    (parsehtml.GenericParser, {'tag_transform':'remove'}),
+    (parsehtml.FastParser, {'tag_transform':'text'}),
+    (parsehtml.FastParser, {'tag_transform':'reduce'}),
+    (parsehtml.FastParser, {'tag_transform':'reduce', 'text_only':False}),
+]
+
+
+@pytest.mark.parametrize('parser_cls,kwargs', PARSERS)
+@pytest.mark.parametrize('html', [TEMPLATE_PAGE, page_html(0)], ids=['template', 'plain'])
+def test_tree_engine_matches_legacy(parser_cls, kwargs, html):
+    legacy = parser_cls(preprocess_engine='legacy', **kwargs).parse_page(html, URL)
+    tree = parser_cls(preprocess_engine='tree', **kwargs).parse_page(html, URL)
+    assert tree == legacy
+
+
+def test_tree_engine_preprocessing():
+    ldoc = parsehtml.FastParser(preprocess_engine='tree').preprocess(TEMPLATE_PAGE, URL, to_lxml=True)
+    assert ldoc.xpath('//img/@src') == ['http://blog.example.com/2020/images/bunny.jpg']
+    assert ldoc.xpath('//h3/@style') == ['font-style: italic']
+    assert ldoc.xpath('//b/@style') == ['color:#333']
+    assert not ldoc.xpath('//style') and not ldoc.xpath('//comment()')
+    assert ldoc.xpath('//p')[0].text == 'Make a '
+
+
+@pytest.mark.parametrize('html', [TEMPLATE_PAGE, page_html(0)], ids=['template', 'plain'])
+def test_tree_engine_kept_html(html):
+    generic = parsehtml.GenericParser(preprocess_engine='tree', keep_preprocessed=True).parse_page(html, URL)
+    fast = parsehtml.FastParser(preprocess_engine='tree', keep_preprocessed=True).parse_page(html, URL)
+    assert generic['html'] == fast['html'] == parsehtml.GenericParser(preprocess_engine='tree').preprocess(html, URL)
+    assert generic['html'].startswith(b'<html><head>')
+
+
+NESTED_PAGE = '''<html><head><title> Bear </title></head><body>
+<div><div><p>Rnd 1: <span style="font-weight:bold">6 sc</span> in ring</p></div></div>
+<div><span><span style="color:red">red</span></span><p></p><i> </i><img src="http://a.com/a.jpg"></div>
+<h2>  Head <!-- c --> <script>x</script> ing </h2><a href="/rel">relative</a> <a href="http://a.com/abs">absolute</a>
+<table><tr><td><b>Rnd 2</b></td><td>inc x6</td></tr></table><section><p>unwrapped section</p></section></body></html>'''
+
+
+@pytest.mark.parametrize('text_only', [True, False])
+@pytest.mark.parametrize('html', [TEMPLATE_PAGE, NESTED_PAGE, page_html(0)], ids=['template', 'nested', 'plain'])
+def test_reduce_tree_matches_reduce_tagset(html, text_only):
+    generic = parsehtml.GenericParser(tag_transform='reduce', text_only=text_only).parse_page(html, URL)
+    fast = parsehtml.FastParser(tag_transform='reduce', text_only=text_only).parse_page(html, URL)
+    assert fast['text'] == generic['text']
+
+
+def record_refs(warc_file):
+    df_index = archive.ArchiveManager(warc_file).index_records(n_jobs=1)
+    return list(zip(df_index.warc_file, df_index.offset))
+
+
+def archive_pages(warc_file):
+    return [(rec['target_uri'], rec['content']) for rec in archive.ArchiveManager(warc_file).parse_records()]
+
+
+def test_parallel_parse_warc_matches_sequential(warc_file):
+    parser = parsehtml.FastParser(tag_transform='reduce')
+    refs = record_refs(warc_file)
+    parsed = list(parser.parallel_parse_warc(refs, batch_size=5, n_jobs=2))
+    
+    pages = archive_pages(warc_file)
+    assert parsed == [parser.parse_page(html, url) for url, html in pages]
+    assert parser.parallel_parse([html for _,html in pages], [url for url,_ in pages], batch_size=5, n_jobs=2) == parsed
+    # worker preprocessing stats are merged into the parser's
+    assert parser.preprocess_stats.report()
+
+
+def test_shared_parser_loaded_once_per_worker(monkeypatch):
+    parser = parsehtml.FastParser()
+    with parsehtml._shared_parser(parser, n_jobs=1) as parser_ref:
+        assert parser_ref is parser
+    
+    loads = []
+    load = parsehtml.pickle.load
+    monkeypatch.setattr(parsehtml.pickle, 'load', lambda f: loads.append(f) or load(f))
+    with parsehtml._shared_parser(parser, n_jobs=2) as parser_ref:
+        assert isinstance(parser_ref, str)
+        for _ in range(3):
+            parsed, _ = parsehtml._parse_batch(parser_ref, ['<p>Rnd 1: 6 sc</p>'], ['http://a.com/'])
+            assert parsed[0]['text'] == parser.parse_page('<p>Rnd 1: 6 sc</p>', 'http://a.com/')['text']
+    assert len(loads) == 1
+    assert not parsehtml.os.path.exists(parser_ref)
+
+
+def content_page(wrapper_class):
+    rounds = ''.join(f'<p>Rnd {r}: (sc, inc) x6, sc in each st around ({6*r})</p>' for r in range(1, 8))
+    return (f'<html><head><title>Bear Blog: Little bear free pattern</title></head><body>'
+            f'<div id="nav"><a href="/">Home</a> <a href="/patterns">All the free crochet patterns and tutorials</a></div>'
+            f'<div class="{wrapper_class}"><h3>Little bear free pattern</h3><p>This little bear is made in rounds, stuffed firmly as you go, and sewn together.</p>{rounds}</div>'
+            f'<div class="sidebar-wrapper"><div id="BlogArchive1"><p>2020 (12), 2019 (30), January, February, March patterns</p></div></div>'
+            f'<div class="comments"><p>Lovely pattern, thank you! I made three of them in different colors.</p></div></body></html>')
+
+
+@pytest.mark.parametrize('wrapper_class', ['canvas', 'navy-bear', 'commentary', 'post-body entry-content', 'entry-header-content', 'post-labels-wrapper'])
+def test_extract_main_content_keeps_content_wrapper(wrapper_class):
+    article = parsehtml.extract_main_content(content_page(wrapper_class))
+    text = ' '.join(block['text'] for block in article['plain_text'])
+    assert article['title'] == 'Little bear free pattern'
+    assert 'Rnd 1: (sc, inc) x6' in text and 'Rnd 7:' in text
+    assert 'Lovely pattern' not in text and 'January' not in text and 'Home' not in text
+
+
+def test_extract_main_content_plain_content():
+    page = (content_page('post-body').replace('<p>This little bear', '<p style="color:red">This <b>little</b> <a href="/bear">bear</a><br>')
+            .replace('<p>Rnd 7:', '<ul><li class="tip">3mm <i>hook</i></li></ul><p><span class="row">Rnd 7:</span>'))
+    article = parsehtml.extract_main_content(page)
+    assert article['plain_content'] != article['content']
+    assert '<b>little</b>' in article['content'] and 'href="/bear"' in article['content']
+    
+    plain = lxml.html.fromstring(article['plain_content'])
+    assert {el.tag for el in plain.iter()} <= parsehtml.PLAIN_TAGS and not any(el.attrib for el in plain.iter() if el is not plain)
+    assert plain.get('id') == 'readability-page-1'
+    assert [el.text for el in plain.iter('p', 'li')][:2] == ['This little bear is made in rounds, stuffed firmly as you go, and sewn together.', 
+                                                          'Rnd 1: (sc, inc) x6, sc in each st around (6)']
+    assert '3mm hook' in [block['text'] for block in article['plain_text']]
+    assert [block['text'] for block in article['plain_text']] == list(plain.itertext())
+
+
+@pytest.mark.parametrize('attrs,weight', [
+    ({'class':'canvas'}, 0), ({'id':'nav'}, -25), ({'class':'main-nav'}, 0), ({'id':'Label1'}, -25), 
+    ({'class':'comments'}, -25), ({'class':'post hentry'}, 25), ({'class':'sidebar-wrapper'}, -25), ({'class':'adventure'}, 0), ({'class':'commentary'}, 0)])
+def test_class_weight_matches_whole_tokens(attrs, weight):
+    assert parsehtml._class_weight(lxml.html.Element('div', attrs)) == weight
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+from crawchet import pipeline
+
+# stand-in stage script: logs its start and end, then writes each output as the concatenation of its inputs
+STAGE_SCRIPT = '''
+import sys, time, json
+from pathlib import Path
+name, data_dir, inputs, outputs = sys.argv[1], Path(sys.argv[2]), sys.argv[3], sys.argv[4]
+log = data_dir/'order.log'
+with open(log, 'a') as f: f.write(json.dumps([name, 'start', time.time()]) + '\\n')
+if (data_dir/f'fail_{name}').exists(): sys.exit(1)
+time.sleep(0.2)
+text = name + ':' + ','.join((data_dir/i).read_text() for i in inputs.split(',') if i)
+for out in outputs.split(','):
+    (data_dir/out).write_text(text)
+with open(log, 'a') as f: f.write(json.dumps([name, 'end', time.time()]) + '\\n')
+'''
+
+
+@pytest.fixture
+def tmp_pipeline(tmp_path, monkeypatch):
+    data_dir, scripts_dir = tmp_path/'data', tmp_path/'scripts'
+    data_dir.mkdir()
+    scripts_dir.mkdir()
+    (scripts_dir/'stage.py').write_text(STAGE_SCRIPT)
+    monkeypatch.setattr(pipeline, 'ROOT', tmp_path)
+    monkeypatch.setattr(pipeline, 'DATA_DIR', data_dir)
+    monkeypatch.setattr(pipeline, 'SCRIPTS_DIR', scripts_dir)
+    monkeypatch.setattr(pipeline, 'LOG_DIR', data_dir/'logs')
+
+    def stage(name, inputs, outputs):
+        return pipeline.Stage(name, 'stage.py', inputs, outputs, args=[name, data_dir.as_posix(), ','.join(inputs), ','.join(outputs)])
+    # a -> b -> d, a -> c -> d, e independent
+    stages = [stage('a', ['src.txt'], ['a.txt']), stage('b', ['a.txt'], ['b.txt']), stage('c', ['a.txt'], ['c.txt']),
+              stage('d', ['b.txt', 'c.txt'], ['d.txt']), stage('e', [], ['e.txt'])]
+    (data_dir/'src.txt').write_text('src')
+
+    def make(**kwargs):
+        return pipeline.Pipeline(stages, state_file=data_dir/'state.json', **kwargs)
+    return make, data_dir
+
+
+def read_log(data_dir):
+    events = [json.loads(line) for line in (data_dir/'order.log').read_text().splitlines()]
+    (data_dir/'order.log').unlink()
+    return {(name, event): t for name, event, t in events}
+
+
+def test_runs_in_dependency_order(tmp_pipeline):
+    make, data_dir = tmp_pipeline
+    results = make(jobs=3).run()
+    assert results == dict.fromkeys('abcde', 'ran')
+    assert (data_dir/'d.txt').read_text() == 'd:b:a:src,c:a:src'
+
+    times = read_log(data_dir)
+    for name, deps in make().deps.items():
+        assert all(times[(dep, 'end')] <= times[(name, 'start')] for dep in deps)
+    # b and c only depend on a, so they run at the same time
+    assert times[('b', 'start')] < times[('c', 'end')] and times[('c', 'start')] < times[('b', 'end')]
+
+
+def test_skips_fresh_and_reruns_downstream(tmp_pipeline):
+    make, data_dir = tmp_pipeline
+    make().run()
+    read_log(data_dir)
+    assert make().run() == dict.fromkeys('abcde', 'skipped')
+    assert make().status() == dict.fromkeys('abcde', 'fresh')
+
+    (data_dir/'src.txt').write_text('changed')
+    assert make().status()['a'] == 'stale'
+    assert make().run(['b']) == {'a': 'ran', 'b': 'ran'}
+    assert make().run() == {'a': 'skipped', 'b': 'skipped', 'c': 'ran', 'd': 'ran', 'e': 'skipped'}
+
+    # outputs changed by hand make their stage stale
+    (data_dir/'e.txt').write_text('edited')
+    assert make().status(['e']) == {'e': 'stale'}
+    read_log(data_dir)
+    # c is rerun, d is not since c wrote the same content again
+    assert make().run(start='c') == {'c': 'ran', 'd': 'skipped'}
+
+
+def test_failed_stage_blocks_dependents(tmp_pipeline):
+    make, data_dir = tmp_pipeline
+    (data_dir/'fail_b').touch()
+    results = make(jobs=2).run()
+    assert results == {'a': 'ran', 'b': 'failed', 'c': 'ran', 'd': 'blocked', 'e': 'ran'}
+    assert 'b' not in make().runs
+
+
+def test_dry_run(tmp_pipeline):
+    make, data_dir = tmp_pipeline
+    assert make().run(dry_run=True) == dict.fromkeys('abcde', 'ran')
+    assert not (data_dir/'a.txt').exists()
+
+
+def test_stages():
+    deps = pipeline.dependencies(pipeline.STAGES)
+    outputs = [out for stage in pipeline.STAGES for out in stage.outputs]
+    assert len(outputs) == len(set(outputs))
+    # GA and page images are downloaded in one deduplicated pass, once both are available
+    assert deps['images'] == ['datasets', 'scrape'] and {s.name: s.args for s in pipeline.STAGES}['images'] == ['--source', 'all']
+    assert pipeline.upstream(pipeline.STAGES, ['images']) == set(s.name for s in pipeline.STAGES)
+    assert pipeline.downstream(pipeline.STAGES, 'pages') == {'pages', 'datasets', 'images'}
+
+
+def test_stage_code_follows_imports(tmp_path, monkeypatch):
+    code = {stage.name: stage.code for stage in pipeline.STAGES}
+    assert {'scripts/asyncget.py', 'crawchet/collect/crawl.py', 'crawchet/process/greatami.py',
+            'crawchet/utils/io.py', 'crawchet/utils/uri.py'} <= set(code['pages'])
+    assert 'crawchet/process/js' in code['datasets']
+
+    monkeypatch.setattr(pipeline, 'ROOT', tmp_path)
+    for path, text in {'pkg/__init__.py': '', 'pkg/a.py': 'from . import b', 'pkg/b.py': 'import json\nfrom .sub.c import x',
+                       'pkg/sub/__init__.py': '', 'pkg/sub/c.py': 'x = 1', 'pkg/unused.py': '', 'script.py': 'from pkg.a import y'}.items():
+        (tmp_path/path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path/path).write_text(text)
+    assert pipeline.imported_modules(tmp_path/'script.py') == ['pkg/__init__.py', 'pkg/a.py', 'pkg/b.py', 'pkg/sub/__init__.py', 'pkg/sub/c.py']
@@ -0,0 +1,74 @@
+import shutil
+
+import pytest
+
+from crawchet.process import readability
+from conftest import page_html
+
+# stand-in for js/readability_worker.js with the same protocol, so the tests need neither jsdom nor network access.
+# A document containing "crash" kills the process, "fail" returns an error
+STUB_WORKER_JS = '''
+const readline = require('readline');
+const rl = readline.createInterface({input: process.stdin, crlfDelay: Infinity});
+rl.on('line', (line) => {
+    const request = JSON.parse(line);
+    if (request.html.includes('crash')) { process.exit(1); }
+    const error = request.html.includes('fail') ? 'failed' : null;
+    const article = error ? null : {title: 'T' + request.id, byline: null, date: null, content: '<div><p>' + request.html.length + '</p></div>'};
+    process.stdout.write(JSON.stringify({id: request.id, article: article, error: error}) + '\\n');
+});
+'''
+
+requires_node = pytest.mark.skipif(shutil.which('node') is None, reason='node not installed')
+
+
+@pytest.fixture
+def stub_worker(tmp_path, monkeypatch):
+    worker_js = tmp_path/'stub_worker.js'
+    worker_js.write_text(STUB_WORKER_JS)
+    monkeypatch.setattr(readability, 'WORKER_JS', worker_js)
+    return worker_js
+
+
+@requires_node
+def test_worker_restarts_after_crash(stub_worker):
+    worker = readability.ReadabilityWorker(errors='ignore')
+    try:
+        assert worker.parse('<p>a</p>')['title'] == 'T1'
+        assert worker.parse('<p>crash</p>') is None
+        assert worker.parse('<p>fail</p>') is None
+        assert worker.parse('<p>b</p>')['title'] == 'T4'
+    finally:
+        worker.close()
+
+    worker = readability.ReadabilityWorker(errors='raise')
+    with pytest.raises(RuntimeError):
+        worker.parse('<p>fail</p>')
+    worker.close()
+
+
+@requires_node
+def test_pool_keeps_order(stub_worker, monkeypatch):
+    monkeypatch.setattr(readability.simple_json, 'have_node', lambda: True)
+    htmls = ['<p>' + 'x'*i + '</p>' for i in range(25)]
+    with readability.ReadabilityPool(n_jobs=3, batch_size=4) as pool:
+        articles = pool.map(htmls, total=len(htmls))
+        assert len(pool._workers) <= 3
+    assert [a['plain_text'][0]['text'] for a in articles] == [str(len(h)) for h in htmls]
+
+
+def test_pool_falls_back_to_python(monkeypatch):
+    monkeypatch.setattr(readability.simple_json, 'have_node', lambda: False)
+    htmls = [page_html(i) for i in range(5)]
+    with readability.ReadabilityPool(n_jobs=2, batch_size=2) as pool:
+        articles = pool.map(htmls)
+    assert articles == [readability.simple_json.simple_json_from_html_string(h, use_readability=False) for h in htmls]
+
+
+def test_article_from_readability():
+    empty = readability.article_from_readability(None)
+    assert empty == dict.fromkeys(['title', 'byline', 'date', 'content', 'plain_content', 'plain_text'])
+
+    article = readability.article_from_readability({'title': 'Bear', 'byline': '', 'content': '<div><p>Rnd 1: 6 sc</p></div>'})
+    assert article['title'] == 'Bear' and article['byline'] is None
+    assert article['plain_text'] == [{'text': 'Rnd 1: 6 sc'}]
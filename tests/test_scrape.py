@@ -0,0 +1,68 @@
+import json
+import gzip
+
+import pytest
+
+from crawchet.collect.scrape import GreatAmigurumiScraper
+from crawchet.process import greatami
+
+PAGES = [{'url': f'https://greatamigurumi.blogspot.com/search?start={p}', 'num_posts': 2, 'next_page': None,
+          'page_data': [{'post_date': 'Jan 01, 2022', 'header': {'title_text': f'Bear {p}{i}', 'title_link': f'https://g.com/{p}{i}'},
+                         'body': {'parsed': [], 'raw_links': [], 'raw_images': [], 'raw_text': 'Bear\nmüffin'}, 'footer': []}
+                        for i in range(2)]}
+         for p in range(3)]
+POSTS = [post for page in PAGES for post in page['page_data']]
+
+
+@pytest.fixture
+def scraper(monkeypatch):
+    scraper = GreatAmigurumiScraper()
+    monkeypatch.setattr(scraper, 'iter_pages', lambda warc_outfile, timeout=2: iter(PAGES))
+    return scraper
+
+
+@pytest.mark.parametrize('name', ['ga.jsonl', 'ga.jsonl.gz', 'ga.ndjson'])
+def test_scrape_jsonl_round_trip(tmp_path, scraper, name):
+    assert scraper.scrape_jsonl(tmp_path/'ga.warc.gz', tmp_path/name) == len(POSTS)
+    assert list(greatami.iter_gaposts(tmp_path/name)) == POSTS
+    assert greatami.flatten_gadata(tmp_path/name) == POSTS
+    if name.endswith('.gz'):
+        assert gzip.open(tmp_path/name).read().decode().count('\n') == len(POSTS)
+
+
+@pytest.mark.parametrize('name', ['ga.json', 'ga.json.gz'])
+def test_json_page_dumps_still_load(tmp_path, name):
+    with (gzip.open if name.endswith('.gz') else open)(tmp_path/name, 'wt') as f:
+        json.dump(PAGES, f)
+    assert not greatami.is_jsonl(tmp_path/name)
+    assert greatami.flatten_gadata(tmp_path/name) == POSTS
+    assert greatami.flatten_gadata(PAGES) == POSTS
+
+
+def test_interrupted_gzip_scrape_is_readable(tmp_path, monkeypatch):
+    outfile = tmp_path/'ga.jsonl.gz'
+    snapshots = []
+    def iter_pages(warc_outfile, timeout=2):
+        for page in PAGES:
+            # file contents as a killed process would leave them, right after the previous page was flushed
+            snapshots.append(outfile.read_bytes())
+            yield page
+    scraper = GreatAmigurumiScraper()
+    monkeypatch.setattr(scraper, 'iter_pages', iter_pages)
+    scraper.scrape_jsonl(tmp_path/'ga.warc.gz', outfile)
+
+    killed = tmp_path/'killed.jsonl.gz'
+    killed.write_bytes(snapshots[2])
+    assert list(greatami.iter_gaposts(killed)) == POSTS[:4]
+    # cut anywhere, the posts read are a prefix of the scrape
+    for cut in range(10, len(snapshots[2]), 7):
+        killed.write_bytes(snapshots[2][:cut])
+        posts = list(greatami.iter_gaposts(killed))
+        assert posts == POSTS[:len(posts)]
+
+
+def test_partial_last_line(tmp_path):
+    lines = [json.dumps(post) for post in POSTS]
+    path = tmp_path/'ga.jsonl'
+    path.write_text('\n'.join(lines[:3]) + '\n\n' + lines[3][:20])
+    assert list(greatami.iter_gaposts(path)) == POSTS[:3]
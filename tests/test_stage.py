@@ -0,0 +1,90 @@
+import json
+import tarfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from crawchet.process import stage, transform
+
+ITEMS = {f'blog{i%3}/texts/{i}_bear.md': f'# Bear {i}\n\nRnd 1: 6 sc in magic ring ({i})\n' for i in range(7)}
+
+
+def read_staged(out_path, fmt):
+    '''{name: text} of everything StagedWriter wrote to out_path'''
+    if fmt == 'files':
+        return {p.relative_to(out_path).as_posix(): p.read_text() for p in out_path.rglob('*') if p.is_file()}
+    if fmt == 'ndjson':
+        lines = [json.loads(line) for p in sorted(out_path.glob('part-*.ndjson')) for line in p.read_text().splitlines()]
+        return {line['name']: line['text'] for line in lines}
+    if fmt == 'zip':
+        with zipfile.ZipFile(out_path) as zf:
+            return {name: zf.read(name).decode() for name in zf.namelist()}
+    with tarfile.open(out_path) as tf:
+        return {m.name: tf.extractfile(m).read().decode() for m in tf.getmembers()}
+
+
+@pytest.mark.parametrize('fmt, name', [('files', 'out'), ('ndjson', 'out'), ('zip', 'out.zip'), ('tar', 'out.tar.gz'), ('tar', 'out.tar')])
+def test_formats_write_the_same_items(tmp_path, fmt, name):
+    names, texts = list(ITEMS), list(ITEMS.values())
+    with stage.StagedWriter(tmp_path/name, fmt=fmt, n_threads=3, shard_size=3) as writer:
+        writer.write(names[:4], texts[:4])
+        writer.write(iter(names[4:]), iter(texts[4:]))
+    assert writer.n_written == len(ITEMS)
+    assert read_staged(tmp_path/name, fmt) == ITEMS
+
+
+def test_ndjson_shards(tmp_path):
+    with stage.StagedWriter(tmp_path, fmt='ndjson', shard_size=3) as writer:
+        writer.write(list(ITEMS)[:2], list(ITEMS.values())[:2])
+        writer.write_records({'data': {'i': i}} for i in range(5))
+    assert [len(p.read_text().splitlines()) for p in sorted(tmp_path.glob('part-*.ndjson'))] == [3, 3, 1]
+
+
+def test_bad_fmt_and_records(tmp_path):
+    with pytest.raises(ValueError):
+        stage.StagedWriter(tmp_path, fmt='parquet')
+    with stage.StagedWriter(tmp_path/'out.zip', fmt='zip') as writer:
+        with pytest.raises(ValueError):
+            writer.write_records([{'a': 1}])
+
+
+def test_iter_frames():
+    df = pd.DataFrame({'a': range(5)})
+    assert [len(b) for b in stage.iter_frames(df, 2)] == [2, 2, 1]
+    assert [len(b) for b in stage.iter_frames([df, df.iloc[:0], df.iloc[:3]], 4)] == [4, 1, 3]
+
+
+def test_render_front_matter_matches_yaml_dump():
+    df = pd.DataFrame({
+        'title': ['Bear: a "free" pattern', 'Ours en peluche ééé', None],
+        'tag_list': [['bear', 'amigurumi'], [], ['x']],
+        'term_count': np.array([12, 0, 3], dtype=np.int64),
+        'content_length': [1.5, 2.0, np.nan],
+        'url': ['http://a.com/' + 'x'*200, 'http://b.com', 'http://c.com'],
+    })
+    front_matter = stage.render_front_matter(df)
+    for fm, rec in zip(front_matter, df.to_dict('records')):
+        assert fm.startswith('---\n') and fm.endswith('---\n\n')
+        rec = {k: (v.item() if isinstance(v, np.generic) else v) for k, v in rec.items()}
+        expected = yaml.dump(rec, Dumper=yaml.SafeDumper, default_flow_style=None, sort_keys=False, width=float('inf'))
+        assert fm == '---\n' + expected + '---\n\n'
+        loaded = yaml.safe_load(fm.strip('-\n'))
+        assert loaded['tag_list'] == rec['tag_list'] and loaded['term_count'] == rec['term_count']
+
+
+def test_write_json_formats(tmp_path):
+    json_cols = ['ptid', 'text', 'post_title', 'languages', 'term_count', 'content_length', 'url']
+    df = pd.DataFrame({'ptid': ['00001', '00002', '00003'], 'text': ['a', 'b', 'ü'], 'post_title': ['A', 'B', 'C'],
+                       'languages': [['en'], ['fr'], []], 'term_count': [1, 2, 3], 'content_length': [10, 20, 30],
+                       'url': ['http://a', 'http://b', 'http://c'], 'extra': [0, 0, 0]})
+    expected = [{'data': rec} for rec in df[json_cols].to_dict('records')]
+
+    transform.write_json([df.iloc[:2], df.iloc[2:]], tmp_path/'out.json', batch_size=1)
+    assert (tmp_path/'out.json').read_text() == json.dumps(expected)
+
+    transform.write_json(df, tmp_path/'ndjson', fmt='ndjson', shard_size=2)
+    lines = [json.loads(line) for p in sorted((tmp_path/'ndjson').glob('part-*.ndjson')) for line in p.read_text().splitlines()]
+    assert lines == expected
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from crawchet.process import terms, parsehtml
+
+TEXTS = [
+    '<title>Bear</title><p>Rnd 1: 6 sc in magic ring (6)<br/>Rnd 2: inc x6 (12)<br/>Rnd 3: (sc, inc) x6 (18)</p>',
+    'Row 1: ch 10, sl st in 2nd ch from hook, sc2tog, 3dc, hdc in each st. Rep rows 2-4.',
+    'Vuelta 1: 6 pb en anillo mágico (6). Vuelta 2: 6 aum (12)',
+    'Toer 1: 6 v in een magische ring (6)<br/>Toer 2: 6 meerd (12)<br/>Toer 3: 3br, 2 l',
+    '',
+    None,
+]
+
+
+def test_english_counts_match_crochet_terms_regex():
+    counts = terms.TermCounter(['en']).count_totals(TEXTS)
+    expected = pd.Series(TEXTS).fillna('').str.count(parsehtml.RE_CROCHET_TERMS).to_numpy()
+    assert counts.tolist() == expected.tolist()
+
+
+def test_count_matrix_columns_and_parallel():
+    counter = terms.TermCounter(['en', 'es', 'nl'])
+    matrix = counter.count_matrix(TEXTS, batch_size=2, n_jobs=1)
+    assert matrix.shape == (len(TEXTS), len(counter.terms))
+    assert (counter.count_matrix(TEXTS, batch_size=2, n_jobs=2) != matrix).nnz == 0
+    assert [counter.count(t) for t in TEXTS[4:]] == [{}, {}]
+
+    es = counter.count(TEXTS[2])
+    assert es == {'es:pb': 1, 'es:aum': 1, 'es:vuelta': 2, 'es:anillo_magico': 1}
+    row = np.asarray(matrix[2].todense()).ravel()
+    assert {counter.terms[i]: c for i, c in enumerate(row) if c} == es
+
+
+def test_terms_shared_between_languages_are_one_feature():
+    counter = terms.TermCounter(['es', 'pt'])
+    assert 'es:aum' in counter.terms and 'pt:aum' not in counter.terms
+    assert counter.count('6 aum') == {'es:aum': 1}
+
+
+@pytest.mark.parametrize('text', [
+    'Rnd 1: 6 sc (6)<br/>Rnd 2: inc x6<br/>Rnd 3: x6<br>',
+    'l v v l br BR v. l, a l a v',
+    'Vitamin C, plan v2 of the blog, la vie en rose',
+])
+def test_single_letters_and_br_tags_are_not_counted(text):
+    counts = terms.TermCounter(['fr', 'nl']).count(text)
+    assert not {'fr:br', 'nl:v', 'nl:l'} & set(counts)
+
+
+def test_counted_abbreviations_after_stitch_count():
+    counts = terms.TermCounter(['fr', 'nl']).count(TEXTS[3])
+    assert counts['nl:v'] == 1 and counts['nl:l'] == 1 and counts['fr:br'] == 1
+    assert counts['nl:toer'] == 3 and counts['nl:magische_ring'] == 1
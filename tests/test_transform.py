@@ -0,0 +1,28 @@
+import pytest
+
+from crawchet.process import transform
+
+
+def test_warc_to_parquet_matches_warc_to_dftext(tmp_path, warc_file):
+    dataset_dir = tmp_path/'textracts'
+    transform.warc_to_parquet(warc_file, dataset_dir, chunk_size=5, n_jobs=1)
+    assert sorted(f.name for f in dataset_dir.glob('part-*.parquet')) == ['part-00000.parquet', 'part-00001.parquet', 'part-00002.parquet']
+
+    df_expected = transform.warc_to_dftext(warc_file, by_offset=True, n_jobs=1).reset_index(drop=True)
+    df_read = transform.read_textracts(dataset_dir)
+    assert df_read[df_expected.columns].equals(df_expected)
+
+
+def test_warc_to_parquet_resumes_and_checks_settings(tmp_path, warc_file):
+    dataset_dir = tmp_path/'textracts'
+    transform.warc_to_parquet(warc_file, dataset_dir, chunk_size=5, n_jobs=1)
+    first, last = dataset_dir/'part-00000.parquet', dataset_dir/'part-00002.parquet'
+    last.unlink()
+    mtime = first.stat().st_mtime_ns
+
+    transform.warc_to_parquet(warc_file, dataset_dir, chunk_size=5, n_jobs=1)
+    assert last.exists() and first.stat().st_mtime_ns == mtime
+    assert len(transform.read_textracts(dataset_dir)) == 12
+
+    with pytest.raises(ValueError):
+        transform.warc_to_parquet(warc_file, dataset_dir, chunk_size=4, n_jobs=1)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from crawchet.utils import uri as uutil
+
+URLS = [
+    'https://1.bp.blogspot.com/-x/AAA/s400/bear.jpg',
+    '//2.bp.blogspot.com/-y/S1600/bunny.PNG',
+    '://example.com/a/s72/cat.gif',
+    'hhttp://example.com/doll.jpeg?x=1',
+    'https://web.archive.org/web/20221210031853/https://www.example.com:80/s320/bear.jpg',
+    'http://web.archive.org/web/2015/http://blog.example.com/2015/01/bear.html',
+    'https://blog.example.com/2020/01/bear.html#comments',
+    'https://example.com/images.jpg.html',
+    'https://example.com/page?img=bear.jpg',
+    'https://www.amazon.com/dp/123',
+    'https://example.com/pattern.PDF',
+    'mailto:someone@example.com',
+    'javascript:void(0)',
+    'https://exämple.com/s400/ours.jpg',
+    'https://example.com/s٤٠٠/bear.jpg',
+    ' https://example.com/bear.jpg',
+    'https://example.com/a;params/bear.jpg',
+    'ftp://example.com/bear.jpg',
+    '',
+    'bear.jpg',
+    '//1.bp.blogspot.com/-x/AAA/s400/bear.jpg',
+    'https://web.archive.org/web/2015id_/',
+    'https://web.archive.org/web/2015/http://example.com:8080/a:80/b/\n/http://example.com',
+    'https://web.archive.org/web/2015/https://exämple.com:80/S400/ours.jpg',
+]
+
+
+@pytest.fixture
+def urls():
+    # repeated urls, and nulls between them
+    return pd.Series(URLS*3 + [None, np.nan], index=range(100, 100+len(URLS)*3+2), dtype=object)
+
+
+def scalar(func, urls, null=None):
+    return pd.Series([func(url) if isinstance(url, str) else null for url in urls], index=urls.index)
+
+
+@pytest.mark.parametrize('chunk_size', [4, 50000])
+def test_batch_functions_match_scalar_versions(urls, chunk_size):
+    strings = urls.map(type).eq(str)
+    pd.testing.assert_series_equal(uutil.fix_urlschemes(urls, chunk_size=chunk_size)[strings], scalar(uutil.fix_urlscheme, urls)[strings])
+    for resize in [False, True]:
+        pd.testing.assert_series_equal(uutil.fix_imgurls(urls, resize, chunk_size=chunk_size)[strings],
+                                       scalar(lambda u: uutil.fix_imgurl(u, resize), urls)[strings])
+    for strip_port in [False, True]:
+        pd.testing.assert_series_equal(uutil.get_original_urls(urls, strip_port, chunk_size=chunk_size)[strings],
+                                       scalar(lambda u: uutil.get_original_url(u, strip_port), urls)[strings])
+    pd.testing.assert_series_equal(uutil.are_imageurls(urls, chunk_size=chunk_size), scalar(uutil.is_imageurl, urls, False))
+    pd.testing.assert_series_equal(uutil.link_filters(urls, chunk_size=chunk_size), scalar(uutil.link_filter, urls, False))
+
+
+@pytest.mark.parametrize('values', [[None, np.nan, None], ['//a.com/s400/b.jpg', None, 'http://b.com', np.nan, '//a.com/s400/b.jpg']])
+def test_nulls_pass_through(values):
+    urls = pd.Series(values, dtype=object)
+    is_null = urls.isna()
+    for func, scalar_func in [(uutil.fix_urlschemes, uutil.fix_urlscheme), (uutil.fix_imgurls, uutil.fix_imgurl),
+                              (uutil.get_original_urls, uutil.get_original_url)]:
+        out = func(urls)
+        assert out.dtype == object and out.index.equals(urls.index)
+        assert out[is_null].tolist() == urls[is_null].tolist()
+        assert out[~is_null].tolist() == [scalar_func(url) for url in urls[~is_null]]
+    for func in [uutil.are_imageurls, uutil.link_filters]:
+        out = func(urls)
+        assert out.dtype == bool and not out[is_null].any()
+
+
+def test_empty_input():
+    assert uutil.fix_urlschemes([]).tolist() == []
+    assert uutil.are_imageurls(pd.Series([], dtype=object)).dtype == bool
+
+
+def test_canonicalize_url():
+    assert uutil.canonicalize_url('https://web.archive.org/web/20221210031853/https://www.Example.com:80/a/?b=2&a=1#c') == 'http://example.com/a?a=1&b=2'
+    assert uutil.canonicalize_url('//www.example.com') == uutil.canonicalize_url('http://example.com/') == 'http://example.com/'
+    assert uutil.canonicalize_url(None) is None